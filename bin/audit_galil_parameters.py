@@ -0,0 +1,67 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function, unicode_literals
+__version__ = '0.0.1'
+
+import sys
+from os.path import dirname, abspath
+sys.path.insert(1, dirname(dirname(abspath(__file__))))
+
+import logging
+logging.basicConfig()
+
+from galil_apci.audit import audit_fleet, load_inventory, write_report
+
+
+import argparse
+def getopts():
+    parser = argparse.ArgumentParser(description="""Check galil controller parameters against templates across a fleet of controllers""")
+
+    parser.add_argument('--version', action='version', version='This is %(prog)s version {}'.format(__version__))
+
+    parser.add_argument('--template', type=str, help='default parameter definition file')
+    parser.add_argument('--axes',     type=str, default='ABCDEFGH', help='default axes present on controllers')
+    parser.add_argument('--workers',  type=int, default=8, help='maximum concurrent controller connections')
+    parser.add_argument('--format',   type=str, choices=('json', 'csv'), default='json', help='report format')
+    parser.add_argument('--output', '-o', type=str, help='report file (default STDOUT)')
+
+    parser.add_argument('inventory', type=str, help='controller list: JSON or "address [template [axes]]" lines')
+
+    return parser.parse_args()
+
+
+def MAIN(argv):
+    inventory = load_inventory(argv.inventory, template=argv.template, axes=argv.axes)
+
+    def progress(res):
+        sys.stderr.write("{address}: {status} ({changes} changes, {total:.2f}s)\n".format(
+            address=res['address'], status=res['status'], changes=len(res['changes']), total=res['timings']['total'],
+        ))
+
+    results = audit_fleet(inventory, workers=argv.workers, callback=progress)
+
+    if not argv.output or '-' == argv.output:
+        write_report(results, sys.stdout, argv.format)
+    else:
+        with open(argv.output, 'w') as fh:
+            write_report(results, fh, argv.format)
+
+    return 0 if all(res['status'] == 'ok' for res in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(MAIN(getopts()))
@@ -17,6 +17,7 @@
 from __future__ import division, absolute_import, print_function, unicode_literals
 __version__ = '0.0.1'
 
+import sys
 from os.path import dirname, abspath
 sys.path.insert(1, dirname(dirname(abspath(__file__))))
 
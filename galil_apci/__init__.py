@@ -17,8 +17,58 @@
 from __future__ import division, absolute_import, print_function
 __version__ = "1.2.0"
 
-from galil_apci.galil      import Galil       # noqa F401
-from galil_apci.file       import GalilFile   # noqa F401
+# Exported names are imported from their modules on first use, so that
+# tools which need only part of the package do not pay for (or require)
+# the rest: e.g., templates only need jinja2, controller access only the
+# transport.
+import importlib
+import sys
+import types
 
-from galil_apci.parameters import *           # noqa F401, F403
-from galil_apci.config     import *           # noqa F401, F403
+_LAZY = dict(
+    Galil="galil",
+    GalilFile="file",
+    RetryPolicy="retry",
+    GalilConfig="config",
+    Variable="schema", VariableSchema="schema",
+)
+# Modules re-exported as a whole: their names (from the module's
+# __all__) join _LAZY when first needed.
+_LAZY_MODULES = ["parameters"]
+
+def _lazy_names():
+    while _LAZY_MODULES:
+        module = _LAZY_MODULES.pop()
+        for name in importlib.import_module("galil_apci." + module).__all__:
+            _LAZY[str(name)] = module      # unicode_literals on Python 2
+    return _LAZY
+
+
+class LazyModule(types.ModuleType):
+    def __getattr__(self, name):
+        if name == "__all__":
+            value = sorted(_lazy_names())
+        else:
+            # exports are classes; lowercase names are e.g. submodules
+            # probed by "from galil_apci import errors"
+            if name not in _LAZY and name[:1].isupper():
+                _lazy_names()
+            if name not in _LAZY:
+                raise AttributeError("module '{}' has no attribute '{}'".format(self.__name__, name))
+            value = getattr(importlib.import_module("galil_apci." + _LAZY[name]), name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_lazy_names()))
+
+
+try:
+    sys.modules[__name__].__class__ = LazyModule
+except TypeError:
+    # Python 2: replace the module, keeping the original alive (its
+    # globals are cleared when it is collected).
+    _lazy = LazyModule(__name__, __doc__)
+    _lazy.__dict__.update(globals())
+    _lazy._module = sys.modules[__name__]
+    sys.modules[__name__] = _lazy
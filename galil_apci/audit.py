@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Fleet-wide parameter audits
+
+Compares the parameters of many controllers against their configuration
+templates concurrently (a bounded pool of worker threads, each with its
+own controller connection) and produces a machine-readable drift report.
+"""
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function
+__all__ = 'audit_controller audit_fleet load_inventory write_report'.split()
+
+import csv
+import json
+import time
+
+from multiprocessing.pool import ThreadPool
+
+from .config import GalilConfig
+from .galil import Galil, logger
+
+REPORT_FIELDS = 'address template status elapsed cmd filename lineno expected actual error'.split()
+CHANGE_FIELDS = 'cmd filename lineno expected actual'.split()
+
+
+def load_inventory(fname, template=None, axes='ABCDEFGH'):
+    """
+    Reads a controller inventory. Either a JSON list of objects with
+    "address", "template" and (optional) "axes" keys, or a text file
+    with one "address [template [axes]]" entry per line (blank lines and
+    lines starting with "#" are ignored). Missing templates and axes are
+    taken from the arguments.
+    """
+    with open(fname, 'r') as fh:
+        content = fh.read()
+
+    if content.lstrip().startswith('['):
+        entries = json.loads(content)
+    else:
+        entries = []
+        for line in content.splitlines():
+            fields = line.replace(",", " ").split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            entries.append(dict(zip(('address', 'template', 'axes'), fields)))
+
+    for entry in entries:
+        entry.setdefault('template', template)
+        entry.setdefault('axes', axes)
+        if not entry['template']:
+            raise Exception("No template given for controller {}".format(entry['address']))
+    return entries
+
+
+def audit_controller(address, template, axes='ABCDEFGH', connect=Galil):
+    """
+    Audits a single controller over a connection from C{connect(address)},
+    closed when done. Never raises, errors are reported in the result
+    dictionary:
+
+        address, template, axes,
+        status:  "ok", "drift", or "error"
+        error:   error message (status "error" only)
+        changes: list of dicts (cmd, filename, lineno, expected, actual)
+        timings: dict of seconds spent in connect, load, check and total
+    """
+    result = dict(address=address, template=template, axes=axes, changes=[], timings=dict())
+    t0 = time.time()
+    stage = "connect"
+    galil = None
+    try:
+        galil = connect(address)
+        t1 = time.time()
+        result['timings']['connect'] = t1 - t0
+
+        stage = "load"
+        conf = GalilConfig(galil, axes=axes).load(template)
+        t2 = time.time()
+        result['timings']['load'] = t2 - t1
+
+        stage = "check"
+        for item, curr in conf.diff():
+            result['changes'].append(dict(
+                cmd=getattr(item, 'cmd', item.name),
+                filename=item.filename, lineno=item.lineno,
+                expected=str(item.value), actual=str(curr),
+            ))
+        result['timings']['check'] = time.time() - t2
+        result['status'] = "drift" if result['changes'] else "ok"
+    except Exception as err:
+        logger.warning("Audit of %s failed during %s: %s", address, stage, err)
+        result['status'] = "error"
+        result['error'] = "{}: {}".format(stage, err)
+    finally:
+        # controllers have only a few handles, do not wait for the collector
+        if galil is not None and hasattr(galil, "close"):
+            try:
+                galil.close()
+            except Exception as err:
+                logger.warning("Closing connection to %s failed: %s", address, err)
+    result['timings']['total'] = time.time() - t0
+    return result
+
+
+def audit_fleet(inventory, workers=8, connect=Galil, callback=None):
+    """
+    Audits all controllers in an inventory (see L{load_inventory})
+    using at most C{workers} concurrent connections. Returns the list of
+    results (see L{audit_controller}) in inventory order. If given,
+    C{callback} is called with each result as it completes.
+    """
+    def run(entry):
+        res = audit_controller(entry['address'], entry['template'], entry.get('axes', 'ABCDEFGH'), connect=connect)
+        if callback is not None:
+            callback(res)
+        return res
+
+    pool = ThreadPool(max(1, min(workers, len(inventory))))
+    try:
+        return pool.map(run, inventory, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def write_report(results, fh, format='json'):
+    """
+    Writes a drift report. JSON reports contain the full results, CSV
+    reports have one row per changed parameter (and a single row for
+    controllers without changes).
+    """
+    if format == 'json':
+        json.dump(dict(generated=time.time(), controllers=results), fh, indent=2, sort_keys=True)
+        fh.write("\n")
+    elif format == 'csv':
+        writer = csv.writer(fh)
+        writer.writerow(REPORT_FIELDS)
+        for res in results:
+            base = [ res['address'], res['template'], res['status'], "{:.3f}".format(res['timings']['total']) ]
+            if res['status'] == 'error':
+                writer.writerow(base + [ "" ] * len(CHANGE_FIELDS) + [ res.get('error', '') ])
+            for change in res['changes']:
+                writer.writerow(base + [ change[k] for k in CHANGE_FIELDS ] + [ "" ])
+            if res['status'] == 'ok':
+                writer.writerow(base + [ "" ] * (len(CHANGE_FIELDS) + 1))
+    else:
+        raise ValueError("Unknown report format '{}'".format(format))
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+Controller backups
+
+Backs up controller programs, arrays and parameter snapshots into a
+content-addressed local store. Each backed up item is normalized (line
+endings, trailing whitespace) and hashed, and only content not already
+present in the store is written (compressed with zstd when the
+C{zstandard} module is available, else gzip). Every backup writes a small
+JSON manifest mapping item names ("program", "array/NAME", "parameters")
+to content hashes, so that nightly backups of unchanged controllers cost
+one manifest each.
+
+When the board program carries an xAPI hash (see L{Galil.add_xAPI}) and
+the hash matches the previous backup of the same controller, the program
+is not uploaded again.
+"""
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function
+__all__ = 'BackupStore backup_controller restore_controller normalize'.split()
+
+import difflib
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import tempfile
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .galil import Galil, logger
+
+p_trailing_space = re.compile(r'[ \t]+$', re.M)
+
+
+def gzip_compress(data):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as fh:
+        fh.write(data)
+    return buf.getvalue()
+
+def gzip_decompress(data):
+    with gzip.GzipFile(fileobj=io.BytesIO(data), mode='rb') as fh:
+        return fh.read()
+
+# extension: (compress, decompress)
+COMPRESSORS = dict(gz=(gzip_compress, gzip_decompress))
+if zstandard is not None:
+    COMPRESSORS['zst'] = (
+        lambda data: zstandard.ZstdCompressor(level=10).compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data),
+    )
+
+
+def normalize(content):
+    """
+    Normalizes uploaded text: unix line endings, no trailing whitespace
+    and a single final newline. Returns bytes.
+    """
+    if isinstance(content, bytes):
+        content = content.decode('latin-1')
+    content = content.replace("\r\n", "\n").replace("\r", "\n")
+    content = p_trailing_space.sub("", content).rstrip("\n")
+    return (content + "\n" if content else content).encode('latin-1')
+
+
+def safe_name(controller):
+    return re.sub(r'[^\w.\-]+', '_', controller)
+
+
+class BackupStore(object):
+    """
+    Content-addressed backup store.
+
+    @param root: Store directory (created as needed). Objects are stored
+        in C{root/objects/XX/HASH.EXT}, manifests in
+        C{root/snapshots/CONTROLLER/TIMESTAMP.json}.
+
+    @param compression: "zst", "gz", or None for the best available.
+    """
+    def __init__(self, root, compression=None):
+        if compression is None:
+            compression = 'zst' if 'zst' in COMPRESSORS else 'gz'
+        if compression not in COMPRESSORS:
+            raise Exception("Unsupported backup compression '{}'".format(compression))
+        self.root = root
+        self.compression = compression
+
+    def object_path(self, digest, ext=None):
+        return os.path.join(self.root, "objects", digest[0:2], "{}.{}".format(digest, ext or self.compression))
+
+    def find(self, digest):
+        """Path to a stored object (any compression), or None"""
+        for ext in [ self.compression ] + sorted(COMPRESSORS):
+            path = self.object_path(digest, ext)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def put(self, content):
+        """
+        Stores (already normalized) content unless already present.
+        Returns (digest, written) where written is the number of bytes
+        written to disk (0 if the content was already stored).
+        """
+        digest = hashlib.sha256(content).hexdigest()
+        if self.find(digest):
+            return digest, 0
+        data = COMPRESSORS[self.compression][0](content)
+        self._write(self.object_path(digest), data)
+        return digest, len(data)
+
+    def get(self, digest):
+        """Returns stored content (bytes)"""
+        path = self.find(digest)
+        if path is None:
+            raise Exception("Backup object {} not found in {}".format(digest, self.root))
+        with open(path, 'rb') as fh:
+            data = fh.read()
+        return COMPRESSORS[path.rsplit(".", 1)[1]][1](data)
+
+    def _write(self, path, data):
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix=".tmp-")
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(data)
+        os.rename(tmp, path)
+
+    def snapshots(self, controller):
+        """Manifest paths of a controller, oldest first"""
+        path = os.path.join(self.root, "snapshots", safe_name(controller))
+        if not os.path.isdir(path):
+            return []
+        return [ os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith(".json") ]
+
+    def controllers(self):
+        path = os.path.join(self.root, "snapshots")
+        if not os.path.isdir(path):
+            return []
+        return sorted(os.listdir(path))
+
+    def manifest(self, spec, controller=None):
+        """
+        Loads a manifest. C{spec} may be a manifest path, a manifest
+        file name or timestamp prefix of one of C{controller}'s
+        snapshots, or a negative index into the controller's snapshots
+        (-1 = latest).
+        """
+        if isinstance(spec, dict):
+            return spec
+        if isinstance(spec, int) or re.match(r'^-\d+$', str(spec)):
+            snaps = self.snapshots(controller)
+            try:
+                path = snaps[int(spec)]
+            except IndexError:
+                raise Exception("No backup {} of controller {}".format(spec, controller))
+        elif os.path.exists(spec):
+            path = spec
+        else:
+            path = None
+            for snap in self.snapshots(controller or ""):
+                if os.path.basename(snap).startswith(spec):
+                    path = snap
+            if path is None:
+                raise Exception("No backup '{}' of controller {}".format(spec, controller))
+        with open(path, 'r') as fh:
+            return json.load(fh)
+
+    def latest(self, controller):
+        snaps = self.snapshots(controller)
+        return self.manifest(snaps[-1]) if snaps else None
+
+    def commit(self, controller, items, info=None):
+        """
+        Writes a manifest for C{items} (dict of name: digest). Returns
+        the manifest path.
+        """
+        now = time.time()
+        manifest = dict(info or {}, controller=controller, time=now, items=items)
+        # truncate (not round) milliseconds, ".9996" must not become ".000" of the same second
+        stamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime(now)) + ".{:03d}".format(int(now * 1000) % 1000)
+        path = os.path.join(self.root, "snapshots", safe_name(controller), stamp + ".json")
+        # manifests of the same millisecond: name_001.json, ... sort after name.json
+        n = 0
+        while os.path.exists(path):
+            n += 1
+            path = os.path.join(self.root, "snapshots", safe_name(controller), "{}_{:03d}.json".format(stamp, n))
+        self._write(path, json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+        return path
+
+    def diff(self, old, new, controller=None, context=3):
+        """
+        Unified diff between two manifests (see L{manifest}). Returns an
+        iterator of text lines.
+        """
+        old = self.manifest(old, controller)
+        new = self.manifest(new, controller)
+        for name in sorted(set(old['items']) | set(new['items'])):
+            a, b = old['items'].get(name), new['items'].get(name)
+            if a == b:
+                continue
+            a_lines = self.get(a).decode('latin-1').splitlines(True) if a else []
+            b_lines = self.get(b).decode('latin-1').splitlines(True) if b else []
+            for line in difflib.unified_diff(a_lines, b_lines, "a/" + name, "b/" + name, n=context):
+                yield line if line.endswith("\n") else line + "\n"
+
+
+def array_text(values):
+    return "".join( "{}\n".format(Galil.round(v)) for v in values )
+
+def array_values(content):
+    return [ float(x) for x in content.split() ]
+
+
+def backup_controller(galil, store, controller=None, arrays=(), template=None, axes='ABCDEFGH',
+                      skip_unchanged=False):
+    """
+    Backs up a controller: the program, the named arrays and (if a
+    parameter C{template} is given, see L{GalilConfig}) the current values
+    of the template parameters.
+
+    @param skip_unchanged: Reuse the program of the previous backup,
+        without uploading, when the board program hash (xPrgHash) is
+        unchanged and xPrgOK is set. Only L{Galil.ensureBoardProgram}
+        maintains these; a program downloaded by other means (GalilTools,
+        C{DL}) keeps the old hash, so only use this when all downloads go
+        through it.
+
+    Returns (manifest_path, stats) where stats is a dict with the
+    number of items, items changed since the previous backup, bytes
+    written and whether the program upload was skipped.
+    """
+    controller = controller or galil.address
+    previous = store.latest(controller)
+    prev_items = previous['items'] if previous else dict()
+    items, info = dict(), dict()
+    stats = dict(items=0, changed=0, written=0, upload_skipped=False)
+
+    def add(name, content):
+        digest, written = store.put(normalize(content))
+        items[name] = digest
+        stats['items']   += 1
+        stats['written'] += written
+        if prev_items.get(name) != digest:
+            stats['changed'] += 1
+
+    board_hash = galil.getBoardProgramHash()
+    if board_hash is not None:
+        info['board_hash'] = board_hash.strip()
+    if (skip_unchanged and board_hash is not None and previous and 'program' in prev_items
+            and previous.get('board_hash') == info['board_hash'] and store.find(prev_items['program'])
+            and galil.get("xPrgOK", 0)):
+        items['program'] = prev_items['program']
+        stats['items'] += 1
+        stats['upload_skipped'] = True
+    else:
+        add("program", galil.programUpload())
+
+    for name in arrays:
+        add("array/" + name, array_text(galil.arrayUpload(name)))
+
+    if template is not None:
+        from .config import GalilConfig
+        conf = GalilConfig(galil, axes=axes).load(template)
+        lines = []
+        for item, value in zip(*conf.fetch()):
+            if value is not None:
+                item.value = value
+            lines.append(str(item))
+        info['axes'] = axes
+        add("parameters", "\n".join(lines))
+
+    path = store.commit(controller, items, info)
+    logger.info("Backup of %s: %d items, %d changed, %d bytes written", controller, stats['items'], stats['changed'], stats['written'])
+    return path, stats
+
+
+def restore_controller(galil, store, manifest, controller=None, names=None, dry_run=False):
+    """
+    Restores items of a backup (see L{BackupStore.manifest}) to a
+    controller. C{names} limits the restored items ("program",
+    "array/NAME", "parameters"). Parameters are applied with
+    L{GalilConfig.apply}. Returns (restored, plan): the list of restored
+    item names and the plan returned by L{GalilConfig.apply} (None if no
+    parameters were restored).
+    """
+    manifest = store.manifest(manifest, controller or galil.address)
+    restored, plan = [], None
+    for name in sorted(manifest['items']):
+        if names is not None and name not in names:
+            continue
+        content = store.get(manifest['items'][name])
+        if name == "program":
+            if not dry_run:
+                galil.programDownload(content.decode('latin-1'))
+        elif name.startswith("array/"):
+            if not dry_run:
+                galil.arrayDownload(array_values(content), name[6:])
+        elif name == "parameters":
+            from .config import GalilConfig
+            conf = GalilConfig(galil, axes=manifest.get('axes', 'ABCDEFGH'))
+            conf.loads(content.decode('latin-1'), "{}:parameters".format(manifest['controller']))
+            plan = conf.apply(dry_run=dry_run)
+        else:
+            logger.warning("Unknown backup item '%s' not restored", name)
+            continue
+        restored.append(name)
+    return restored, plan
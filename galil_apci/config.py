@@ -21,7 +21,12 @@ __all__ = 'GalilConfig'.split()
 
 import re
 
+from array import array
 from functools import partial
+from multiprocessing import Pool
+
+from .errors import CommandError
+from .galil import Galil, logger, pack
 from .parameters import AxisMaskParameter, AxisQueryParameter
 from .parameters import BasicParameter, BasicQueryParameter
 from .parameters import CmdParameter, EqParameter, IndexedParameter, NetworkParameter
@@ -47,6 +52,139 @@ CONFIG_PARSERS = [
     (re.compile(r'^\s*(?P<name>CN)\s+(?P<value>.*)$'), partial(VectorParameter, length=5)),
 ]
 
+_compiled_parsers = dict()
+
+def compiled_parsers():
+    """
+    Compiles CONFIG_PARSERS into a single alternation so that each line
+    is parsed with one match. Since alternatives are tried in order, the
+    first matching parser wins, exactly as when trying each pattern in
+    turn.
+
+    Named groups are renamed C{_<index>_<name>} and each alternative is
+    wrapped in a group named C{_<index>} so that the matching parser can
+    be found from C{match.lastgroup} (the outermost group closes last).
+
+    Returns (regex, [ (class, [(group, name), ...]), ... ]). The result
+    is cached, but recompiled if CONFIG_PARSERS is modified.
+    """
+    key = tuple( (id(pat), id(cls)) for pat, cls in CONFIG_PARSERS )
+    if key not in _compiled_parsers:
+        alternatives = []
+        targets = []
+        for i, (pat, cls) in enumerate(CONFIG_PARSERS):
+            names = sorted(pat.groupindex, key=pat.groupindex.get)
+            src = re.sub(r'\(\?P<(\w+)>', r'(?P<_{}_\1>'.format(i), pat.pattern)
+            alternatives.append('(?P<_{}>{})'.format(i, src))
+            targets.append((GalilConfig.lookup_class(cls), [ ('_{}_{}'.format(i, n), n) for n in names ]))
+        _compiled_parsers.clear()
+        _compiled_parsers[key] = (re.compile("|".join(alternatives)), targets)
+    return _compiled_parsers[key]
+
+
+def parse_lines(lines, filename=None):
+    """
+    Parses configuration lines. Returns a list of (lineno, line, index,
+    kwargs) tuples where index is the matching CONFIG_PARSERS entry and
+    kwargs are its named groups.
+    """
+    regex, targets = compiled_parsers()
+    match = regex.match
+    parsed = []
+    for lineno, line in enumerate(lines, start=1):
+        line = line.rstrip()
+        m = match(line)
+        if m is None:
+            raise Exception("Unparsable setting in {} line {}: '{}'".format(filename, lineno, line))
+        idx = int(m.lastgroup[1:])
+        parsed.append((lineno, line, idx, dict( (name, m.group(group)) for group, name in targets[idx][1] )))
+    return parsed
+
+
+def parse_file(filename):
+    """Parses a configuration file (see L{parse_lines})"""
+    with open(filename, 'r') as fh:
+        return parse_lines(fh, filename)
+
+
+class ColumnarLines(object):
+    """
+    Compact storage for the lines of a configuration file.
+
+    Parser index, name, axis/index, value and source location of each
+    line are stored in parallel arrays (file names are stored once in a
+    table). Parameter objects are constructed on demand when indexed or
+    iterated. Assigning a Parameter object back to its index stores its
+    (possibly refreshed) value.
+    """
+    KEYS = ('axis', 'index')
+
+    def __init__(self, galil, axes):
+        self.galil     = galil
+        self.axes      = axes
+        self.kinds     = array(str('h'))
+        self.names     = []
+        self.keys      = []
+        self.values    = []
+        self.files     = array(str('H'))
+        self.linenos   = array(str('I'))
+        self.filenames = []
+        self.file_idx  = dict()
+        self.extras    = dict()
+
+    def append(self, lineno, line, idx, kwargs, filename):
+        if filename not in self.file_idx:
+            self.file_idx[filename] = len(self.filenames)
+            self.filenames.append(filename)
+        cls = compiled_parsers()[1][idx][0]
+        if cls is not None and not callable(cls):
+            raise Exception("Unexpected class {} matched in {} line {}: '{}'".format(cls, filename, lineno, line))
+
+        kwargs = dict(kwargs)
+        key = None
+        for k in self.KEYS:
+            if k in kwargs:
+                key = kwargs.pop(k)
+        self.kinds.append(idx)
+        self.names.append(kwargs.pop('name', None))
+        self.keys.append(key)
+        self.values.append(line if cls is None else kwargs.pop('value', None))
+        self.files.append(self.file_idx[filename])
+        self.linenos.append(lineno)
+        if kwargs:
+            self.extras[len(self.kinds) - 1] = kwargs
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __iter__(self):
+        for i in range(len(self.kinds)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        cls, groups = compiled_parsers()[1][self.kinds[i]]
+        if cls is None:
+            return self.values[i]
+        kwargs = dict(self.extras.get(i, ()))
+        for group, name in groups:
+            if name == 'name':
+                kwargs['name'] = self.names[i]
+            elif name in self.KEYS:
+                kwargs[name] = self.keys[i]
+        if self.values[i] is not None:
+            kwargs['value'] = self.values[i]
+        kwargs.setdefault("axes", self.axes)
+        return cls(galil=self.galil, filename=self.filenames[self.files[i]], lineno=self.linenos[i], **kwargs)
+
+    def __setitem__(self, i, item):
+        if isinstance(item, Parameter):
+            self.values[i] = item.value
+        elif compiled_parsers()[1][self.kinds[i]][0] is None:
+            self.values[i] = item
+        else:
+            raise TypeError("Parameter lines may only be replaced by Parameter objects")
+
+
 class Foo(object):
     def __init__(self, bar, baz):
         self.bar = bar
@@ -61,51 +199,211 @@ class GalilConfig(object):
         self._parser_classes_[cls] = globals().get(cls, cls)
         return self._parser_classes_[cls]
 
-    def __init__(self, galil, axes='ABCDEFGH'):
-        self.galil   = galil
-        self.axes    = axes
+    def __init__(self, galil, axes='ABCDEFGH', columnar=False):
+        """
+        @param columnar: If true, lines are stored in compact
+            L{ColumnarLines} (Parameter objects are created on demand)
+            rather than a list of Parameter objects.
+        """
+        self.galil    = galil
+        self.axes     = axes
+        self.columnar = columnar
 
     def refresh(self):
-        for item in self.lines:
+        for i, item in enumerate(self.lines):
             if isinstance(item, Parameter):
                 item.get(refresh=True)
+                self.lines[i] = item
+
+    def fetch(self):
+        """
+        Reads the current controller value of every parameter. Returns
+        (items, values) lists where items are the configuration lines and
+        values the current values (None for non-parameter lines and
+        commands, see L{is_command}).
+
+        Parameters read by a single C{MG} expression are read together in
+        packed C{MG} commands and "?" queries are packed into
+        semicolon-separated command lines. Other parameters (and any
+        packed line whose response can not be split unambiguously) are
+        read individually.
+        """
+        items  = list(self.lines)
+        values = [None] * len(items)
+        exprs, queries, single = [], [], []
+        for i, item in enumerate(items):
+            if not isinstance(item, Parameter) or self.is_command(item):
+                continue
+            cmd = item.get_cmd() if item.batchable else ""
+            if cmd.startswith("MG") and "," not in cmd and '"' not in cmd:
+                exprs.append((i, cmd[2:]))
+            elif cmd.endswith("?"):
+                queries.append((i, cmd))
+            else:
+                single.append(i)
+
+        if exprs:
+            try:
+                res = self.galil.get_list([ e for i, e in exprs ])
+            except CommandError:
+                res = None
+            if res is None:
+                single.extend( i for i, e in exprs )
+            else:
+                for (i, e), val in zip(exprs, res):
+                    values[i] = Galil.round(val)
+
+        width = self.galil.max_line_length - 2
+        for group in pack([ q for i, q in queries ], "", ";", width):
+            batch, queries = queries[0:len(group)], queries[len(group):]
+            try:
+                res = self.galil.command(";".join(group))
+                res = res.split() if res is not None else []
+            except CommandError:
+                res = []
+            if len(res) == len(batch):
+                for (i, q), val in zip(batch, res):
+                    values[i] = val
+            else:
+                single.extend( i for i, q in batch )
+
+        for i in single:
+            values[i] = items[i].get(refresh=False)
+
+        return items, values
+
+    def diff(self):
+        """
+        Returns a list of (parameter, current value) for all parameters
+        whose controller value differs from the configuration value.
+        """
+        items, values = self.fetch()
+        return [ (item, curr) for item, curr in zip(items, values)
+                 if isinstance(item, Parameter) and not self.is_command(item) and not item.cmp(curr, item.value) ]
+
+    @staticmethod
+    def is_command(item):
+        """
+        True for command lines (C{MO}, C{SHA}, ...). These have no
+        controller value to compare, so are never reported as changed
+        nor issued by L{apply}.
+        """
+        return isinstance(item, CmdParameter)
+
+    def apply(self, dry_run=False, verify=True):
+        """
+        Pushes the configuration to the controller, setting only those
+        parameters whose controller value differs. Set commands are
+        packed into as few command lines as the controller line length
+        allows (see L{Galil.join}), then (unless C{verify} is false) all
+        parameters are read back in a single batched L{fetch}.
+
+        Returns a dictionary:
+
+            changes:  list of (parameter, previous value) needing update
+            commands: list of set commands, in file order
+            lines:    packed command lines (sent unless dry_run)
+            failed:   list of (parameter, current value) still differing
+                      after the update (only present if verified)
+            skipped:  command lines (see L{is_command}) not issued
+
+        @param dry_run: If true, nothing is sent; the returned plan
+            describes what would be sent.
+        """
+        changes  = self.diff()
+        commands = [ item.set_cmd(item.value) for item, curr in changes ]
+        lines    = self.galil.join(commands) if commands else []
+        skipped  = [ item for item in self.lines if self.is_command(item) ]
+        plan = dict(changes=changes, commands=commands, lines=lines, skipped=skipped)
+        for item in skipped:
+            logger.info("%s on %s line %s not issued (command, not a setting)", item.cmd, item.filename, item.lineno)
+        if dry_run:
+            return plan
+
+        for line in lines:
+            self.galil.command(line)
+
+        if verify:
+            plan['failed'] = self.diff() if lines else []
+            for item, curr in plan['failed']:
+                logger.warning("%s on %s line %s not applied: wanted %s, controller has %s",
+                               getattr(item, 'cmd', item.name), item.filename, item.lineno, item.value, curr)
+        return plan
 
     def check(self):
         changes = []
-        for item in self.lines:
-            if isinstance(item, Parameter):
-                if not item.check():
-                    changes.append("{} command on {} line {} changed from {} to {}".format(
-                        item.cmd,
-                        item.filename or 'Unknown', item.lineno or 'Unknown',
-                        item.value, item.get(refresh=False)
-                    ))
+        for item, curr in self.diff():
+            changes.append("{} command on {} line {} changed from {} to {}".format(
+                getattr(item, 'cmd', item.name),
+                item.filename or 'Unknown', item.lineno or 'Unknown',
+                item.value, curr
+            ))
         return changes
 
-    def load(self, filename):
-        with open(filename, 'r') as fh:
-            lines = []
-            for lineno, line in enumerate(fh, start=1):
-                line = line.rstrip()
-                for pat, cls in CONFIG_PARSERS:
-                    match = pat.match(line)
-                    if match:
-                        cls = GalilConfig.lookup_class(cls)
-                        if cls is None:
-                            lines.append(line.rstrip())
-                            break
-                        elif callable(cls):
-                            kwargs = match.groupdict()
-                            kwargs.setdefault("axes", self.axes)
-                            kwargs.setdefault("filename", filename)
-                            kwargs.setdefault("lineno", lineno)
-                            lines.append(cls(galil=self.galil, **kwargs))
-                            break
-                        else:
-                            raise Exception("Unexpected class {} matched in {} line {}: '{}'".format(cls, filename, lineno, line))
-                else:
-                    raise Exception("Unparsable setting in {} line {}: '{}'".format(filename, lineno, line))
-        self.lines = lines
+    def load(self, source, filename=None):
+        """
+        Load a configuration file.
+
+        @param source: file name or readable stream
+        @param filename: file name to report in errors and change
+            messages (defaults to the file name or stream name)
+        """
+        if hasattr(source, 'read'):
+            filename = filename or getattr(source, 'name', None)
+            self.lines = self.build(parse_lines(source, filename), filename)
+        else:
+            filename = filename or source
+            with open(source, 'r') as fh:
+                self.lines = self.build(parse_lines(fh, filename), filename)
+        return self
+
+    def loads(self, content, filename=None):
+        """Load configuration from a string"""
+        self.lines = self.build(parse_lines(content.splitlines(), filename), filename)
+        return self
+
+    @classmethod
+    def load_many(cls, galil, filenames, axes='ABCDEFGH', processes=None, columnar=False):
+        """
+        Parse many configuration files in parallel (using a process
+        pool). Returns a list of GalilConfig objects in the order of
+        filenames.
+        """
+        pool = Pool(processes)
+        try:
+            parsed = pool.map(parse_file, filenames)
+        finally:
+            pool.close()
+            pool.join()
+        configs = []
+        for filename, entries in zip(filenames, parsed):
+            conf = cls(galil, axes=axes, columnar=columnar)
+            conf.lines = conf.build(entries, filename)
+            configs.append(conf)
+        return configs
+
+    def build(self, entries, filename):
+        """Constructs lines and Parameter objects from parsed entries"""
+        if self.columnar:
+            lines = ColumnarLines(self.galil, self.axes)
+            for lineno, line, idx, kwargs in entries:
+                lines.append(lineno, line, idx, kwargs, filename)
+            return lines
+
+        targets = compiled_parsers()[1]
+        lines = []
+        for lineno, line, idx, kwargs in entries:
+            cls = targets[idx][0]
+            if cls is None:
+                lines.append(line)
+            elif callable(cls):
+                kwargs.setdefault("axes", self.axes)
+                kwargs.setdefault("filename", filename)
+                kwargs.setdefault("lineno", lineno)
+                lines.append(cls(galil=self.galil, **kwargs))
+            else:
+                raise Exception("Unexpected class {} matched in {} line {}: '{}'".format(cls, filename, lineno, line))
+        return lines
 
 
     def save(self, filename):
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming compressed data logger
+
+A L{DataLogger} samples a set of MG expressions (read together with
+L{Galil.get_list}) and/or data record sources (see
+C{Galil.sourceValue}) at a fixed rate. Samples are collected in NumPy
+chunks which a background thread writes as compressed columnar files:
+chunked C{.npz} archives by default, or Parquet (when C{pyarrow} is
+installed). Output files are rotated when they exceed a size limit.
+
+Sampling is scheduled against the start time rather than the previous
+sample, so the rate does not drift. Slots which can not be met (slow
+controller responses) are skipped and counted rather than sampled in a
+burst.
+
+Requires NumPy.
+"""
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function
+__all__ = 'DataLogger read_log'.split()
+
+import io
+import os
+import threading
+import time
+import zipfile
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from .errors import CommandError, TimeoutError
+from .galil import logger
+
+
+def rotated_path(path, index):
+    """
+    Output file name for rotation number C{index}. A "{n}" in the path is
+    replaced by the index, otherwise the index is inserted before the
+    extension (log.npz -> log.0003.npz).
+    """
+    if "{n" in path:
+        return path.format(n=index)
+    base, ext = os.path.splitext(path)
+    return "{}.{:04d}{}".format(base, index, ext)
+
+
+class NpzChunkWriter(object):
+    """
+    Writes chunks as separate (deflated) members "chunkNNNNNN.npy" of a
+    zip archive which C{numpy.load} can read. The column names are stored
+    in the "columns.npy" member.
+    """
+    ext = ".npz"
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.nr_chunks = 0
+        self.write_array("columns.npy", np.array(columns))
+
+    def write_array(self, name, arr):
+        buf = io.BytesIO()
+        np.lib.format.write_array(buf, arr, allow_pickle=False)
+        self.zip.writestr(name, buf.getvalue())
+
+    def write(self, chunk):
+        self.write_array("chunk{:06d}.npy".format(self.nr_chunks), chunk)
+        self.nr_chunks += 1
+
+    def size(self):
+        return self.zip.fp.tell()
+
+    def close(self):
+        self.zip.close()
+
+
+class ParquetChunkWriter(object):
+    """Writes chunks as row groups of a zstd compressed Parquet file"""
+    ext = ".parquet"
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = columns
+        self.fh = open(path, 'wb')
+        schema = pyarrow.schema([ (c, pyarrow.float64()) for c in columns ])
+        self.writer = pyarrow.parquet.ParquetWriter(self.fh, schema, compression='zstd')
+
+    def write(self, chunk):
+        arrays = [ pyarrow.array(chunk[:, i]) for i in range(len(self.columns)) ]
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays, names=self.columns))
+
+    def size(self):
+        return self.fh.tell()
+
+    def close(self):
+        self.writer.close()
+        self.fh.close()
+
+
+WRITERS = dict(npz=NpzChunkWriter, parquet=ParquetChunkWriter)
+
+
+class DataLogger(object):
+    """
+    @param galil: L{Galil} object
+
+    @param path: Output file name, rotated files are numbered (see
+        L{rotated_path}).
+
+    @param exprs: MG expressions to sample (e.g., "_TPA", "@AN[1]").
+
+    @param sources: Data record sources to sample (e.g., "_RPA", see
+        C{galil.sources()}). One record is read per sample.
+
+    @param rate: Samples per second.
+
+    @param method: Data record read method. "DR" streams records (the
+        record rate is set to match C{rate}), "QR" queries one record
+        per sample.
+
+    @param chunk_rows: Rows per chunk (default: one second of samples,
+        at least 64).
+
+    @param max_bytes: Rotate output files when they exceed this size.
+
+    @param format: "npz" or "parquet" (default: "parquet" if C{path}
+        ends with ".parquet", else "npz").
+    """
+    def __init__(self, galil, path, exprs=(), sources=(), rate=100.0, method="DR",
+                 chunk_rows=None, max_bytes=64 << 20, format=None):
+        if not (exprs or sources):
+            raise Exception("Nothing to log")
+        if format is None:
+            format = "parquet" if path.endswith(".parquet") else "npz"
+        if format not in WRITERS:
+            raise Exception("Unknown data log format '{}'".format(format))
+        if format == "parquet" and pyarrow is None:
+            raise Exception("Parquet output requires pyarrow")
+        if sources and getattr(galil, "sourceValue", None) is None:
+            raise Exception("Data record sources require a transport which decodes records (sourceValue), e.g. the vendor library")
+
+        self.galil   = galil
+        self.path    = path
+        self.exprs   = list(exprs)
+        self.sources = list(sources)
+        self.rate    = rate
+        self.method  = method
+        self.columns = [ "time" ] + self.exprs + self.sources
+        self.chunk_rows = chunk_rows or max(64, int(rate))
+        self.max_bytes  = max_bytes
+        self.writer_class = WRITERS[format]
+
+        self.files   = []
+        self.samples = 0
+        self.missed  = 0
+        self.errors  = 0
+        self.queue   = queue.Queue(maxsize=64)
+        self.stop_event = threading.Event()
+        self.thread  = None
+        self.writer_thread = None
+
+    def sample(self, out):
+        """
+        Reads one sample into C{out} (a row of the chunk, excluding the
+        time column). Returns False if the controller did not respond.
+        """
+        n = len(self.exprs)
+        try:
+            if n:
+                values = self.galil.get_list(self.exprs)
+                if values is None:
+                    return False
+                out[0:n] = values
+            if self.sources:
+                rec = self.galil.record(self.method)
+                sv = self.galil.sourceValue
+                for i, src in enumerate(self.sources):
+                    out[n+i] = sv(rec, src)
+        except (CommandError, TimeoutError) as err:
+            logger.debug("Data log sample failed: %s", err)
+            return False
+        return True
+
+    def run(self, duration=None):
+        """
+        Samples in the calling thread until L{stop} is called (or
+        C{duration} seconds have passed), then waits for all data to be
+        written.
+        """
+        self.start_writer()
+        if self.sources and self.method == "DR":
+            self.galil.recordsStart(1000.0 / self.rate)
+        try:
+            self._sample_loop(duration)
+        finally:
+            if self.sources and self.method == "DR":
+                self.galil.recordsStart(0)
+            self.queue.put(None)
+            self.writer_thread.join()
+
+    def _sample_loop(self, duration):
+        period = 1.0 / self.rate
+        width  = len(self.columns)
+        chunk  = np.empty((self.chunk_rows, width))
+        row    = 0
+        start  = time.time()
+        end    = None if duration is None else start + duration
+        slot   = 0
+        now    = start
+        while not self.stop_event.is_set() and (end is None or now < end):
+            delay = start + slot * period - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -period:
+                skip = int(-delay / period)
+                self.missed += skip
+                slot += skip
+            slot += 1
+
+            now = time.time()
+            if not self.sample(chunk[row, 1:]):
+                self.errors += 1
+                continue
+            chunk[row, 0] = now
+            row += 1
+            self.samples += 1
+            if row == self.chunk_rows:
+                self.queue.put(chunk)
+                chunk = np.empty((self.chunk_rows, width))
+                row = 0
+
+        if row:
+            self.queue.put(chunk[0:row])
+
+    def start_writer(self):
+        self.writer_thread = threading.Thread(target=self._write_loop, name="galil_apci-datalog-writer")
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
+    def _write_loop(self):
+        writer, failed = None, False
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            if failed:
+                continue                  # drain until the sampler stops
+            try:
+                if writer is None:
+                    path = rotated_path(self.path, len(self.files))
+                    writer = self.writer_class(path, self.columns)
+                    self.files.append(path)
+                writer.write(chunk)
+                if writer.size() >= self.max_bytes:
+                    writer.close()
+                    writer = None
+            except Exception as err:
+                logger.error("Data log writer failed: %s", err)
+                failed = True
+                self.stop_event.set()
+        if writer is not None:
+            writer.close()
+
+    def start(self, duration=None):
+        """Samples in a background thread (see L{run})"""
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, args=(duration,), name="galil_apci-datalog")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stops sampling and waits until all data is written"""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def stats(self):
+        return dict(samples=self.samples, missed=self.missed, errors=self.errors, files=list(self.files))
+
+
+def read_log(paths):
+    """
+    Reads data log files (a path or list of paths, in order) written by
+    L{DataLogger}. Returns (columns, array) with one row per sample.
+    """
+    if isinstance(paths, basestring):
+        paths = [ paths ]
+    columns, chunks = None, []
+    for path in paths:
+        if path.endswith(".parquet"):
+            table = pyarrow.parquet.read_table(path)
+            columns = table.column_names
+            chunks.append(np.column_stack([ table.column(c).to_numpy() for c in columns ]))
+        else:
+            with np.load(path, allow_pickle=False) as npz:
+                columns = [ str(c) for c in npz["columns"] ]
+                for name in sorted(k for k in npz.files if k.startswith("chunk")):
+                    chunks.append(npz[name])
+    if not chunks:
+        return columns, np.empty((0, len(columns or ())))
+    return columns, np.concatenate(chunks)
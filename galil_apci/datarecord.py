@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""
+UDP data record receiver
+
+A L{DataRecordReceiver} listens on a UDP socket on which the controller
+streams data records (DR): its own, or the record handle of a connected
+L{SocketTransport<galil_apci.transport.SocketTransport>}. Packets are received with C{recv_into} into
+preallocated slots, several per wakeup, and the sample number in each
+record header is used to count lost, duplicated and reordered records.
+Decoded samples are delivered in batches through a queue so that
+consumers (e.g., a logger) never block the receiver.
+
+Records are decoded with a field map of C{name: (offset, struct format)}
+(offsets from the start of the record, see the data record map of the
+controller manual). Without a field map, raw records are delivered.
+"""
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function
+__all__ = 'DataRecordReceiver RecordDecoder'.split()
+
+import collections
+import errno
+import socket
+import struct
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .errors import CommandError
+
+import logging
+logger = logging.getLogger('galil_apci')
+
+COUNTER_MODULUS = 1 << 16
+
+Sample = collections.namedtuple('Sample', 'sample time values')
+
+
+class RecordDecoder(object):
+    """
+    Decodes fields of a data record.
+
+    @param fields: dict (or list of pairs) of C{name: (offset, format)},
+        format being a single C{struct} item ("h", "l", "B", ...).
+        Records are little-endian.
+    """
+    def __init__(self, fields):
+        items = list(fields.items()) if hasattr(fields, 'items') else list(fields)
+        self.names = tuple( name for name, _ in items )
+        self.structs = tuple( (offset, struct.Struct('<' + fmt)) for _, (offset, fmt) in items )
+
+    def __call__(self, record):
+        return dict(zip(self.names, ( s.unpack_from(record, offset)[0] for offset, s in self.structs )))
+
+
+class DataRecordReceiver(object):
+    """
+    @param bind: Local (host, port) of the UDP socket (default: any
+        interface, ephemeral port).
+
+    @param fields: Field map (see L{RecordDecoder}) or a decoding
+        callable taking the record (bytes). None delivers raw records.
+
+    @param counter_offset: Offset of the 16 bit sample number in the
+        record header (4 on DMC-40x0/30000/21x3/RIO).
+
+    @param batch: Maximum records read per wakeup (and per queue item).
+
+    @param maxsize: Maximum batches queued. Batches which do not fit
+        are dropped (and counted) rather than stalling the receiver.
+
+    @param slot_size: Receive buffer size of each record slot.
+
+    @param max_errors: Socket errors in a row after which the receiver
+        stops. Between errors it backs off, doubling the wait from
+        C{backoff} seconds up to C{timeout_ms}.
+    """
+    def __init__(self, bind=("", 0), fields=None, counter_offset=4, batch=64,
+                 maxsize=256, slot_size=2048, timeout_ms=500, max_errors=10, backoff=0.01):
+        if fields is None or callable(fields):
+            self.decode = fields
+        else:
+            self.decode = RecordDecoder(fields)
+        self.counter = struct.Struct('<H')
+        self.counter_offset = counter_offset
+        self.batch = batch
+        self.timeout_ms = timeout_ms
+        self.max_errors = max_errors
+        self.backoff = backoff
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(bind)
+        self.address = self.sock.getsockname()
+        self.own_sock = True
+
+        self.buf = bytearray(batch * slot_size)
+        self.view = memoryview(self.buf)
+        self.slots = [ self.view[i*slot_size:(i+1)*slot_size] for i in range(batch) ]
+
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.galil = None
+        self.step = None
+        self.last = None
+        self.missing = set()                # recent lost sample numbers
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.counters = collections.Counter(
+            packets=0, samples=0, lost=0, duplicates=0, reordered=0, dropped=0, short=0, bytes=0, errors=0,
+        )
+
+    def connect(self, galil):
+        """
+        Receives on the record handle of C{galil}'s transport (see
+        L{SocketTransport.records_handle
+        <galil_apci.transport.SocketTransport.records_handle>}) in place
+        of the receiver's own socket and returns the controller handle
+        letter of the connection. The transport keeps ownership of the
+        handle.
+        """
+        if not hasattr(galil, 'records_handle'):
+            raise CommandError("Data records require the socket transport ({})".format(galil.address))
+        sock = galil.records_handle()
+        if sock is not self.sock:
+            if self.own_sock:
+                self.sock.close()
+            self.sock = sock
+            self.address = sock.getsockname()
+            self.own_sock = False
+        return galil.dr_handle
+
+    def start(self, galil=None, period=1):
+        """
+        Starts the receiver thread. If C{galil} is given, the controller
+        is asked to stream a record every C{period} samples to this
+        socket (and to stop in L{stop}). Otherwise records are expected
+        to be directed here by other means.
+        """
+        self.step = period
+        if galil is not None:
+            self.connect(galil)
+            self.galil = galil
+            galil.recordsStart(samples=period)
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name="galil_apci-datarecord")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.galil is not None:
+            try:
+                self.galil.recordsStart(0)
+            except Exception as err:
+                logger.warning("Unable to stop data records: %s", err)
+            self.galil = None
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        self.stop()
+        if self.own_sock:
+            self.sock.close()
+
+    def run(self):
+        sock, slots = self.sock, self.slots
+        failures = 0
+        while not self.stop_event.is_set():
+            # block for the first packet, then take what is already waiting
+            sock.settimeout(self.timeout_ms / 1000.0)
+            sizes = []
+            try:
+                sizes.append(sock.recv_into(slots[0]))
+                sock.settimeout(0)
+                while len(sizes) < self.batch:
+                    sizes.append(sock.recv_into(slots[len(sizes)]))
+            except socket.timeout:
+                pass
+            except socket.error as err:
+                if sizes or err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    pass                    # nothing more waiting
+                else:
+                    # e.g., ECONNREFUSED: back off rather than spin
+                    failures += 1
+                    self.counters['errors'] += 1
+                    if failures >= self.max_errors:
+                        logger.error("Data record receiver stopped after %d errors: %s", failures, err)
+                        return
+                    self.stop_event.wait(min(self.backoff * 2 ** (failures - 1), self.timeout_ms / 1000.0))
+                    continue
+            if sizes:
+                failures = 0
+                self.process(sizes)
+
+    def process(self, sizes):
+        """Account for and decode received slots, queue the batch"""
+        now = time.time()
+        samples = []
+        c = self.counters
+        c['packets'] += len(sizes)
+        for slot, n in zip(self.slots, sizes):
+            c['bytes'] += n
+            if n < self.counter_offset + 2:
+                c['short'] += 1
+                continue
+            sample = self.counter.unpack_from(slot, self.counter_offset)[0]
+            if not self.accept(sample):
+                continue
+            record = slot[0:n].tobytes()
+            samples.append(Sample(sample, now, self.decode(record) if self.decode else record))
+        if samples:
+            c['samples'] += len(samples)
+            try:
+                self.queue.put_nowait(samples)
+            except queue.Full:
+                c['dropped'] += len(samples)
+
+    def accept(self, sample, window=256):
+        """
+        Sequence accounting of a sample number. Returns False for
+        duplicated and late (reordered) records, which are not
+        delivered. The samples missing from the last C{window} periods
+        are remembered, so that a record counted as lost and arriving
+        late is counted as reordered instead. Other late records
+        (already received, or older than the window) count as
+        duplicates.
+        """
+        c = self.counters
+        if self.last is None:
+            self.last = sample
+            return True
+        diff = (sample - self.last) % COUNTER_MODULUS
+        if diff == 0:
+            c['duplicates'] += 1
+            return False
+        if diff >= COUNTER_MODULUS // 2:
+            if sample in self.missing:
+                self.missing.discard(sample)
+                c['lost'] -= 1
+                c['reordered'] += 1
+            else:
+                c['duplicates'] += 1
+            return False
+        step = self.step or 1
+        if diff > step:
+            c['lost'] += diff // step - 1
+            self.missing.update( (self.last + i * step) % COUNTER_MODULUS
+                                 for i in range(max(1, diff // step - window), diff // step) )
+            if len(self.missing) > window:
+                self.missing = set( m for m in self.missing if (sample - m) % COUNTER_MODULUS <= window * step )
+        self.last = sample
+        return True
+
+    def samples(self, timeout=None):
+        """
+        Iterates over received samples until the receiver stops (or no
+        samples arrive for C{timeout} seconds).
+        """
+        while True:
+            try:
+                batch = self.queue.get(timeout=timeout if timeout is not None else self.timeout_ms / 1000.0)
+            except queue.Empty:
+                if timeout is not None or self.thread is None or not self.thread.is_alive():
+                    return
+                continue
+            for sample in batch:
+                yield sample
+
+    def stats(self):
+        return dict(self.counters)
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+Controller exceptions
+
+When the vendor SWIG binding (C{Galil}) is installed, its exception
+classes are used so that errors raised by the library and by the
+pure-Python transports (see L{galil_apci.transport}) can be caught the
+same way. Otherwise equivalent classes are defined here.
+"""
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function
+__all__ = 'CommandError TimeoutError ProgramLimitError'.split()
+
+try:
+    import Galil as ExternalGalil
+except ImportError:
+    ExternalGalil = None
+
+if ExternalGalil is not None:
+    CommandError = ExternalGalil.CommandError
+    TimeoutError = ExternalGalil.TimeoutError
+else:
+    class CommandError(Exception):
+        """Controller rejected a command ("?" response)"""
+
+    class TimeoutError(Exception):          # noqa: A001
+        """No (complete) response from the controller in time"""
+
+
+class ProgramLimitError(ValueError):
+    """Program does not fit the program memory of the controller model"""
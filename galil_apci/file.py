@@ -24,14 +24,22 @@ Preforms useful actions on galil encoder files.
 
 from __future__ import division, absolute_import, print_function
 
+import collections
+import copy
+import hashlib
+import json
+import os
 import re
+import threading
 import logging
 logger = logging.getLogger(__name__)
 
+from multiprocessing import Pool
+
 import galil_apci
 import jinja2
 
-import collections
+from galil_apci import text
 
 from jinja2_apci import RequireExtension, RaiseExtension
 
@@ -104,6 +112,53 @@ def acos(h):
     return 180 * math.acos(h) / math.pi
 
 
+def finalize(value):
+    if value is None:
+        print("Use of undefined value in template!")
+        return "None"
+    else:
+        return value
+
+
+# Shared template environments, see GalilFile.get_environment()
+_environments = {}
+_environments_lock = threading.Lock()
+
+
+def merge_context(base, override):
+    """
+    Returns a copy of C{base} with C{override} merged in. Nested
+    dictionaries are merged recursively, other values are replaced.
+    """
+    merged = copy.deepcopy(base)
+    for key, val in override.items():
+        if isinstance(val, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_context(merged[key], val)
+        else:
+            merged[key] = copy.deepcopy(val)
+    return merged
+
+
+# Per-process state of variant build workers (see GalilFile.build_variants)
+_variant_worker = {}
+
+def _variant_setup(gf, name, base):
+    _variant_worker.update(gf=gf, template=gf.get_template(name), base=base)
+
+def _variant_init(settings, name, base):
+    # Rebuilt from settings (not pickled) so that workers need not be
+    # forked; the environment comes from the shared registry.
+    _variant_setup(GalilFile(shared=True, **settings), name, base)
+
+def _variant_build(item):
+    key, override, opts = item
+    gf = _variant_worker['gf']
+    content = gf.postprocess(_variant_worker['template'].render(merge_context(_variant_worker['base'], override)))
+    program = gf.minify(content, opts['prune'], opts['keep'], opts['shorten']) if opts['minify'] else gf.trim(content)
+    return (key, program, galil_apci.Galil.computeProgramHash(program), hashlib.sha1(program).hexdigest(),
+            gf.lint(program, warnings=opts['warnings']), gf.symbols if opts['shorten'] else None)
+
+
 class GalilFile(object):
 
     @classmethod
@@ -129,43 +184,103 @@ class GalilFile(object):
         g["acos"] = acos
 
 
-    def __init__(self, path=None, package=None, line_length=79):
+    @classmethod
+    def get_environment(cls, path=None, package=None, cache_dir=None):
         """
-        @param path: If a path (array of directories) is provided, it will
-            be prepended to the template search path. The default path is
-            the "gal" folder in the apci module directory.
-
-        @param line_length: Galil maximum line length. 79 for most boards,
-            but some are capped at 39.
+        Returns the jinja environment for a template search path. The
+        environment is created on first use and shared by all L{GalilFile}
+        objects using the same search path, so templates are compiled at
+        most once per process.
+
+        @param cache_dir: If given, compiled templates are also cached in
+            this directory (jinja2.FileSystemBytecodeCache) and reused
+            across processes until the template source changes.
         """
-        self.line_length = line_length
+        if isinstance(path, basestring):
+            path = [ path ]
+        path = tuple( os.path.abspath(p) for p in path ) if path else ()
+        key = (path, package, cache_dir)
+
+        with _environments_lock:
+            env = _environments.get(key)
+            if env is None:
+                env = _environments[key] = cls.create_environment(path, package, cache_dir)
+        return env
 
+    @classmethod
+    def create_environment(cls, path=None, package=None, cache_dir=None):
+        """Creates a new (unshared) jinja environment"""
         loaders = []
         if path:
             loaders.append(jinja2.FileSystemLoader(path, encoding='utf-8'))
         if package:
             loaders.append(jinja2.PackageLoader(package, 'gal', encoding='utf-8'))
 
-        def finalize(value):
-            if value is None:
-                print("Use of undefined value in template!")
-                return "None"
-            else:
-                return value
+        bytecode_cache = None
+        if cache_dir:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(cache_dir)
 
-        self.env = jinja2.Environment(
+        env = jinja2.Environment(
             extensions=[RequireExtension, RaiseExtension],
             loader=jinja2.ChoiceLoader(loaders),
             undefined=jinja2.StrictUndefined,
             finalize=finalize,
+            bytecode_cache=bytecode_cache,
         )
 
-        GalilFile.add_globals(self.env.globals)
+        GalilFile.add_globals(env.globals)
+        return env
+
+
+    def __init__(self, path=None, package=None, line_length=79, cache_dir=None, shared=False):
+        """
+        @param path: If a path (array of directories) is provided, it will
+            be prepended to the template search path. The default path is
+            the "gal" folder in the apci module directory.
+
+        @param line_length: Galil maximum line length. 79 for most boards,
+            but some are capped at 39.
 
+        @param cache_dir: Directory for compiled template cache (see
+            L{get_environment}).
 
-    def load(self, name, context):
+        @param shared: Use the jinja environment shared by all objects
+            with the same search path (see L{get_environment}), so that
+            templates are compiled once per process. Globals and filters
+            added to a shared environment are seen by all of them. By
+            default, each object has a private environment.
+        """
+        self.line_length = line_length
+        self.prune_report = None
+        self.symbols = None
+        # for rebuilding in worker processes, see build_variants()
+        self.settings = dict(path=path, package=package, line_length=line_length, cache_dir=cache_dir)
+
+        if shared:
+            self.env = GalilFile.get_environment(path, package, cache_dir)
+        else:
+            self.env = GalilFile.create_environment(path, package, cache_dir)
+
+    def precompile(self, extensions=("gal",)):
+        """
+        Compiles all templates on the search path with one of the given
+        extensions, warming the bytecode cache. Returns a list of
+        (template name, error) pairs for templates which fail to compile.
+        """
+        errors = []
+        for name in self.env.list_templates(extensions=extensions):
+            try:
+                self.env.get_template(name)
+            except jinja2.TemplateError as err:
+                errors.append((name, err))
+        return errors
+
+
+    def load(self, name, context, prune=False, keep=(), shorten=False):
         """Renders and minifies a template"""
-        return self.minify( self.render(name, context) )
+        return self.minify( self.render(name, context), prune, keep, shorten )
 
     def lint(self, content, warnings=False):
         """
@@ -187,222 +302,65 @@ class GalilFile(object):
             - uninitialized variables (variables not initialized in any #xxINIT)
 
         """
-        content = self.minify(content)
-        errors = []
+        return text.lint(content, self.line_length, warnings)
 
-        # WARNING: Any trailing semicolon/EOL checks need to be zero-width assertions
-        p_sub_def   = re.compile(r"(?:^|;)(#[a-zA-Z0-9_]{1,7})")
-        p_sub_arg   = re.compile(r"""
-                         (?:^|;)
-                         (?:J[SP]|XQ) (\#[a-zA-Z0-9_]{1,7})      # jump name
-                         ((?:\(.*?\))?)                          # optional arguments
-                         (?= ; | $                               # endl
-                           | , \(                                # complex condition
-                           | , (?:\d+|\^[a-h]|\w{1,8}) (?:;|$)   # thread number
-                         )
-                      """, re.X)
-        p_bad_ops   = re.compile(r"(?:==|!=)")
-        p_JS        = re.compile(r"_JS")
-
-        p_if_js     = re.compile(r"(?:^|;)IF\([^;\n]+\)[;\n](J[SP]#[a-zA-Z]+)[^;\n]*[;\n]ENDIF", re.M)
-
-        # Dangerous to have any calculation in an argument. Only want variables.
-        # warning: won't catch @ABS[foo]
-        p_danger_arg = re.compile(r"(?:.(?:\(|\)).|[^a-zA-Z0-9.,@\[\]_\(\)\^\&\"\-]|(?<![\(,])\-)")
-        pc_MG       = re.compile(r"^MG")
-        subs        = set()
-        sub_line    = {}
-        sub_arity   = {}
-        sub_neg1_dflt = set(("#ok", "#error"))
-        AUTO_subs   = set(["#AUTO", "#MCTIME", "#AMPERR", "#AUTOERR", "#POSERR", "#CMDERR"])
-        JSP_sub     = set()
-        JSP_line    = collections.defaultdict(list)
-
-        if warnings:
-            for jump in p_if_js.findall(content):
-                errors.append( "IF(...);{} better written as {},(...)".format(jump, jump) )
-
-        lineno = 0
-        for line in content.split("\n"):
-            lineno += 1
-
-            # presence of None
-            if "None" in line:
-                errors.append( "line {}, Contains 'None', check template vars: {}".format(lineno, line) )
-
-            # long lines
-            if len(line) > self.line_length:
-                errors.append( "line {}, Line too long: {}".format(lineno, line) )
-
-            # Bad operators
-            if p_bad_ops.search(line):
-                errors.append( "line {}, bad operator: {}".format(lineno, line) )
-
-            # for duplicate labels
-            for name in p_sub_def.findall(line):
-                if name in subs:
-                    errors.append( "line {}, Duplicate label: {}".format(lineno, name) )
-                else:
-                    subs.add(name)
-                    sub_line[name] = lineno
-
-            # examine subroutine arguments (JS, JP)
-            # also for unused labels and jumps to non-existant labels
-            for name, arg in p_sub_arg.findall(line):
-                # Note: arg includes "()"
-                JSP_sub.add(name)
-                JSP_line[name].append(lineno)
-                args = [] if len(arg) < 3 else arg.split(',')
-
-                if name in sub_neg1_dflt and arg == "(-1)":
-                    # Make exception for #ok and #error
-                    pass
-                elif name in sub_arity:
-                    if len(args) != sub_arity[name]:
-                        errors.append( "line {}, inconsistent sub arity for {}. Was {} now {}".format(lineno, name, sub_arity[name], len(args)) )
-                else:
-                    sub_arity[name] = len(args)
-
-                if p_JS.search(arg):
-                    errors.append( "line {}, _JS used in subroutine argument: {}".format(lineno, line) )
-                if p_danger_arg.search(arg):
-                    errors.append( "line {}, Dangerous value (calculation) used in argument: {}".format(lineno, line) )
-
-            for cmd in line.split(";"):
-                # long strings
-                if not pc_MG.search(cmd):
-                    strings = cmd.split('"')
-                    for idx in (x for x in xrange(1, len(strings), 2) if len(strings[x]) > 5):
-                        errors.append( "line {}, Long string '{}' in command: {}".format(lineno, strings[idx], cmd) )
-
-        # jumps to non-existant labels
-        for sub in JSP_sub - subs:
-            errors.append( "line(s) {}, J[SP]{} found but label {} not defined".format(JSP_line[sub], sub, sub) )
-
-        if warnings:
-            # unused labels
-            for sub in subs - JSP_sub - AUTO_subs:
-                errors.append( "line {}, Label {} defined but never used".format(sub_line[sub], sub) )
-
-        return errors
+    def analyze(self, content, model=None):
+        """
+        Static resource analysis of galil code as it will be downloaded
+        (e.g., the result of L{load}): line, label, variable, array and
+        thread usage (see L{text.analyze_lines}). If a model
+        (e.g., "DMC4080" or a controller connection string) is given,
+        the analysis includes an "errors" list of exceeded limits (see
+        L{text.MODEL_LIMITS}).
+        """
+        analysis = text.analyze(content)
+        if model is not None:
+            analysis['errors'] = text.check_limits(analysis, model)
+        return analysis
 
-    def minify(self, content):
+    def minify(self, content, prune=False, keep=(), shorten=False):
         """
         Performs minification on a galil file. Actions performed:
 
            - Strips all comments
            - trims space after semicolon and before/after various ops (" = ", "IF (...)")
            - Merges "simple" lines (up to line_length)
-        """
-        lines = []
-
-        double_semi = re.compile(r';(\s*)(?=;)')
-        line_end_semi = re.compile(r';$')
-
-        # Comments: ', NO, REM. Do NOT need to check for word boundaries ("NOTE" is a comment)
-        #
-        # WARNING: This is INCORRECT! In galil a semicolon ends a comment
-        # - this is crazy so I explicitly choose to have a comment kill
-        # the rest of the line
-        comment = re.compile(r"(?:^|;)\s*(?:'|NO|REM).*")
-
-        # Operators with wrapped space. Match will be replaced with \1.
-        operator_spaces = re.compile(r"\s*([,;=\+\-*/%<>\(\)\[\]&|]|<>|>=|<=)\s*")
-
-        # A line containing just a label
-        label_line = re.compile(r"^#[a-zA-Z0-9]{1,7}$")
-
-        # A line that starts with a label
-        label_start = re.compile(r"^#")
-
-        # Joinable Lines (combinations of the following):
-        #    - Simple Assignments: assignments to our variables or arrays (start with lower)
-        #    - ENDIF, ELSE
-        # NOTE: a joinable line never ends in a semicolon - this provides a way to force a line break
-        joinable_line = re.compile(r"""
-            ^(?: (?:^|;) \s*
-                 (?:
-                     (?:[~^][a-z]|[a-z][a-zA-Z0-9]{0,7}(?:\[[^\];]+\])?)
-                         \s* = \s* [^\;]+
-                   | ENDIF
-                   | ELSE
-                 )
-            \s*)+$
-        """, re.X)
-
-        _lines1 = []
-        # Start with simple compaction (removes extra garbage and makes
-        # later length calculations more reliable
-        for line in content.split("\n"):
-            line = re.sub(comment, '', line)
-            line = re.sub(operator_spaces, '\\1', line)
-            line = line.strip()
-            if len(line):
-                _lines1.append(line)
-
-        # The more advanced stuff: line merging, etc
-        i = 0
-        _lines2 = []
-        while i < len(_lines1):
-            line = _lines1[i]
-
-            while ( i < len(_lines1) - 1
-                    and joinable_line.match(_lines1[i+1])
-                    and self.line_length > len(line + ";" + _lines1[i+1])
-                    ):
-                line = line + ";" + _lines1[i+1]
-                i += 1
-
-            if len(line):
-                _lines2.append(line)
-            i += 1
-
-        # Squash label into next line (assuming it isn't itself a label)
-        i = 0
-        while i < len(_lines2):
-            line = _lines2[i]
-
-            if ( i < len(_lines2) - 1
-                 and label_line.match(line)
-                 and not label_start.match(_lines2[i+1])
-                 and self.line_length > len(line + ";" + _lines2[i+1])
-               ):
-                line = line + ";" + _lines2[i+1]
-                i += 1
-
-                if ( i < len(_lines2) - 1
-                     and _lines2[i+1] == 'EN'
-                     and self.line_length > len(line + ";" + _lines2[i+1])
-                     ):
-                    line = line + ";" + _lines2[i+1]
-                    i += 1
-
-            # double semicolons confuse galil but are somewhat easy to
-            # introduce when templating and doing strange minification.
-            # Strip them out again just to be sure:
-            line = line_end_semi.sub('',(double_semi.sub(r'\1',line)))
-
-            if len(line):
-                lines.append(line)
-            i += 1
-
-        for i, line in enumerate(lines):
-            if (len(line) > self.line_length):
-                logger.error("Long line '%s' in minified galil output", line)
-
-        return "\n".join(lines)
 
+        @param prune: If true, also remove subroutines which can never be
+            reached (see L{text.prune_lines}). What was removed is stored
+            in C{self.prune_report}.
+
+        @param keep: Additional labels and variable names to keep when
+            pruning or shortening (e.g., labels executed or variables
+            accessed from python).
+
+        @param shorten: If true, also rename variables and labels to the
+            shortest available names (see L{text.shorten_lines}). The
+            symbol map is stored in C{self.symbols}, see
+            L{save_symbols} and L{Galil.load_symbols}.
+        """
+        report  = dict(labels=[], lines=0, bytes=0)
+        symbols = dict(variables={}, labels={})
+        content = text.minify(content, self.line_length, prune, keep, report, shorten, symbols)
+        if shorten:
+            self.symbols = symbols
+        if prune:
+            self.prune_report = report
+            logger.info("Pruned %d unreachable labels (%d lines, %d bytes)", len(report['labels']), report['lines'], report['bytes'])
+        return content
+
+
+    def save_symbols(self, fname):
+        """Writes the symbol map of the last shortened program (JSON)"""
+        with open(fname, 'w') as fh:
+            json.dump(self.symbols, fh, indent=2, sort_keys=True)
+            fh.write("\n")
 
     def trim(self, content):
         """
         Performs whitespace trimming on a galil file.
         """
-        lines = []
-        for line in content.split("\n"):
-            line = line.strip()
-            if len(line):
-                lines.append(line)
-        return "\n".join(lines)
+        return text.trim(content)
 
 
     def render(self, name, context):
@@ -411,11 +369,174 @@ class GalilFile(object):
         inclusions), but does not perform whitespace trimming or
         minification.
         """
-        content = self.env.get_template(name).render(context)
+        return self.postprocess(self.env.get_template(name).render(context))
+
+    def postprocess(self, content):
+        """Cleans up rendered template output (see L{render})"""
         # double semicolons confuse galil but are somewhat easy to
         # introduce when templating. Strip them out here:
         return re.sub(r';(\s*)(?=;)', r'\1', content).encode('utf-8')
 
+    def render_lines(self, name, context):
+        """
+        Like L{render}, but returns an iterator over the (unicode) lines
+        of the rendered template, generated incrementally (Jinja
+        C{generate()}) so that the whole text is never held in memory.
+        """
+        return text.strip_double_semis(text.split_lines(self.get_template(name).generate(context)))
+
+    def stream(self, name, context, minify=True, trim=True, prune=False, keep=(), shorten=False):
+        """
+        Renders and minifies (or only trims, if C{minify} is false, or
+        neither) a template, returning an iterator over output lines.
+        Memory use is bounded by a few lines unless C{prune} or
+        C{shorten} is requested, as these passes need the whole program
+        (see L{text.minify_lines}). The prune report and symbol map (see
+        L{minify}) are complete once the iterator is exhausted.
+        """
+        lines = self.render_lines(name, context)
+        if minify:
+            report  = dict(labels=[], lines=0, bytes=0)
+            symbols = dict(variables={}, labels={})
+            if shorten:
+                self.symbols = symbols
+            if prune:
+                self.prune_report = report
+            return text.minify_lines(lines, self.line_length, prune, keep, report, shorten, symbols)
+        if trim:
+            return text.trim_lines(lines)
+        return lines
+
+    def stream_to(self, name, context, out, xapi=None, date=None, warnings=False, **kwargs):
+        """
+        Streams a template (see L{stream}, which receives the remaining
+        keyword arguments) straight to C{out}: a file name, a file
+        object or a L{Galil} object (see L{Galil.programDownloadWriter}).
+        Lines are linted on the way (see L{lint}).
+
+        @param xapi: xAPI program name. The program hash is needed
+            before the xAPI functions can be written (see
+            L{Galil.add_xAPI}), so the template is then rendered twice.
+
+        @attention: If the template fails to render part way, a file
+            C{out} is left unchanged (lines are written to a temporary
+            file, renamed on success) and nothing is downloaded to a
+            controller. Over a transport which streams downloads
+            (L{SocketTransport}) the lines sent so far are replaced by an
+            empty program (unless C{xapi} is given: the first rendering
+            fails before anything is sent).
+
+        Returns dict(lines, bytes, hash, lint): lines and bytes written,
+        the program hash (before adding xAPI functions) and lint errors.
+        """
+        Galil = galil_apci.Galil
+        phash = None
+        if xapi:
+            md5 = hashlib.md5()
+            for i, line in enumerate(self.stream(name, context, **kwargs)):
+                md5.update(line.encode('utf-8') if not i else b"\n" + line.encode('utf-8'))
+            phash = Galil.string_to_galil_hex(md5.hexdigest()[0:6])
+
+        # xAPI function lines (see Galil.add_xAPI_lines)
+        replace = dict()
+        if xapi:
+            for line in ("#xINIT;EN", "#xAPIOk;EN"):
+                replace[line] = list(Galil.add_xAPI_lines([ line ], xapi, phash, date, self.line_length))
+
+        if hasattr(out, "programDownloadWriter"):
+            sink = out.programDownloadWriter()
+            write, close, abort = sink.write, sink.close, sink.abort
+        else:
+            if isinstance(out, basestring):
+                tmp = "{}.{}.tmp".format(out, os.getpid())
+                fh = open(tmp, 'wb')
+
+                def close():
+                    fh.close()
+                    os.rename(tmp, out)
+
+                def abort():
+                    fh.close()
+                    os.unlink(tmp)
+            else:
+                fh = getattr(out, 'buffer', out)
+                close = abort = lambda: None
+            write = lambda line: fh.write(line.encode('utf-8') + b"\n")
+
+        stats = dict(lines=0, bytes=0, hash=phash)
+        md5 = hashlib.md5()
+
+        def tap(lines):
+            for i, line in enumerate(lines):
+                md5.update(line.encode('utf-8') if not i else b"\n" + line.encode('utf-8'))
+                for out_line in replace.get(line, (line,)):
+                    write(out_line)
+                    stats['lines'] += 1
+                    stats['bytes'] += len(out_line) + 1
+                yield line
+
+        try:
+            stats['lint'] = text.lint_lines(tap(self.stream(name, context, **kwargs)), self.line_length, warnings)
+        except Exception:
+            abort()
+            raise
+        close()
+        if phash is None:
+            stats['hash'] = Galil.string_to_galil_hex(md5.hexdigest()[0:6])
+        return stats
+
+    def build_variants(self, name, base, overrides, processes=None, minify=True,
+                       prune=False, keep=(), shorten=False, warnings=False):
+        """
+        Builds a template for many variants of a machine definition in
+        parallel. Each variant context is C{base} with that variant's
+        overrides merged in (see L{merge_context}); it is rendered,
+        minified (or trimmed), linted and hashed in a worker process.
+        Workers load the template through the shared environment of this
+        object's search path (see L{get_environment}), so they do not see
+        globals or filters added to a private environment. The template
+        is compiled there before the workers are started, so forked
+        workers inherit it; otherwise give a C{cache_dir} so that workers
+        load the compiled template from the cache.
+
+        @param overrides: dict of variant name: overrides (built in name
+            order unless an OrderedDict), or a list of overrides (variants
+            are then named by index).
+
+        @param processes: Number of worker processes (default: CPU count).
+            With C{processes=1} everything is built in this process.
+
+        Returns (variants, programs): C{variants} is an ordered dict of
+        variant name: dict(hash, digest, lint, symbols) and C{programs}
+        maps each distinct program digest (SHA-1, unlike the short
+        program hash it does not collide) to the program text, so that
+        variants producing identical programs are stored once.
+        """
+        if not isinstance(overrides, dict):
+            overrides = collections.OrderedDict( (i, o) for i, o in enumerate(overrides) )
+        opts  = dict(minify=minify, prune=prune, keep=tuple(keep), shorten=shorten, warnings=warnings)
+        keys  = list(overrides) if isinstance(overrides, collections.OrderedDict) else sorted(overrides)
+        items = [ (key, overrides[key], opts) for key in keys ]
+
+        if processes == 1 or len(items) < 2:
+            _variant_setup(self, name, base)
+            results = [ _variant_build(item) for item in items ]
+        else:
+            GalilFile(shared=True, **self.settings).get_template(name)
+            pool = Pool(processes, initializer=_variant_init, initargs=(self.settings, name, base))
+            try:
+                results = pool.map(_variant_build, items, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+
+        variants, programs = collections.OrderedDict(), dict()
+        for key, program, phash, digest, lint, symbols in results:
+            programs.setdefault(digest, program)
+            variants[key] = dict(hash=phash, digest=digest, lint=lint, symbols=symbols)
+        logger.info("Built %d variants of %s, %d distinct programs", len(variants), name, len(programs))
+        return variants, programs
+
     def get_template(self, name):
         """
         Gets the jinja template object for a template file.
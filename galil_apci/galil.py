@@ -21,12 +21,13 @@ the APCI toolchain.
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 from __future__ import division, absolute_import, print_function
-__all__ = 'Galil'.split()
+__all__ = 'Galil WriteBatch'.split()
 
 
 import collections
 import gzip as _gzip
 import hashlib
+import json
 import os
 import re
 import time
@@ -34,12 +35,19 @@ import time
 from datetime import datetime
 from binascii import b2a_hex
 from contextlib import closing
-import Galil as ExternalGalil
+
+from .errors import CommandError, ProgramLimitError
+from .retry import RetryPolicy
+from .transport import open_transport
+from . import text
 
 import logging
 logger = logging.getLogger('galil_apci')
 GALIL_TRACE = int(os.environ.get('GALIL_APCI_TRACE', 0))
 
+# A Galil4,2 hex value as printed by MG{$8.4}
+p_ghex = re.compile(r'\$[0-9A-Fa-f]{8}\.[0-9A-Fa-f]{4}')
+
 
 def hex2str(match):
     return chr(int(match.group(0), 16))
@@ -53,10 +61,151 @@ def flatten(l):
         else:
             yield el
 
+def pack(items, prefix="", sep=";", width=78):
+    """
+    Packs items (already formatted strings) into lines of at most
+    C{width} characters. Each line begins with C{prefix} and items are
+    separated by C{sep}. Returns a list of lists of items, one list per
+    line (an item which is too long by itself gets a line of its own).
+    """
+    lines = []
+    length = 0
+    for item in items:
+        if lines and length + len(sep) + len(item) <= width:
+            lines[-1].append(item)
+            length += len(sep) + len(item)
+        else:
+            lines.append([item])
+            length = len(prefix) + len(item)
+    return lines
+
+
+class WriteBatch(object):
+    """
+    Collects output bit and variable writes (see L{Galil.batch}) and
+    sends them together, packed into as few command lines as possible.
+
+    Redundant writes are collapsed: the last value written to a variable
+    or output bit wins (SB2 then CB2 sends only CB2, so a bit pulsed
+    within a batch ends in its final state whatever its prior state).
+
+    Writes are not sent in call order: output bits are sent first, then
+    variables, each in the order of their first write.
+    """
+    def __init__(self, galil, autoflush=True):
+        self.galil = galil
+        self.autoflush = autoflush
+        self.depth = 0
+        self.bits = collections.OrderedDict()
+        self.variables = collections.OrderedDict()
+        self.sent = []
+        self.stats = collections.Counter(writes=0, collapsed=0, lines=0)
+
+    def __enter__(self):
+        if self.depth == 0:
+            if self.galil.write_batch not in (None, self):
+                raise Exception("Another write batch is already active")
+            self.galil.write_batch = self
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.depth -= 1
+        if self.depth:
+            return False
+        self.galil.write_batch = None
+        if exc_type is None and self.autoflush:
+            self.flush()
+        elif self:
+            logger.warning("Discarding %d unsent batched writes", len(self))
+            self.clear()
+        return False
+
+    def __len__(self):
+        return len(self.bits) + len(self.variables)
+
+    def bit(self, port, value):
+        port = int(port)
+        self.stats['writes'] += 1
+        if port in self.bits:
+            self.stats['collapsed'] += 1
+        self.bits[port] = bool(value)
+
+    def assign(self, name, value):
+        """Assignment of C{value} (Galil code, e.g., a number or expression)"""
+        self.stats['writes'] += 1
+        if name in self.variables:
+            self.stats['collapsed'] += 1
+        self.variables[name] = value
 
-class Galil(ExternalGalil.Galil):
-    def __init__(self, address=""):
-        super(Galil,self).__init__(str(address))
+    def set(self, **kwargs):
+        """Variable assignments as in L{Galil.set} (strings are quoted)"""
+        for name, val in kwargs.items():
+            self.assign(name, '"{}"'.format(val) if isinstance(val, basestring) else val)
+
+    def commands(self):
+        """The commands a flush would send (unpacked)"""
+        code = [ "{}{}".format("SB" if value else "CB", port) for port, value in self.bits.items() ]
+        code.extend( "{}={}".format(self.galil.translate(name), val) for name, val in self.variables.items() )
+        return code
+
+    def clear(self):
+        self.bits.clear()
+        self.variables.clear()
+
+    def flush(self):
+        """
+        Sends the pending writes. Returns the list of command lines sent
+        (also appended to C{self.sent}).
+        """
+        lines = self.galil.join(self.commands()) if self else []
+        self.clear()
+        for line in lines:
+            if GALIL_TRACE: logger.debug("galil.batch: %s", line)
+            self.galil.command(line)
+        self.sent.extend(lines)
+        self.stats['lines'] += len(lines)
+        return lines
+
+
+class ProgramBuffer(object):
+    """Collects program lines for L{Galil.programDownload}"""
+    def __init__(self, galil):
+        self.galil = galil
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(line)
+
+    def close(self):
+        self.galil.programDownload("\n".join(self.lines))
+
+    def abort(self):
+        """Drops the collected lines, nothing is downloaded"""
+        self.lines = []
+
+
+class Galil(object):
+    """
+    Controller connection.
+
+    @param address: Controller address (as accepted by the vendor library)
+
+    @param transport: A transport object or the name of a registered
+        transport (see L{galil_apci.transport}). By default, the vendor
+        library is used when installed, else the pure-Python socket
+        transport.
+    """
+    def __init__(self, address="", transport=None):
+        if transport is None or isinstance(transport, basestring):
+            transport = open_transport(address, transport)
+        self.transport = transport
+        self.address = address
+        self.recorder = None
+        self.retry_policy = RetryPolicy(default_timeout_ms=self.timeout_ms)
+        self.program_index = None
+        self.symbols = None
+        self.write_batch = None
         self.max_line_length = 80
         self.nr_digital_inputs = 8
         self.nr_digital_outputs = 8
@@ -65,30 +214,152 @@ class Galil(ExternalGalil.Galil):
         self.nr_threads = 8
 
 
-    def commandValue(self,command,retry=1):
-        try:
-            return super(Galil,self).commandValue(str(command))
-        except ExternalGalil.TimeoutError:
-            logger.warning("Galil timeout (retrying...)" if retry > 0 else "Galil timeout (no retry)")
-            if retry > 0:
-                return self.commandValue(self,command,retry-1)
-        return None
-
-    def command(self,command,retry=1):
+    def __getattr__(self, name):
+        # Library methods not wrapped here (record, sourceValue,
+        # arrayUpload, ...) are passed through to the transport.
+        if name.startswith("__") or name == "transport":
+            raise AttributeError(name)
+        transport = self.__dict__.get("transport")
+        if transport is None:
+            raise AttributeError(name)
+        return getattr(transport, name)
+
+    @property
+    def timeout_ms(self):
+        return None if self.transport is None else self.transport.timeout_ms
+
+    @timeout_ms.setter
+    def timeout_ms(self, value):
+        if self.transport is not None:
+            self.transport.timeout_ms = value
+
+    def close(self):
+        """
+        Closes the controller connection (and any session recording).
+        Transports without a C{close} method (the vendor library) are
+        released, disconnecting when collected.
+        """
+        self.stop_recording()
+        transport, self.transport = self.transport, None
+        if transport is not None and hasattr(transport, "close"):
+            transport.close()
+
+    @staticmethod
+    def addresses():
+        """Controller addresses found by the vendor library (requires it)"""
+        import Galil as ExternalGalil
+        return ExternalGalil.Galil.addresses()
+
+    def _call(self, op, method, *args):
+        """
+        Invokes a library method, logging the call to the session
+        recorder if one is attached.
+        """
+        if self.recorder is None:
+            return method(*args)
+        t0 = time.time()
         try:
-            return super(Galil,self).command(str(command))
-        except ExternalGalil.TimeoutError:
-            if retry > 0:
-                return self.command(command,retry-1)
-        return None
+            res = method(*args)
+        except Exception as err:
+            self.recorder.record(op, args[0] if args else None, None, t0, time.time() - t0, err)
+            raise
+        self.recorder.record(op, args[0] if args else None, res, t0, time.time() - t0)
+        return res
+
+    def record_session(self, fh):
+        """
+        Start logging all controller traffic to a file (see
+        L{galil_apci.record.SessionRecorder}). Returns the recorder.
+        """
+        from .record import SessionRecorder
+        self.stop_recording()
+        self.recorder = SessionRecorder(fh, galil=self)
+        return self.recorder
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    # Transport methods looked up at call time (see L{_call})
+    def _programUpload(self):
+        return self.transport.programUpload()
+
+    def _programDownload(self, program):
+        return self.transport.programDownload(program)
+
+    def _commandValue(self, command):
+        return self.transport.commandValue(command)
+
+    def _command(self, command):
+        return self.transport.command(command)
+
+    def programUpload(self):
+        self.retry_policy.reset_timeout(self)
+        return self._call("programUpload", self._programUpload)
+
+    def programDownload(self, program):
+        return self._call("programDownload", self._programDownload, str(program))
+
+    def programDownloadWriter(self):
+        """
+        Returns a writer (C{write(line)}, C{close()}, C{abort()}) which
+        downloads a program line by line. If the transport can not stream downloads
+        (or the session is being recorded), lines are collected and sent
+        with L{programDownload} on close.
+        """
+        start = getattr(self.transport, "programDownloadStart", None)
+        if start is None or self.recorder is not None:
+            return ProgramBuffer(self)
+        return start()
+
+    def commandValue(self, command, retry=None):
+        """
+        Send a command and return its numeric response. Timeouts are
+        handled by the retry policy (C{self.retry_policy}), C{retry}
+        overrides the number of retries allowed by the policy. Returns
+        None if no response was received.
+        """
+        return self.retry_policy.call(self, "commandValue", self._commandValue, str(command), retry)
+
+    def command(self, command, retry=None):
+        """
+        Send a command and return its response. Timeouts are handled by
+        the retry policy (C{self.retry_policy}), C{retry} overrides the
+        number of retries allowed by the policy. Returns None if no
+        response was received.
+        """
+        return self.retry_policy.call(self, "command", self._command, str(command), retry)
+
+    def load_symbols(self, symbols):
+        """
+        Use a symbol map written by a shortening minifier (see
+        L{text.shorten_lines}): a dict or the name of a JSON file with
+        "variables" and "labels" maps of original name to program name.
+        Variable names passed to L{get}, L{set}, L{get_list}, etc. are
+        then translated to the names used in the program. Pass None to
+        stop translating.
+        """
+        if isinstance(symbols, basestring):
+            with open(symbols, 'r') as fh:
+                symbols = json.load(fh)
+        self.symbols = symbols
+
+    def translate(self, expr):
+        """Translates names in an expression through the symbol map"""
+        if not self.symbols:
+            return expr
+        return text.rename(str(expr), self.symbols.get('variables'), self.symbols.get('labels'))
 
     def __getitem__(self, key):
         if GALIL_TRACE: logger.debug("galil.__getitem__, getting '%s'", key)
-        return self.commandValue("MG{}".format(key))
+        return self.commandValue("MG{}".format(self.translate(key)))
 
     def __setitem__(self, key, value):
         if GALIL_TRACE: logger.debug("galil.__setitem__, setting '%s' = '%s'", key, value)
-        self.command("{}={}".format(key, value))
+        if self.write_batch is not None:
+            return self.write_batch.assign(key, value)
+        self.command("{}={}".format(self.translate(key), value))
 
     @classmethod
     def string_to_galil_hex(self, string):
@@ -122,6 +393,20 @@ class Galil(ExternalGalil.Galil):
         """
         return re.sub('[a-zA-Z0-9]{2}', hex2str, ghex.translate(None, '$.'))
 
+    @classmethod
+    def galil_hex_to_number(self, ghex):
+        """
+        Numeric value of a Galil4,2 hex string (32-bit two's complement
+        integer part, 16-bit fraction).
+
+        E.g.: '$FFFFFFFF.8000' -> -0.5
+        """
+        whole, _, frac = ghex.strip().lstrip('$').partition('.')
+        val = int(whole + frac.ljust(4, '0')[0:4], 16)
+        if val >= (1 << 47):
+            val -= (1 << 48)
+        return val / 65536
+
     @classmethod
     def computeProgramHash(self, program):
         """
@@ -160,20 +445,28 @@ class Galil(ExternalGalil.Galil):
             if stash is not None:
                 stash[key] = val
             return val
-        except ExternalGalil.CommandError:
+        except CommandError:
             return dflt
 
     def get_list(self, exprs, stash=None):
+        """
+        Evaluates a list of expressions, returning a list of floats (or
+        None on error). Expressions are packed into as few C{MG} commands
+        as the line length allows.
+        """
         cmd = "MG" + ",".join(exprs)
         if stash is not None and cmd in stash:
             return stash[cmd]
 
-        res = self.command(cmd)
-        if GALIL_TRACE: logger.debug("galil.get_list('%s') -> %s", cmd, res)
-        if res is None:
-            return None
+        ret = []
+        for group in pack([ self.translate(e) for e in exprs ], "MG", ",", self.max_line_length - 2):
+            line = "MG" + ",".join(group)
+            res = self.command(line)
+            if GALIL_TRACE: logger.debug("galil.get_list('%s') -> %s", line, res)
+            if res is None:
+                return None
+            ret.extend( float(x) for x in res.split() )
 
-        ret = [ float(x) for x in res.split() ]
         if stash is not None:
             stash[cmd] = ret
             for key, val in zip(exprs, ret):
@@ -200,13 +493,13 @@ class Galil(ExternalGalil.Galil):
             return stash[stash_key]
 
         try:
-            coded = self.command("MG {{$8.4}}, {}".format(name))
+            coded = self.command("MG {{$8.4}}, {}".format(self.translate(name)))
             val = self.galil_hex_to_string(coded)
             if GALIL_TRACE: logger.debug("galil.get_string(%s) -> '%s'", name, val)
             if stash is not None:
                 stash[stash_key] = val
             return val
-        except ExternalGalil.CommandError:
+        except CommandError:
             return dflt
 
     def get_string_list(self, exprs, stash=None):
@@ -215,7 +508,7 @@ class Galil(ExternalGalil.Galil):
         if stash is not None and cmd in stash:
             return stash[cmd]
 
-        res = self.command(cmd)
+        res = self.command(self.translate(cmd))
         if GALIL_TRACE: logger.debug("galil.get_string_list('%s') -> %s", cmd, res)
         if res is None:
             return None
@@ -249,36 +542,47 @@ class Galil(ExternalGalil.Galil):
         """
         Sets or clear a galil output bit. Returns None on error.
         """
+        if self.write_batch is not None:
+            self.write_batch.bit(port, value)
+            return ""
         cmd = "SB" if value else "CB"
 
         try:
             if GALIL_TRACE: logger.debug("galil.TB: %s%s", cmd, int(port))
             return self.command("{}{}".format(cmd, int(port)))
-        except ExternalGalil.CommandError:
+        except CommandError:
             return None
 
     def SB(self, *ports):
         """
         Sets bits on output ports. Return None on error (but may have partial setting!)
         """
+        if self.write_batch is not None:
+            for port in ports:
+                self.write_batch.bit(port, True)
+            return ""
         cmd = ";".join( "SB{}".format(port) for port in ports )
 
         try:
             if GALIL_TRACE: logger.debug("galil.SB: %s", cmd)
             return self.command(cmd)
-        except ExternalGalil.CommandError:
+        except CommandError:
             return None
 
     def CB(self, *ports):
         """
         Clears bits on output ports. Return None on error (but may have partial setting!)
         """
+        if self.write_batch is not None:
+            for port in ports:
+                self.write_batch.bit(port, False)
+            return ""
         cmd = ";".join( "CB{}".format(port) for port in ports )
 
         try:
             if GALIL_TRACE: logger.debug("galil.CB: %s", cmd)
             return self.command(cmd)
-        except ExternalGalil.CommandError:
+        except CommandError:
             return None
 
     def get_all_IN(self, stash=None):
@@ -321,6 +625,7 @@ class Galil(ExternalGalil.Galil):
         """Internal helper function for .set() and .run()"""
         code = []
         for name, val in kwargs.iteritems():
+            name = self.translate(name)
             if isinstance(val, basestring):
                 code.append('{}="{}"'.format(name, val))
             else:
@@ -339,12 +644,39 @@ class Galil(ExternalGalil.Galil):
         @attention: Strings will be automatically wrapped in "", be sure
             that any numbers passed are properly int() or float().
         """
+        if self.write_batch is not None:
+            return self.write_batch.set(**kwargs)
         code = self._get_variables_code(**kwargs)
         if GALIL_TRACE: logger.info("Setting variables: %s", " ".join(code))
 
         for line in self.join(code):
             self.command(line)
 
+    def batch(self, autoflush=True):
+        """
+        Write batch context manager (see L{WriteBatch}). While the batch
+        is active, L{TB}, L{SB}, L{CB}, L{set} and item assignment
+        (C{galil["x"] = 1}) only record their writes. On exit the writes
+        are sent if C{autoflush}, otherwise only L{WriteBatch.flush}
+        sends them and unflushed writes are discarded. Writes are also
+        discarded if the block raises.
+
+        Only the last write to each bit or variable is sent, and all
+        output bits are sent before any variable (see L{WriteBatch}), so
+        code which depends on the order of its writes must flush in
+        between.
+
+        Example:
+
+            with galil.batch() as b:
+                galil.SB(1, 2)
+                galil.set(xMode=3)
+            print(b.sent)
+        """
+        if self.write_batch is not None:
+            return self.write_batch
+        return WriteBatch(self, autoflush=autoflush)
+
     def run(self, command, **kwargs):
         """
         Run an APCI "program" on the galil board.
@@ -377,7 +709,7 @@ class Galil(ExternalGalil.Galil):
         """
         try:
             return self.command("MG {$8.4}, xPrgHash")
-        except ExternalGalil.CommandError:
+        except CommandError:
             return None
 
     def getBoardProgramDate(self):
@@ -391,7 +723,7 @@ class Galil(ExternalGalil.Galil):
         try:
             date = self.command("MG {Z8.0} xPrgDate")
             return datetime.strptime(date,'%Y%m%d')
-        except ExternalGalil.CommandError:
+        except CommandError:
             return None
         except ValueError:
             return None
@@ -405,7 +737,7 @@ class Galil(ExternalGalil.Galil):
         """
         try:
             return self.get_string("xPrgName")
-        except ExternalGalil.CommandError:
+        except CommandError:
             return None
 
     @classmethod
@@ -437,6 +769,23 @@ class Galil(ExternalGalil.Galil):
             "#xAPIOk;EN\n", '#xAPIOk;xAPIOk=xAPIOk+1;EN\n'
         )
 
+    @classmethod
+    def add_xAPI_lines(self, lines, name, hash, date=None, columns=79):
+        """
+        Line by line version of L{add_xAPI}: returns an iterator over
+        the lines of the modified program.
+        """
+        program = "\n".join(self.add_xAPI("#xINIT;EN\n#xAPIOk;EN\n", name, hash, date, columns).split("\n")[0:-1])
+        xINIT, xAPIOk = program.rsplit("\n", 1)
+        for line in lines:
+            if line == "#xINIT;EN":
+                for sub in xINIT.split("\n"):
+                    yield sub
+            elif line == "#xAPIOk;EN":
+                yield xAPIOk
+            else:
+                yield line
+
     def check_xAPI(self):
         """
         Check that loaded controller code properly supports xAPI
@@ -454,7 +803,7 @@ class Galil(ExternalGalil.Galil):
 
             return (self["xAPIOk"] == xAPIOk + 1)
 
-        except ExternalGalil.CommandError:
+        except CommandError:
             return False
 
     def boardProgramNeedsUpdate(self, name, check):
@@ -486,24 +835,82 @@ class Galil(ExternalGalil.Galil):
 
         return False
 
-    def ensureBoardProgram(self, name, program, run_auto=True, force=False):
+    def checkProgramLimits(self, program):
+        """
+        Raises L{ProgramLimitError} if a program exceeds the program
+        memory limits of this controller model (lines, labels,
+        variables, arrays, threads; see L{text.MODEL_LIMITS}). Does
+        nothing if the model is unknown. Resources are counted on the
+        compacted program (see L{text.compact_lines}), lines as
+        downloaded.
+        """
+        try:
+            model = self.connection()
+        except Exception:
+            return
+        lines = str(program).split("\n")
+        analysis = text.analyze_lines(text.compact_lines(lines))
+        analysis.update( (k, v) for k, v in text.analyze_lines(lines).items() if k in ("lines", "line_length") )
+        errors = text.check_limits(analysis, model)
+        if errors:
+            raise ProgramLimitError("Program does not fit on {}: {}".format(model.split(",")[0], "; ".join(errors)))
+
+    def programIndexKey(self):
+        """Key identifying this controller in the program index"""
+        return self.address or self.connection()
+
+    def indexedProgramCurrent(self, name, new_hash):
+        """
+        Returns True if the program index records this controller as
+        running the given program and (unless the index is trusted) a
+        single query confirms the board hash and xPrgOK flag.
+        """
+        index = self.program_index
+        if index is None:
+            return False
+        known = index.lookup(self.programIndexKey())
+        if known is None or known['name'] != name or known['hash'] != new_hash:
+            return False
+        if index.trust:
+            return True
+        try:
+            coded = p_ghex.findall(self.command("MG{$8.4}xPrgOK,xPrgHash") or "")
+        except CommandError:
+            return False
+        return (len(coded) == 2 and self.galil_hex_to_number(coded[0]) != 0
+                and coded[1].upper() == new_hash.upper())
+
+    def ensureBoardProgram(self, name, program, run_auto=True, force=False, path=None):
         """
         Examines the hash of the current program on the galil board. If it
         matches the hash of the parameter, nothing is done. Otherwise, the
         program will be loaded onto the board and its #AUTO routine will be
         executed (unless "run_auto=False" is passed to this method).
 
+        If a program index is attached (C{self.program_index}, see
+        L{galil_apci.index.ProgramIndex}), program hashes are memoized
+        (across processes if C{path}, the file the program was built
+        from, is given) and
+        board verification is shortened when the index already records
+        the program on this controller.
+
         Returns True if program was freshly downloaded to the board.
         Returns False if the prorgam was already there.
         """
+        index       = self.program_index
         program_str = str(program)
-        new_hash    = self.computeProgramHash(program_str)
+        new_hash    = self.computeProgramHash(program_str) if index is None else index.program_hash(program_str, path)
 
-        if force or self.boardProgramNeedsUpdate(name, new_hash):
+        current = not force and self.indexedProgramCurrent(name, new_hash)
+        if not current and (force or self.boardProgramNeedsUpdate(name, new_hash)):
+            full_program = self.add_xAPI(program_str, name, new_hash)
+            self.checkProgramLimits(full_program)
             logger.info("Downloading program %s (%s)", name, new_hash)
+            if index is not None:
+                index.forget(self.programIndexKey())
             self.command('RS')
             self["xPrgOK"] = 0
-            self.programDownload(self.add_xAPI(program_str, name, new_hash))
+            self.programDownload(full_program)
             if run_auto:
                 logger.info("Starting program %s (%s)", name, new_hash)
                 self.command('XQ#AUTO')
@@ -513,8 +920,13 @@ class Galil(ExternalGalil.Galil):
                 self['xPrgName'] = self.string_to_galil_hex(name)
                 self['xPrgHash'] = new_hash
             self["xPrgOK"] = 1
+            if index is not None:
+                index.record(self.programIndexKey(), name, new_hash, path, downloaded=True)
             return True
 
+        if index is not None:
+            index.record(self.programIndexKey(), name, new_hash, path)
+
         if run_auto and self["_XQ0"] < 0:
             logger.info("Restarting program %s (%s)", name, new_hash)
             try:
@@ -522,7 +934,7 @@ class Galil(ExternalGalil.Galil):
                 time.sleep(0.5)
             except Exception:
                 self["xPrgOK"] = 0
-                return self.ensureBoardProgram(name, program, run_auto, force=True)
+                return self.ensureBoardProgram(name, program, run_auto, force=True, path=path)
 
         return False
 
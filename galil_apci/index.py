@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent program index
+
+A L{ProgramIndex} is a small sqlite database recording, for each
+controller, the name, hash, path and download time of the last program
+known to be on the board, and a memo of program hashes (keyed by the
+path the program was built from and a CRC and length of the program
+text). When attached to a L{Galil} object
+(C{galil.program_index}), L{Galil.ensureBoardProgram} uses it to avoid
+rehashing unchanged programs and to replace the full xAPI verification
+with a single query when the board is already known to run the program.
+
+The index may also be opened and queried without any controller.
+"""
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function
+__all__ = 'ProgramIndex'.split()
+
+import sqlite3
+import threading
+import time
+import zlib
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS controllers (
+    controller TEXT PRIMARY KEY,
+    name       TEXT,
+    hash       TEXT,
+    path       TEXT,
+    downloaded REAL,
+    verified   REAL
+);
+CREATE TABLE IF NOT EXISTS programs (
+    path   TEXT PRIMARY KEY,
+    length INTEGER,
+    crc    INTEGER,
+    hash   TEXT
+);
+"""
+
+
+class ProgramIndex(object):
+    """
+    @param path: sqlite database file (created if necessary)
+
+    @param trust: If true, a controller recorded as running the
+        requested program is not queried at all. Otherwise a single
+        query confirms the program hash and xPrgOK flag.
+    """
+    def __init__(self, path, trust=False):
+        self.path  = path
+        self.trust = trust
+        self.lock  = threading.Lock()
+        self.memo  = dict()
+        self.db    = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock:
+            self.db.executescript(SCHEMA)
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def program_hash(self, program, path=None):
+        """
+        Galil hash of a program (see L{Galil.computeProgramHash}). If
+        C{path} (the file the program was built from) is given, the hash
+        is remembered across processes until the program text (its CRC
+        or length) changes. Otherwise it is remembered for the life of
+        this object.
+        """
+        from .galil import Galil
+
+        if program in self.memo:
+            return self.memo[program]
+
+        if path is not None:
+            length, crc = len(program), zlib.crc32(program) & 0xffffffff
+            with self.lock:
+                row = self.db.execute("SELECT * FROM programs WHERE path = ?", (path,)).fetchone()
+            if row is not None and row['length'] == length and row['crc'] == crc:
+                self.memo[program] = row['hash']
+                return row['hash']
+
+        phash = Galil.computeProgramHash(program)
+        self.memo[program] = phash
+        if path is not None:
+            with self.lock:
+                self.db.execute("INSERT OR REPLACE INTO programs (path, length, crc, hash) VALUES (?, ?, ?, ?)",
+                                (path, length, crc, phash))
+                self.db.commit()
+        return phash
+
+    def lookup(self, controller):
+        """Last known program on a controller (dict), or None"""
+        with self.lock:
+            row = self.db.execute("SELECT * FROM controllers WHERE controller = ?", (controller,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def record(self, controller, name, phash, path=None, downloaded=False):
+        """
+        Record that a controller runs a program. If C{downloaded} is
+        true, the download time is set to now, else it is retained.
+        """
+        now = time.time()
+        with self.lock:
+            old = self.db.execute("SELECT downloaded FROM controllers WHERE controller = ?", (controller,)).fetchone()
+            when = now if downloaded or old is None else old['downloaded']
+            self.db.execute("INSERT OR REPLACE INTO controllers (controller, name, hash, path, downloaded, verified) VALUES (?, ?, ?, ?, ?, ?)",
+                            (controller, name, phash, path, when, now))
+            self.db.commit()
+
+    def forget(self, controller):
+        with self.lock:
+            self.db.execute("DELETE FROM controllers WHERE controller = ?", (controller,))
+            self.db.commit()
+
+    def controllers(self):
+        """All controller records (list of dicts) ordered by controller"""
+        with self.lock:
+            return [ dict(row) for row in self.db.execute("SELECT * FROM controllers ORDER BY controller") ]
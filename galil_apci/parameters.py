@@ -27,11 +27,16 @@ IndexedParameter VectorParameter NetworkParameter
 '''.split()
 
 import struct
-import Galil as ExternalGalil
 
+from .errors import CommandError
 from .galil import Galil
 
 class Parameter(object):
+    __slots__ = ('galil', 'name', 'value', 'axes', 'filename', 'lineno')
+
+    # True if the value is read by get_cmd() alone (so may be batched with others)
+    batchable = True
+
     def __init__(self, galil, name, value=None, axes=None, filename=None, lineno=None):
         self.galil = galil
         self.name  = name
@@ -75,6 +80,8 @@ class Parameter(object):
 
 
 class CmdParameter(Parameter):
+    __slots__ = ('cmd',)
+
     def __init__(self, galil, name, cmd=None, **kwargs):
         super(CmdParameter,self).__init__(galil, name, **kwargs)
         self.cmd   = name if cmd is None else cmd
@@ -88,6 +95,8 @@ class CmdParameter(Parameter):
 
 
 class BasicParameter(Parameter):
+    __slots__ = ('cmd',)
+
     def __init__(self, galil, name, cmd=None, **kwargs):
         super(BasicParameter,self).__init__(galil, name, **kwargs)
         self.cmd   = name if cmd is None else cmd
@@ -100,32 +109,43 @@ class BasicParameter(Parameter):
 
 
 class BasicQueryParameter(BasicParameter):
+    __slots__ = ()
+
     def get_cmd(self):
         return "{} ?".format(self.cmd)
 
 
 class EqParameter(BasicParameter):
+    __slots__ = ()
+
     def set_cmd(self, value):
         return "{}={}".format(self.cmd, value)
 
 
 class AxisParameter(EqParameter):
+    __slots__ = ()
+
     def __init__(self, galil, name, axis, **kwargs):
         super(AxisParameter,self).__init__(galil, name, cmd=(name + axis), **kwargs)
 
 
 class AxisQueryParameter(AxisParameter):
+    __slots__ = ()
+
     def get_cmd(self):
         return "{}=?".format(self.cmd)
 
 
 class SSIParameter(AxisQueryParameter):
+    __slots__ = ()
+    batchable = False
+
     def get(self, refresh=True):
         try:
             value = self.galil.command(self.get_cmd())
             value = [ x.strip() for x in value.split(',') ]
             value = "{},{},{},{}<{}>{}".format(*value)
-        except ExternalGalil.CommandError:
+        except CommandError:
             value = 0
         if refresh:
             self.value = value
@@ -133,6 +153,9 @@ class SSIParameter(AxisQueryParameter):
 
 
 class AxisMaskParameter(BasicParameter):
+    __slots__ = ()
+    batchable = False
+
     def __init__(self, galil, name, axes, **kwargs):
         super(AxisMaskParameter,self).__init__(galil, name, axes=axes, **kwargs)
 
@@ -151,6 +174,8 @@ class AxisMaskParameter(BasicParameter):
 
 
 class VectorParameter(AxisMaskParameter):
+    __slots__ = ()
+
     def __init__(self, galil, name, length, **kwargs):
         kwargs['axes'] = range(length)
         super(VectorParameter,self).__init__(galil, name, **kwargs)
@@ -180,6 +205,9 @@ class VectorParameter(AxisMaskParameter):
 
 
 class NetworkParameter(BasicParameter):
+    __slots__ = ()
+    batchable = False
+
     @staticmethod
     def int_to_csip(val):
         return ",".join([ str(x) for x in reversed(struct.unpack_from(b"BBBB", struct.pack(b"i", val))) ])
@@ -195,6 +223,8 @@ class NetworkParameter(BasicParameter):
 
 
 class IndexedParameter(Parameter):
+    __slots__ = ('index',)
+
     def __init__(self, galil, name, index, **kwargs):
         super(IndexedParameter,self).__init__(galil, name, **kwargs)
         self.index = index
@@ -207,6 +237,8 @@ class IndexedParameter(Parameter):
 
 
 class OutputBitParameter(Parameter):
+    __slots__ = ('index',)
+
     def __init__(self, galil, name, index, **kwargs):
         kwargs.setdefault("value", (1 if name == 'SB' else 0))
         super(OutputBitParameter,self).__init__(galil, name, **kwargs)
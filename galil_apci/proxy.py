@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+Multiplexing controller proxy
+
+A L{GalilProxy} accepts any number of local clients speaking the Galil
+ASCII protocol (commands terminated by carriage return or newline,
+responses terminated by ":" or "?") and serializes their commands onto a
+single upstream L{Galil} connection.
+
+Read-only commands (see L{is_read}) are shared between clients:
+identical reads which arrive while one is in flight wait for and reuse
+its response, and responses are cached for a short time (C{cache_ttl}).
+Any other command clears the cache.
+
+The special command C{#STATS} returns the per-client metrics as a JSON
+document.
+"""
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function
+__all__ = 'GalilProxy'.split()
+
+import collections
+import json
+import re
+import threading
+import time
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+from .errors import CommandError
+from .galil import GALIL_TRACE, logger
+
+READ_FAMILIES = frozenset('MG TP RP TE TD TV TS TI TC'.split())
+
+p_line_end = re.compile(br'[\r\n]')
+p_command  = re.compile(r'(?:[^;"]|"[^"]*"?)+')
+# TC1 text within an upstream CommandError (vendor library or socket transport)
+p_tc1      = re.compile(r'(?:TC1 returned "|returned \? )(\d+ [^"]*)')
+
+
+def split_commands(line):
+    """Commands of a line (split on ";" outside of quoted strings)"""
+    return [ cmd.strip() for cmd in p_command.findall(line) if cmd.strip() ]
+
+
+def is_read(command):
+    """
+    True if every command on the line is a query without side effects
+    (C{MG}, C{TP}, ... or an "=?" / " ?" parameter query).
+    """
+    for cmd in command.split(";"):
+        cmd = cmd.strip()
+        if not (cmd[0:2] in READ_FAMILIES or cmd.endswith("?")) or '"' in cmd:
+            return False
+    return True
+
+
+class PendingRead(object):
+    def __init__(self):
+        self.event  = threading.Event()
+        self.result = None
+        self.error  = None
+
+
+class ClientMetrics(object):
+    FIELDS = 'commands reads writes cache_hits merged upstream errors bytes_in bytes_out'.split()
+
+    def __init__(self, address):
+        self.address   = "{}:{}".format(*address[0:2])
+        self.connected = time.time()
+        self.upstream_time = 0.0
+        self.last_error = None              # TC1 text of the client's last error
+        for key in self.FIELDS:
+            setattr(self, key, 0)
+
+    def as_dict(self):
+        d = dict( (key, getattr(self, key)) for key in self.FIELDS )
+        d.update(address=self.address, connected=self.connected, upstream_time=round(self.upstream_time, 6))
+        return d
+
+
+class ProxyHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        proxy   = self.server
+        metrics = proxy.add_client(self.client_address)
+        buf = b""
+        try:
+            while True:
+                data = self.request.recv(4096)
+                if not data:
+                    break
+                metrics.bytes_in += len(data)
+                buf += data
+                parts = p_line_end.split(buf)
+                buf = parts.pop()
+                for cmd in parts:
+                    cmd = cmd.decode('latin-1').strip()
+                    if not cmd:
+                        continue
+                    reply = proxy.respond(cmd, metrics).encode('latin-1')
+                    metrics.bytes_out += len(reply)
+                    self.request.sendall(reply)
+        finally:
+            proxy.remove_client(self.client_address)
+
+
+class GalilProxy(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    @param galil: upstream L{Galil} connection
+    @param listen: (host, port) to listen on. Defaults to localhost only.
+    @param cache_ttl: Seconds a read response may be served from cache.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, galil, listen=("127.0.0.1", 2323), cache_ttl=0.050):
+        socketserver.TCPServer.__init__(self, listen, ProxyHandler)
+        self.galil      = galil
+        self.cache_ttl  = cache_ttl
+        self.galil_lock = threading.Lock()   # serializes upstream commands
+        self.state_lock = threading.Lock()   # protects cache, inflight and clients
+        self.cache      = dict()
+        self.inflight   = dict()
+        self.clients    = collections.OrderedDict()
+        self.closed     = []
+
+    def add_client(self, address):
+        metrics = ClientMetrics(address)
+        with self.state_lock:
+            self.clients[address] = metrics
+        logger.info("Proxy client connected: %s", metrics.address)
+        return metrics
+
+    def remove_client(self, address):
+        with self.state_lock:
+            metrics = self.clients.pop(address, None)
+            if metrics is not None:
+                self.closed = (self.closed + [metrics])[-20:]
+        logger.info("Proxy client disconnected: %s", metrics.address if metrics else address)
+
+    def metrics(self):
+        """Metrics of connected (and the last few disconnected) clients"""
+        with self.state_lock:
+            return dict(
+                clients=[ m.as_dict() for m in self.clients.values() ],
+                closed=[ m.as_dict() for m in self.closed ],
+                cached=len(self.cache),
+            )
+
+    def respond(self, line, metrics):
+        """
+        Galil protocol reply for a client command line: the response
+        and ":" for each command, up to a "?" for the first one which
+        fails (the controller ignores the rest of the line).
+        """
+        if line == "#STATS":
+            return json.dumps(self.metrics()) + "\r\n:"
+        reply = []
+        for cmd in split_commands(line):
+            metrics.commands += 1
+            if cmd in ("TC", "TC0", "TC1"):
+                # answered locally: upstream TC1 may report another client's error
+                error = metrics.last_error or "0"
+                reply.append((error if cmd == "TC1" else error.split()[0]) + "\r\n:")
+                continue
+            try:
+                res = self.execute(cmd, metrics)
+            except CommandError as err:
+                if GALIL_TRACE: logger.debug("proxy: '%s' from %s failed: %s", cmd, metrics.address, err)
+                res = None
+                metrics.last_error = getattr(err, 'tc1', None) or "1 Unrecognized command"
+            if res is None:
+                metrics.errors += 1
+                reply.append("?")
+                break
+            reply.append((res + "\r\n:") if res else ":")
+        return "".join(reply)
+
+    def upstream(self, cmd, metrics):
+        with self.galil_lock:
+            t0 = time.time()
+            try:
+                return self.galil.command(cmd)
+            except CommandError as err:
+                # Read the error text before another client's command can replace it
+                err.tc1 = self.error_text(err)
+                raise
+            finally:
+                metrics.upstream += 1
+                metrics.upstream_time += time.time() - t0
+
+    def error_text(self, err):
+        """TC1 text of a failed upstream command (galil_lock held)"""
+        m = p_tc1.search(str(err))
+        if m:
+            return m.group(1).strip()
+        try:
+            return self.galil.command("TC1").strip()
+        except CommandError:
+            return None
+
+    def execute(self, cmd, metrics):
+        if not is_read(cmd):
+            metrics.writes += 1
+            with self.state_lock:
+                self.cache.clear()
+            return self.upstream(cmd, metrics)
+
+        metrics.reads += 1
+        with self.state_lock:
+            hit = self.cache.get(cmd)
+            if hit is not None and time.time() - hit[0] <= self.cache_ttl:
+                metrics.cache_hits += 1
+                return hit[1]
+            pending = self.inflight.get(cmd)
+            owner = pending is None
+            if owner:
+                pending = self.inflight[cmd] = PendingRead()
+
+        if not owner:
+            metrics.merged += 1
+            pending.event.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.result
+
+        try:
+            pending.result = self.upstream(cmd, metrics)
+            if pending.result is not None:
+                with self.state_lock:
+                    self.cache[cmd] = (time.time(), pending.result)
+            return pending.result
+        except Exception as err:
+            pending.error = err
+            raise
+        finally:
+            with self.state_lock:
+                del self.inflight[cmd]
+            pending.event.set()
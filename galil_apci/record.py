@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Controller session recording and replay
+
+A L{SessionRecorder} attached to a L{Galil} object (see
+L{Galil.record_session}) logs every command, response, timing and
+exception as one JSON object per line (gzip compressed if the file name
+ends in ".gz"). L{ReplayGalil} feeds a recording back to application
+code in place of a real controller connection.
+"""
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function
+__all__ = 'SessionRecorder ReplayGalil ReplayTransport ReplayError'.split()
+
+import collections
+import gzip
+import json
+import threading
+import time
+
+from . import errors
+from .galil import Galil, logger
+from .retry import RetryPolicy
+
+RECORD_VERSION = 1
+RECORD_SETTINGS = 'max_line_length nr_digital_inputs nr_digital_outputs nr_analog_inputs nr_analog_outputs nr_threads'.split()
+
+
+def open_session_file(fname, mode):
+    if fname.endswith('.gz'):
+        return gzip.open(fname, mode + 'b')
+    return open(fname, mode)
+
+
+class ReplayError(Exception):
+    pass
+
+
+class SessionRecorder(object):
+    """
+    Writes a session log. Each line is a JSON object. The first line is a
+    header containing the recording start time and controller settings,
+    the remaining lines are calls:
+
+        {"t": 0.0123, "dt": 0.0011, "op": "command", "cmd": "MG_TPA", "res": " 1000.0000"}
+        {"t": 0.0140, "dt": 0.5002, "op": "command", "cmd": "MG_TPA", "err": ["TimeoutError", "1010 TIMEOUT ERROR..."]}
+
+    where "t" is seconds since recording start and "dt" is the call
+    duration in seconds.
+
+    @param fh: file name (compressed if ending in ".gz") or writable file
+        handle.
+    """
+    def __init__(self, fh, galil=None):
+        self.own_fh = not hasattr(fh, 'write')
+        self.fh     = open_session_file(fh, 'w') if self.own_fh else fh
+        self.start  = time.time()
+        self.lock   = threading.Lock()
+        self.count  = 0
+
+        header = dict(version=RECORD_VERSION, start=self.start)
+        if galil is not None:
+            header['address'] = getattr(galil, 'address', None)
+            for key in RECORD_SETTINGS:
+                header[key] = getattr(galil, key, None)
+        self.write(header)
+
+    def write(self, obj):
+        line = json.dumps(obj, separators=(',', ':')) + "\n"
+        with self.lock:
+            self.fh.write(line.encode('utf-8') if self.own_fh and isinstance(self.fh, gzip.GzipFile) else line)
+
+    def record(self, op, cmd, res, t0, dt, err=None):
+        """Log a single call. Timestamps are time.time() values."""
+        rec = dict(t=round(t0 - self.start, 6), dt=round(dt, 6), op=op, cmd=cmd)
+        if err is not None:
+            rec['err'] = [ type(err).__name__, str(err) ]
+        else:
+            rec['res'] = res
+        self.count += 1
+        self.write(rec)
+
+    def close(self):
+        with self.lock:
+            if self.own_fh:
+                self.fh.close()
+            else:
+                self.fh.flush()
+
+
+class ReplayTransport(object):
+    """
+    Transport answering calls from the recorded calls of a session (see
+    L{ReplayGalil} for C{time_scale} and C{strict}).
+    """
+    def __init__(self, records, time_scale=0.0, strict=False, timeout_ms=500):
+        self.time_scale = time_scale
+        self.strict     = strict
+        self.timeout_ms = timeout_ms
+        self.records = collections.deque(records)
+        self.by_key  = collections.defaultdict(collections.deque)
+        for rec in records:
+            self.by_key[(rec['op'], rec['cmd'])].append(rec)
+
+    def __len__(self):
+        return len(self.records)
+
+    def command(self, command):
+        return self.answer("command", command)
+
+    def commandValue(self, command):
+        return self.answer("commandValue", command)
+
+    def programUpload(self):
+        return self.answer("programUpload", None)
+
+    def programDownload(self, program):
+        return self.answer("programDownload", program)
+
+    def answer(self, op, command):
+        if self.strict:
+            if not self.records:
+                raise ReplayError("Recording exhausted at {} '{}'".format(op, command))
+            rec = self.records.popleft()
+            if rec['op'] != op or rec['cmd'] != command:
+                raise ReplayError("Expected {} '{}', got {} '{}'".format(rec['op'], rec['cmd'], op, command))
+        else:
+            queue = self.by_key.get((op, command))
+            if not queue:
+                raise ReplayError("No recorded response for {} '{}'".format(op, command))
+            rec = queue.popleft() if len(queue) > 1 else queue[0]
+
+        if self.time_scale:
+            time.sleep(rec['dt'] * self.time_scale)
+
+        if 'err' in rec:
+            exc = getattr(errors, rec['err'][0], None)
+            if not (isinstance(exc, type) and issubclass(exc, Exception)):
+                logger.debug("Replaying unknown exception type %s as ReplayError", rec['err'][0])
+                exc = ReplayError
+            raise exc(rec['err'][1])
+        return rec.get('res')
+
+
+class ReplayGalil(Galil):
+    """
+    Stands in for a L{Galil} connection, answering calls from a session
+    recording (through a L{ReplayTransport}). No controller connection
+    is made.
+
+    @param source: recording file name or readable file handle
+
+    @param time_scale: Each call sleeps for its recorded duration times
+        this factor (0, the default, replays as fast as possible).
+
+    @param strict: If true, calls must arrive in exactly the recorded
+        order (a L{ReplayError} is raised on mismatch). Otherwise, each
+        (operation, command) pair is answered from its own queue of
+        recorded responses and the final response is repeated once the
+        queue is exhausted, so polling code which runs more (or fewer)
+        iterations than were recorded still replays deterministically.
+    """
+    def __init__(self, source, time_scale=0.0, strict=False):
+        fh = open_session_file(source, 'r') if not hasattr(source, 'read') else source
+        try:
+            lines = [ json.loads(line) for line in fh if line.strip() ]
+        finally:
+            if fh is not source:
+                fh.close()
+
+        if not lines or lines[0].get('version') != RECORD_VERSION:
+            raise ReplayError("Not a galil session recording (or unsupported version)")
+        header = lines.pop(0)
+
+        super(ReplayGalil,self).__init__(header.get('address'), transport=ReplayTransport(lines, time_scale, strict))
+        # Recorded calls include any retries, do not retry again
+        self.retry_policy = RetryPolicy(retries=0, adaptive=False)
+        for key in RECORD_SETTINGS:
+            if header.get(key) is not None:
+                setattr(self, key, header[key])
+
+    def __len__(self):
+        return len(self.transport)
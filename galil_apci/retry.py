@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Timeout and retry policy for controller commands
+
+Each L{Galil} object owns a L{RetryPolicy} (C{galil.retry_policy}) which
+decides the library timeout to use for a command, whether and how often
+a timed out command may be resent, and how long to wait between
+attempts. Timeouts adapt to the observed latency of each command family
+(the two-letter command name).
+"""
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function
+__all__ = 'RetryPolicy'.split()
+
+import collections
+import random
+import re
+import time
+
+from .errors import TimeoutError
+
+import logging
+logger = logging.getLogger('galil_apci')
+
+# Commands which must never be blindly resent: a timeout does not mean
+# that the controller did not act on them.
+NON_IDEMPOTENT = frozenset('XQ SB CB DL RS BN BP BV'.split())
+
+p_family = re.compile(r'^\s*([A-Z]{2})')
+
+
+class LatencyTracker(object):
+    """Sliding window of observed latencies for one command family."""
+    def __init__(self, window):
+        self.samples = collections.deque(maxlen=window)
+        self.pending = 0
+        self.cached  = None
+
+    def add(self, ms):
+        self.samples.append(ms)
+        self.pending += 1
+
+    def percentile(self, pct, min_samples, every=16):
+        if len(self.samples) < min_samples:
+            return None
+        if self.cached is None or self.pending >= every:
+            values = sorted(self.samples)
+            self.cached  = values[min(len(values) - 1, int(pct * len(values)))]
+            self.pending = 0
+        return self.cached
+
+
+class RetryPolicy(object):
+    """
+    @param retries: Number of times a timed out (idempotent) command is
+        resent.
+
+    @param backoff: Delay (seconds) before the first retry, doubled for
+        each subsequent retry up to C{backoff_max}.
+
+    @param jitter: Fraction of the delay to randomize (0.5 means the
+        delay is drawn uniformly from 50%..100% of the nominal value).
+
+    @param timeouts: Dictionary of static timeouts (ms) per command
+        family, e.g., C{dict(MG=100, QU=2000)}. Static timeouts are not
+        adapted.
+
+    @param default_timeout_ms: Timeout for commands with no static or
+        adaptive timeout. Defaults to the library timeout at the time the
+        policy is first used.
+
+    @param adaptive: If true, the timeout for a family is C{factor} times
+        the C{percentile} latency of the last C{window} responses,
+        clamped to [C{timeout_min_ms}, C{timeout_max_ms}]. Each timeout
+        doubles the timeout of the following attempt (up to the maximum).
+
+    @param no_retry: Command families never resent after a timeout.
+
+    @param raise_errors: If true, re-raise the final timeout rather than
+        returning None.
+
+    @ivar counters: Counter of "calls", "timeouts", "retries",
+        "suppressed" (timeouts of non-idempotent commands which were not
+        resent), and "failures" (calls which ran out of attempts).
+    """
+    def __init__(self, retries=2, backoff=0.010, backoff_max=0.250, jitter=0.5,
+                 timeouts=None, default_timeout_ms=None,
+                 adaptive=True, factor=4.0, percentile=0.99, window=200, min_samples=20,
+                 timeout_min_ms=50, timeout_max_ms=2000,
+                 no_retry=NON_IDEMPOTENT, raise_errors=False):
+        self.retries     = retries
+        self.backoff     = backoff
+        self.backoff_max = backoff_max
+        self.jitter      = jitter
+        self.timeouts    = dict(timeouts or ())
+        self.default_timeout_ms = default_timeout_ms
+        self.adaptive    = adaptive
+        self.factor      = factor
+        self.percentile  = percentile
+        self.window      = window
+        self.min_samples = min_samples
+        self.timeout_min_ms = timeout_min_ms
+        self.timeout_max_ms = timeout_max_ms
+        self.no_retry    = frozenset(no_retry)
+        self.raise_errors = raise_errors
+
+        self.latency  = collections.defaultdict(lambda: LatencyTracker(self.window))
+        self.counters = collections.Counter()
+
+    @staticmethod
+    def families(command):
+        """Two-letter command names in a (possibly packed) command line."""
+        fams = []
+        for cmd in command.split(";"):
+            m = p_family.match(cmd)
+            if m:
+                fams.append(m.group(1))
+        return fams or [""]
+
+    def idempotent(self, families):
+        return not any(f in self.no_retry for f in families)
+
+    def timeout_for(self, families):
+        """Timeout (ms) for a command line: the largest of its families' timeouts."""
+        timeout = None
+        for fam in families:
+            if fam in self.timeouts:
+                t = self.timeouts[fam]
+            elif self.adaptive and fam in self.latency:
+                t = self.latency[fam].percentile(self.percentile, self.min_samples)
+                if t is not None:
+                    t = min(self.timeout_max_ms, max(self.timeout_min_ms, int(t * self.factor)))
+            else:
+                t = None
+            if t is None:
+                t = self.default_timeout_ms
+            if t is not None and (timeout is None or t > timeout):
+                timeout = t
+        return timeout
+
+    def delay(self, attempt):
+        """Sleep time (seconds) before the given retry attempt (1, 2, ...)"""
+        delay = min(self.backoff_max, self.backoff * (2 ** (attempt - 1)))
+        return delay * (1 - self.jitter * random.random())
+
+    def observe(self, families, ms):
+        for fam in families:
+            self.latency[fam].add(ms)
+
+    def stats(self):
+        """Counters and current per-family timeouts"""
+        return dict(
+            counters=dict(self.counters),
+            timeouts=dict( (fam, self.timeout_for([fam])) for fam in self.latency ),
+        )
+
+    def reset_timeout(self, galil):
+        """Restore the default library timeout (e.g., before uploads)"""
+        if self.default_timeout_ms is not None and galil.timeout_ms != self.default_timeout_ms:
+            galil.timeout_ms = self.default_timeout_ms
+
+    def call(self, galil, op, method, command, retries=None):
+        """
+        Executes C{galil._call(op, method, command)} under this policy.
+        Returns the result, or None if all attempts timed out (unless
+        raise_errors is set).
+        """
+        if self.default_timeout_ms is None:
+            self.default_timeout_ms = galil.timeout_ms
+
+        families = self.families(command)
+        timeout  = self.timeout_for(families)
+        attempts = 1 + (self.retries if retries is None else retries)
+        if not self.idempotent(families):
+            attempts = 1
+
+        self.counters["calls"] += 1
+        for attempt in range(attempts):
+            if attempt:
+                self.counters["retries"] += 1
+                time.sleep(self.delay(attempt))
+
+            if timeout is not None and timeout != galil.timeout_ms:
+                galil.timeout_ms = timeout
+
+            t0 = time.time()
+            try:
+                res = galil._call(op, method, command)
+            except TimeoutError as err:
+                self.counters["timeouts"] += 1
+                error = err
+                if timeout is not None and self.adaptive:
+                    timeout = min(self.timeout_max_ms, 2 * timeout)
+                logger.warning("Galil timeout on '%s' (attempt %d of %d)", command, attempt + 1, attempts)
+                continue
+
+            self.observe(families, 1000 * (time.time() - t0))
+            return res
+
+        if attempts == 1 and (retries is None or retries > 0) and not self.idempotent(families):
+            self.counters["suppressed"] += 1
+            logger.warning("Galil timeout on '%s', not retrying non-idempotent command", command)
+        self.counters["failures"] += 1
+        if self.raise_errors:
+            raise error
+        return None
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+Coalescing read scheduler
+
+Rather than polling the controller independently, consumers subscribe
+to the expressions they need at the rate they need them. Each tick the
+L{ReadScheduler} merges the (unique) expressions of all subscriptions
+which are due into as few packed C{MG} commands as the line length
+allows (see L{Galil.get_list}) and hands each subscriber its values, so
+that controller load depends on the set of expressions rather than on
+the number of consumers.
+
+Due times lie on a grid of each subscription's period measured from a
+common origin, so subscriptions with related rates (10 Hz and 5 Hz, say)
+fall due in the same ticks. Subscriptions due within C{slack} seconds of
+a tick are read early in that tick.
+
+The scheduler runs in a background thread (L{start}), from an asyncio
+event loop (L{attach}, controller reads run in the loop's executor), or
+by calling L{tick} from an existing loop.
+"""
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function
+__all__ = 'ReadScheduler Subscription'.split()
+
+import collections
+import math
+import threading
+import time
+
+from .errors import CommandError
+from .galil import logger, pack
+
+
+class Subscription(object):
+    """
+    A set of expressions read every C{period} seconds. C{callback} is
+    called with (values, timestamp), values being a dict of expression:
+    float.
+    """
+    def __init__(self, exprs, period, callback):
+        self.exprs    = list(exprs)
+        self.period   = period
+        self.callback = callback
+        self.next_due = None
+        self.reads    = 0
+        self.missed   = 0
+        self.errors   = 0
+
+    def schedule(self, origin, now):
+        """Next grid point (of this period, measured from origin) at or after now"""
+        k = math.ceil((now - origin) / self.period - 1e-9)
+        self.next_due = origin + max(0, k) * self.period
+
+
+class ReadScheduler(object):
+    """
+    @param galil: L{Galil} object
+
+    @param slack: Subscriptions due within this many seconds of a tick
+        are read in that tick.
+
+    @param min_interval: Minimum time between ticks (seconds)
+    """
+    def __init__(self, galil, slack=0.002, min_interval=0.0):
+        self.galil  = galil
+        self.slack  = slack
+        self.min_interval = min_interval
+        self.origin = time.time()
+        self.subscriptions = []
+        self.latest = dict()
+        self.lock   = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.handle = None
+        self.counters = collections.Counter(ticks=0, lines=0, exprs=0, requested=0, errors=0)
+
+    def subscribe(self, exprs, rate, callback):
+        """
+        Read C{exprs} C{rate} times per second. Returns the
+        L{Subscription} (see L{unsubscribe}).
+        """
+        sub = Subscription(exprs, 1.0 / rate, callback)
+        # due immediately, on the grid
+        sub.next_due = self.origin + math.floor((time.time() - self.origin) / sub.period) * sub.period
+        with self.lock:
+            self.subscriptions.append(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            if sub in self.subscriptions:
+                self.subscriptions.remove(sub)
+
+    def next_due(self):
+        with self.lock:
+            return min( s.next_due for s in self.subscriptions ) if self.subscriptions else None
+
+    def poll(self, now=None):
+        """
+        Reads all due expressions. Returns a list of (subscription,
+        values, timestamp) deliveries (see L{publish}).
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            due = [ s for s in self.subscriptions if s.next_due <= now + self.slack ]
+        if not due:
+            return []
+
+        exprs, seen = [], set()
+        for sub in due:
+            for e in sub.exprs:
+                if e not in seen:
+                    seen.add(e)
+                    exprs.append(e)
+
+        c = self.counters
+        c['ticks'] += 1
+        c['exprs'] += len(exprs)
+        c['requested'] += sum( len(s.exprs) for s in due )
+        c['lines'] += len(pack([ self.galil.translate(e) for e in exprs ], "MG", ",", self.galil.max_line_length - 2))
+
+        values = self.read(exprs)
+        stamp = time.time()
+        deliveries = []
+        for sub in due:
+            if values is None:
+                sub.errors += 1
+            elif all( e in values for e in sub.exprs ):
+                sub.reads += 1
+                deliveries.append((sub, dict( (e, values[e]) for e in sub.exprs ), stamp))
+            else:
+                sub.errors += 1
+            # stay on the grid, skipping (and counting) slots we could not meet
+            sub.next_due += sub.period
+            if sub.next_due <= stamp:
+                late = sub.next_due
+                sub.schedule(self.origin, stamp)
+                sub.missed += int(round((sub.next_due - late) / sub.period))
+        return deliveries
+
+    def read(self, exprs):
+        """
+        Values (dict) of exprs in as few commands as possible. If the
+        controller rejects the combined read, expressions are read one
+        at a time so that a bad expression fails only its own
+        subscriptions.
+        """
+        try:
+            res = self.galil.get_list(exprs)
+        except CommandError as err:
+            logger.warning("Scheduled read failed (%s), reading expressions individually", err)
+            values = dict()
+            for e in exprs:
+                try:
+                    val = self.galil.get_list([e])
+                except CommandError:
+                    logger.error("Scheduled read of '%s' failed", e)
+                    continue
+                if val is not None:
+                    values[e] = val[0]
+            self.latest.update(values)
+            self.counters['errors'] += 1
+            return values
+        if res is None or len(res) != len(exprs):
+            self.counters['errors'] += 1
+            return None
+        values = dict(zip(exprs, res))
+        self.latest.update(values)
+        return values
+
+    def publish(self, deliveries):
+        for sub, values, stamp in deliveries:
+            try:
+                sub.callback(values, stamp)
+            except Exception as err:
+                logger.error("Read scheduler subscriber failed: %s", err)
+
+    def tick(self, now=None):
+        """Poll and publish once. Returns the number of deliveries."""
+        deliveries = self.poll(now)
+        self.publish(deliveries)
+        return len(deliveries)
+
+    def delay(self):
+        """Seconds until the next tick (None if nothing is subscribed)"""
+        due = self.next_due()
+        if due is None:
+            return None
+        return max(self.min_interval, due - time.time())
+
+    def run(self, idle=0.1):
+        """Tick until L{stop} is called"""
+        while not self.stop_event.is_set():
+            delay = self.delay()
+            if delay is None:
+                delay = idle
+            if delay > 0 and self.stop_event.wait(delay):
+                break
+            self.tick()
+
+    def start(self):
+        """Runs the scheduler in a background thread"""
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name="galil_apci-scheduler")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def attach(self, loop, executor=None, idle=0.1):
+        """
+        Runs the scheduler from an asyncio event loop. Controller reads
+        run in C{executor} (default: the loop's executor), subscribers
+        are called in the loop thread. Returns immediately.
+        """
+        def schedule():
+            if self.stop_event.is_set():
+                return
+            delay = self.delay()
+            self.handle = loop.call_later(idle if delay is None else delay, fire)
+
+        def done(future):
+            try:
+                self.publish(future.result())
+            except Exception as err:
+                logger.error("Scheduled read failed: %s", err)
+            schedule()
+
+        def fire():
+            loop.run_in_executor(executor, self.poll).add_done_callback(done)
+
+        self.stop_event.clear()
+        loop.call_soon_threadsafe(schedule)
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def stats(self):
+        """
+        Counters: ticks, MG lines sent, unique expressions read and
+        expressions requested by subscribers.
+        """
+        return dict(self.counters)
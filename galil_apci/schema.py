@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+Typed bulk variable access
+
+A L{VariableSchema} declares a set of controller variables (names, types
+and array sizes) and compiles them into packed read and write command
+lines so that an entire structure of process variables can be
+transferred in as few round trips as the controller line length allows.
+
+Reads are performed in Galil4,2 hex format (C{MG{$8.4}}) which is exact
+for every type (including strings) and is decoded according to the
+declared type.
+"""
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function
+__all__ = 'Variable VariableSchema'.split()
+
+import re
+
+from .galil import Galil, GALIL_TRACE, logger, pack, p_ghex
+
+
+p_name = re.compile(r'^[a-zA-Z][a-zA-Z0-9]{0,7}$')
+
+# Largest galil integer part (Galil4,2: 32-bit integer, 16-bit fraction)
+GALIL_INT_MAX = 2147483647
+
+
+def format_int(value):
+    value = int(value)
+    if abs(value) > GALIL_INT_MAX:
+        raise ValueError("Value {} out of range for a galil variable".format(value))
+    return str(value)
+
+def format_float(value):
+    value = float(value)
+    if abs(value) > GALIL_INT_MAX:
+        raise ValueError("Value {} out of range for a galil variable".format(value))
+    # Galil stores 1/65536 resolution, but only accepts 4 decimal places
+    return "{:.4f}".format(value).rstrip("0").rstrip(".")
+
+def format_bool(value):
+    return "1" if value else "0"
+
+def format_string(value):
+    value = str(value)
+    if len(value) > 6:
+        raise ValueError("Galil strings may have at most 6 characters: '{}'".format(value))
+    if '"' in value:
+        raise ValueError("Galil strings may not contain '\"': '{}'".format(value))
+    return '"{}"'.format(value)
+
+
+def parse_int(ghex):
+    return int(round(Galil.galil_hex_to_number(ghex)))
+
+def parse_float(ghex):
+    return Galil.galil_hex_to_number(ghex)
+
+def parse_bool(ghex):
+    return Galil.galil_hex_to_number(ghex) != 0
+
+def parse_string(ghex):
+    return Galil.galil_hex_to_string(ghex)
+
+
+# type name: (formatter, parser, maximum formatted width)
+TYPES = {
+    'int':    (format_int,    parse_int,    11),
+    'float':  (format_float,  parse_float,  16),
+    'bool':   (format_bool,   parse_bool,   1),
+    'string': (format_string, parse_string, 8),
+}
+TYPE_ALIASES = { int: 'int', float: 'float', bool: 'bool', str: 'string', 'str': 'string' }
+
+
+class Variable(object):
+    """
+    A single declared controller variable.
+
+    @param name: Galil variable name (at most 8 characters)
+    @param type: One of 'int', 'float', 'bool', 'string' (or the
+        corresponding python type). Strings are at most 6 characters.
+    @param size: None for scalar variables, else the number of array
+        elements (the variable must be declared with C{DM} on the
+        controller).
+    """
+    def __init__(self, name, type='float', size=None):
+        if not p_name.match(name):
+            raise ValueError("Invalid galil variable name '{}'".format(name))
+        type = TYPE_ALIASES.get(type, type)
+        if type not in TYPES:
+            raise ValueError("Unknown type '{}' for galil variable '{}'".format(type, name))
+        if size is not None and int(size) < 1:
+            raise ValueError("Invalid array size {} for galil variable '{}'".format(size, name))
+
+        self.name = name
+        self.type = type
+        self.size = None if size is None else int(size)
+        self.format, self.parse, self.width = TYPES[type]
+
+    def __repr__(self):
+        if self.size is None:
+            return "Variable({!r}, {!r})".format(self.name, self.type)
+        return "Variable({!r}, {!r}, {})".format(self.name, self.type, self.size)
+
+    def exprs(self):
+        """Galil expressions for each value of this variable"""
+        if self.size is None:
+            return [ self.name ]
+        return [ "{}[{}]".format(self.name, i) for i in range(self.size) ]
+
+    def assignments(self, value):
+        """Formatted assignment commands setting this variable to value"""
+        if self.size is None:
+            return [ "{}={}".format(self.name, self.format(value)) ]
+        if len(value) > self.size:
+            raise ValueError("Too many values ({}) for galil array {}[{}]".format(len(value), self.name, self.size))
+        return [ "{}[{}]={}".format(self.name, i, self.format(v)) for i, v in enumerate(value) ]
+
+
+class CompiledSchema(object):
+    """
+    Precomputed command lines for a schema at a particular line length.
+
+    @ivar read_cmds: list of (command, [(variable, index), ...]) pairs.
+        Each command returns one Galil4,2 hex value per entry.
+
+    @ivar write_templates: list of (template, [(variable, index), ...])
+        pairs. Templates are packed assuming the maximum formatted width
+        of each value so any full set of values fits on the line.
+    """
+    def __init__(self, variables, width):
+        self.width = width
+
+        slots = [ (var, idx) for var in variables for idx in range(var.size or 1) ]
+
+        def expr(slot):
+            var, idx = slot
+            return var.name if var.size is None else "{}[{}]".format(var.name, idx)
+
+        self.read_cmds = []
+        prefix = "MG{$8.4}"
+        i = 0
+        for group in pack([ expr(s) for s in slots ], prefix, ",", width):
+            self.read_cmds.append((prefix + ",".join(group), slots[i:i+len(group)]))
+            i += len(group)
+
+        self.write_templates = []
+        i = 0
+        placeholders = [ expr(s) + "=" + "#" * s[0].width for s in slots ]
+        for group in pack(placeholders, "", ";", width):
+            group_slots = slots[i:i+len(group)]
+            tmpl = ";".join( expr(s).replace("{", "{{").replace("}", "}}") + "={}" for s in group_slots )
+            self.write_templates.append((tmpl, group_slots))
+            i += len(group)
+
+
+class VariableSchema(object):
+    """
+    A declared set of controller variables which may be read or written
+    together with a minimal number of commands.
+
+    Example:
+
+        recipe = VariableSchema([
+            ("xSpeed", float), ("xCount", int), ("xName", str),
+            ("xEnable", bool), ("xTbl", float, 10),
+        ])
+        values = recipe.read(galil)
+        values["xSpeed"] = 12.5
+        recipe.write(galil, values)
+
+    @param variables: list of L{Variable} objects or (name, type[, size])
+        tuples.
+    """
+    def __init__(self, variables):
+        self.variables = []
+        self.by_name = dict()
+        for var in variables:
+            if not isinstance(var, Variable):
+                var = Variable(*var)
+            if var.name in self.by_name:
+                raise ValueError("Duplicate galil variable '{}' in schema".format(var.name))
+            self.variables.append(var)
+            self.by_name[var.name] = var
+        self._compiled = dict()
+
+    def __iter__(self):
+        return iter(self.variables)
+
+    def __len__(self):
+        return len(self.variables)
+
+    def compile(self, width):
+        """Returns the (cached) L{CompiledSchema} for a maximum line width."""
+        if width not in self._compiled:
+            self._compiled[width] = CompiledSchema(self.variables, width)
+        return self._compiled[width]
+
+    @staticmethod
+    def width_for(galil):
+        return galil.max_line_length - 2
+
+    def read(self, galil, stash=None):
+        """
+        Read all variables in the schema. Returns a dictionary of values
+        (lists for array variables) decoded according to declared type.
+
+        @param stash: If provided, the stash will be populated with the
+            values read (keyed by variable name)
+        """
+        compiled = self.compile(self.width_for(galil))
+        values = dict( (var.name, [None] * var.size) for var in self.variables if var.size is not None )
+
+        for cmd, slots in compiled.read_cmds:
+            res = galil.command(galil.translate(cmd))
+            if GALIL_TRACE: logger.debug("VariableSchema.read('%s') -> %s", cmd, res)
+            if res is None:
+                raise Exception("No response reading galil variables: {}".format(cmd))
+            coded = p_ghex.findall(res)
+            if len(coded) != len(slots):
+                raise Exception("Expected {} values, received {} reading galil variables: {}".format(len(slots), len(coded), cmd))
+            for (var, idx), ghex in zip(slots, coded):
+                if var.size is None:
+                    values[var.name] = var.parse(ghex)
+                else:
+                    values[var.name][idx] = var.parse(ghex)
+
+        if stash is not None:
+            stash.update(values)
+        return values
+
+    def write_commands(self, galil, values=None, **kwargs):
+        """
+        Returns the packed command lines required to write the given
+        values. Values for every variable in the schema use the
+        precompiled templates, partial updates are packed on demand.
+        """
+        if values is None:
+            values = dict()
+        values = dict(values, **kwargs)
+        for name in values:
+            if name not in self.by_name:
+                raise KeyError("Galil variable '{}' not in schema".format(name))
+
+        width = self.width_for(galil)
+        full = all( name in values and (var.size is None or len(values[name]) == var.size)
+                    for name, var in self.by_name.items() )
+
+        if full:
+            return [ tmpl.format(*[ var.format(values[var.name] if var.size is None else values[var.name][idx])
+                                    for var, idx in slots ])
+                     for tmpl, slots in self.compile(width).write_templates ]
+
+        code = []
+        for var in self.variables:
+            if var.name in values:
+                code.extend(var.assignments(values[var.name]))
+        return [ ";".join(group) for group in pack(code, "", ";", width) ]
+
+    def write(self, galil, values=None, **kwargs):
+        """
+        Write variables to the controller. Values may be passed as a
+        dictionary and/or keyword arguments. Returns the list of command
+        lines which were sent.
+        """
+        code = self.write_commands(galil, values, **kwargs)
+        if GALIL_TRACE: logger.info("VariableSchema.write: %s", " ".join(code))
+        for line in code:
+            galil.command(galil.translate(line))
+        return code
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Shared memory status snapshots
+
+A L{StatusPublisher} owns the controller connection and periodically
+writes a fixed-layout status snapshot (digital and analog I/O, axis
+positions, running threads, program name and hash) into a memory mapped
+file (by default on /dev/shm). Any number of L{StatusReader} objects in
+other processes can then read the latest snapshot without touching the
+controller.
+
+Consistency is ensured with a seqlock: the writer makes the sequence
+number odd while updating and even when done, readers retry until they
+see the same even sequence number before and after copying the data.
+"""
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function
+__all__ = 'StatusPublisher StatusReader StatusSnapshot'.split()
+
+import collections
+import mmap
+import os
+import struct
+import time
+
+from .errors import CommandError
+from .galil import Galil, logger, p_ghex
+
+STATUS_MAGIC   = b'GSTS'
+STATUS_VERSION = 1
+
+# magic, version, nr_inputs, nr_outputs, nr_analog, nr_axes, axis names, seq
+HEADER = struct.Struct(b'<4sHHHHH8sI')
+SEQ_OFFSET = HEADER.size - 4
+
+StatusSnapshot = collections.namedtuple(
+    'StatusSnapshot',
+    'seq time ok inputs outputs analog positions threads program_name program_hash'
+)
+
+
+def payload_struct(nr_inputs, nr_outputs, nr_analog, nr_axes):
+    # time, ok, input bits, output bits, analog[], positions[], thread bits, name, hash
+    return struct.Struct('<dBQQ{}d{}dI8s16s'.format(nr_analog, nr_axes).encode('ascii'))
+
+
+def default_path(name):
+    shm = "/dev/shm"
+    return os.path.join(shm if os.path.isdir(shm) else "/tmp", "galil_apci-status-{}".format(name))
+
+
+def bits(values):
+    mask = 0
+    for i, val in enumerate(values):
+        if val:
+            mask |= (1 << i)
+    return mask
+
+def unbits(mask, count):
+    return [ (mask >> i) & 1 for i in range(count) ]
+
+
+class StatusPublisher(object):
+    """
+    Polls a controller and publishes status snapshots.
+
+    @param galil: L{Galil} object (the single connection to the controller)
+    @param path: File to map (see L{default_path}), created or resized as needed.
+    @param axes: Axes whose positions (C{_TP}) are published.
+    @param program_interval: Seconds between reads of program name and
+        hash (these rarely change).
+    """
+    def __init__(self, galil, path, axes="ABCD", program_interval=5.0):
+        if len(axes) > 8:
+            raise ValueError("At most 8 axes may be published")
+        self.galil = galil
+        self.path  = path
+        self.axes  = axes
+        self.program_interval = program_interval
+
+        self.nr_inputs  = galil.nr_digital_inputs
+        self.nr_outputs = galil.nr_digital_outputs
+        self.nr_analog  = galil.nr_analog_inputs
+        if max(self.nr_inputs, self.nr_outputs) > 64:
+            raise ValueError("At most 64 digital inputs and outputs may be published")
+
+        self.exprs = (
+            [ "@IN[{}]".format(1+i)  for i in range(self.nr_inputs) ] +
+            [ "@OUT[{}]".format(1+i) for i in range(self.nr_outputs) ] +
+            [ "@AN[{}]".format(1+i)  for i in range(self.nr_analog) ] +
+            [ "_TP{}".format(a) for a in axes ] +
+            [ "_XQ{}".format(i) for i in range(galil.nr_threads) ]
+        )
+
+        self.payload = payload_struct(self.nr_inputs, self.nr_outputs, self.nr_analog, len(axes))
+        size = HEADER.size + self.payload.size
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        HEADER.pack_into(self.map, 0, STATUS_MAGIC, STATUS_VERSION,
+                         self.nr_inputs, self.nr_outputs, self.nr_analog, len(axes),
+                         axes.encode('ascii'), 0)
+        self.seq = 0
+        self.program = (b"", b"")
+        self.program_time = 0
+
+    def read_program(self):
+        """Program name and hash in a single round trip"""
+        try:
+            res = self.galil.command("MG{$8.4}xPrgName,xPrgHash")
+            coded = p_ghex.findall(res or "")
+        except CommandError:
+            coded = []
+        if len(coded) != 2:
+            return (b"", b"")
+        return (Galil.galil_hex_to_string(coded[0]).encode('latin-1'), coded[1].encode('ascii'))
+
+    def poll(self):
+        """
+        Read the controller status. Returns the payload tuple, or None if
+        the controller did not respond.
+        """
+        now = time.time()
+        if now - self.program_time >= self.program_interval:
+            self.program = self.read_program()
+            self.program_time = now
+
+        try:
+            values = self.galil.get_list(self.exprs)
+        except CommandError as err:
+            logger.warning("Status poll failed: %s", err)
+            values = None
+        if values is None:
+            return None
+
+        i, o, a, n = self.nr_inputs, self.nr_outputs, self.nr_analog, len(self.axes)
+        inputs    = values[0:i]
+        outputs   = values[i:i+o]
+        analog    = values[i+o:i+o+a]
+        positions = values[i+o+a:i+o+a+n]
+        threads   = [ x >= 0 for x in values[i+o+a+n:] ]
+        return ((now, 1, bits(inputs), bits(outputs)) + tuple(analog) + tuple(positions)
+                + (bits(threads),) + self.program)
+
+    def write(self, payload):
+        self.seq = (self.seq + 1) & 0xFFFFFFFF    # odd: update in progress
+        struct.pack_into(b'<I', self.map, SEQ_OFFSET, self.seq)
+        self.payload.pack_into(self.map, HEADER.size, *payload)
+        self.seq = (self.seq + 1) & 0xFFFFFFFF    # even: consistent
+        if self.seq == 0:                         # 0 means "nothing published yet"
+            self.seq = 2
+        struct.pack_into(b'<I', self.map, SEQ_OFFSET, self.seq)
+
+    def publish(self):
+        """
+        Poll once and publish. If the controller does not respond, the
+        previous values are republished with the "ok" flag cleared.
+        Returns True if fresh values were published.
+        """
+        payload = self.poll()
+        if payload is None:
+            old = list(self.payload.unpack_from(self.map, HEADER.size))
+            old[1] = 0
+            self.write(old)
+            return False
+        self.write(payload)
+        return True
+
+    def run(self, interval=0.1, stop=None):
+        """
+        Publish every C{interval} seconds until C{stop} (a
+        C{threading.Event}) is set.
+        """
+        next_time = time.time()
+        while stop is None or not stop.is_set():
+            self.publish()
+            next_time += interval
+            delay = next_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_time = time.time()
+
+    def close(self):
+        self.map.close()
+
+
+class StatusReader(object):
+    """
+    Reads snapshots published by a L{StatusPublisher} (possibly in
+    another process). No controller connection is required.
+    """
+    def __init__(self, path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            self.map = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+
+        (magic, version, self.nr_inputs, self.nr_outputs, self.nr_analog,
+         nr_axes, axes, _) = HEADER.unpack_from(self.map, 0)
+        if magic != STATUS_MAGIC or version != STATUS_VERSION:
+            raise ValueError("{} is not a galil status region (or unsupported version)".format(path))
+        self.axes = axes[0:nr_axes].decode('ascii')
+        self.payload = payload_struct(self.nr_inputs, self.nr_outputs, self.nr_analog, nr_axes)
+
+    def sequence(self):
+        return struct.unpack_from(b'<I', self.map, SEQ_OFFSET)[0]
+
+    def read(self, retries=1000):
+        """Returns the latest consistent L{StatusSnapshot}."""
+        start, end = HEADER.size, HEADER.size + self.payload.size
+        for _ in range(retries):
+            seq1 = self.sequence()
+            if seq1 & 1:
+                continue
+            data = self.map[start:end]
+            seq2 = self.sequence()
+            if seq1 == seq2:
+                break
+        else:
+            raise RuntimeError("Unable to read a consistent status snapshot")
+
+        if seq1 == 0:
+            return None
+
+        values = self.payload.unpack(data)
+        a, n = self.nr_analog, len(self.axes)
+        t, ok, inputs, outputs = values[0:4]
+        analog    = list(values[4:4+a])
+        positions = dict(zip(self.axes, values[4+a:4+a+n]))
+        threads, name, phash = values[4+a+n:]
+        return StatusSnapshot(
+            seq1, t, bool(ok),
+            unbits(inputs, self.nr_inputs), unbits(outputs, self.nr_outputs),
+            analog, positions,
+            set( i for i in range(32) if (threads >> i) & 1 ),
+            name.rstrip(b"\0").decode('latin-1'), phash.rstrip(b"\0").decode('ascii'),
+        )
+
+    def close(self):
+        self.map.close()
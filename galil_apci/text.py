@@ -0,0 +1,568 @@
+# -*- coding: utf-8 -*-
+"""
+Plain text passes over galil programs
+
+Whitespace trimming, minification and lint checks for already rendered
+(plain) galil code. This module depends only on the standard library so
+that tools processing C{.dmc} files need not load the templating stack
+(see L{GalilFile} for the template interface).
+
+Each pass is available as a generator over lines (C{*_lines}) which
+holds at most a couple of lines in memory, and as a function over a
+complete string.
+"""
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function
+__all__ = 'split_lines strip_double_semis trim trim_lines minify minify_lines prune_lines shorten_lines rename lint lint_lines analyze analyze_lines check_limits model_limits MODEL_LIMITS'.split()
+
+import collections
+import itertools
+import re
+import logging
+logger = logging.getLogger(__name__)
+
+
+double_semi = re.compile(r';(\s*)(?=;)')
+line_end_semi = re.compile(r';$')
+trailing_semi = re.compile(r';(\s*)$')
+
+# Comments: ', NO, REM. Do NOT need to check for word boundaries ("NOTE" is a comment)
+#
+# WARNING: This is INCORRECT! In galil a semicolon ends a comment
+# - this is crazy so I explicitly choose to have a comment kill
+# the rest of the line
+comment = re.compile(r"(?:^|;)\s*(?:'|NO|REM).*")
+
+# Operators with wrapped space. Match will be replaced with \1.
+operator_spaces = re.compile(r"\s*([,;=\+\-*/%<>\(\)\[\]&|]|<>|>=|<=)\s*")
+
+# A line containing just a label
+label_line = re.compile(r"^#[a-zA-Z0-9]{1,7}$")
+
+# A line that starts with a label
+label_start = re.compile(r"^#")
+
+# Joinable Lines (combinations of the following):
+#    - Simple Assignments: assignments to our variables or arrays (start with lower)
+#    - ENDIF, ELSE
+# NOTE: a joinable line never ends in a semicolon - this provides a way to force a line break
+joinable_line = re.compile(r"""
+    ^(?: (?:^|;) \s*
+         (?:
+             (?:[~^][a-z]|[a-z][a-zA-Z0-9]{0,7}(?:\[[^\];]+\])?)
+                 \s* = \s* [^\;]+
+           | ENDIF
+           | ELSE
+         )
+    \s*)+$
+""", re.X)
+
+
+# Lint patterns
+# WARNING: Any trailing semicolon/EOL checks need to be zero-width assertions
+p_sub_def   = re.compile(r"(?:^|;)(#[a-zA-Z0-9_]{1,7})")
+p_sub_arg   = re.compile(r"""
+                 (?:^|;)
+                 (?:J[SP]|XQ) (\#[a-zA-Z0-9_]{1,7})      # jump name
+                 ((?:\(.*?\))?)                          # optional arguments
+                 (?= ; | $                               # endl
+                   | , \(                                # complex condition
+                   | , (?:\d+|\^[a-h]|\w{1,8}) (?:;|$)   # thread number
+                 )
+              """, re.X)
+p_bad_ops   = re.compile(r"(?:==|!=)")
+p_JS        = re.compile(r"_JS")
+
+p_if_js     = re.compile(r"(?:^|;)IF\([^;\n]+\)[;\n](J[SP]#[a-zA-Z]+)[^;\n]*[;\n]ENDIF", re.M)
+
+# Dangerous to have any calculation in an argument. Only want variables.
+# warning: won't catch @ABS[foo]
+p_danger_arg = re.compile(r"(?:.(?:\(|\)).|[^a-zA-Z0-9.,@\[\]_\(\)\^\&\"\-]|(?<![\(,])\-)")
+pc_MG       = re.compile(r"^MG")
+
+AUTO_subs   = set(["#AUTO", "#MCTIME", "#AMPERR", "#AUTOERR", "#POSERR", "#CMDERR"])
+
+# Dead code pruning: labels run by the controller itself (automatic
+# subroutines) or from python (xAPI) are always kept.
+PRUNE_ROOTS = AUTO_subs | set(["#COMINT", "#ININT", "#LIMSWI", "#SERERR", "#TCPERR", "#xINIT", "#xAPIOk"])
+p_label_ref = re.compile(r"#([a-zA-Z0-9_]{1,7})")
+# Variables read or written from python, never renamed by shorten_lines
+KEEP_NAMES = set("xRun xPrgName xPrgHash xPrgDate xPrgOK xAPIOk".split())
+# A (lower case) variable name, not part of a longer token, a command
+# operand (_TPA), axis/argument variable (~a, ^a), label or hex value ($1a.2b)
+p_identifier = re.compile(r"(?<![A-Za-z0-9_~^$.#])([a-z][a-zA-Z0-9]{0,7})(?![A-Za-z0-9_])")
+# Commands after which execution never continues on the next line
+p_block_end = re.compile(r"^(?:EN(?![A-Z])|R[EI](?![A-Z])|JP#[a-zA-Z0-9_]{1,7}(?:\([^,]*\))?$)")
+
+# Analysis patterns. Variables follow the APCI convention of starting
+# with a lower case letter (upper case assignments are commands, "KPA=1").
+p_var_assign = re.compile(r"(?:^|;)([a-z][a-zA-Z0-9]{0,7})(?:\[[^\];]+\])?=")
+p_dm         = re.compile(r"(?:^|;)DM ?([^;]+)")
+p_dm_array   = re.compile(r"^([a-zA-Z][a-zA-Z0-9]{0,7})\[(\d+)\]$")
+p_xq         = re.compile(r"(?:^|;)XQ ?#[a-zA-Z0-9_]{1,7}(?:,(\d+))?")
+
+# Program memory limits by model (prefix of the connection string, e.g.
+# "DMC4080 Rev 1.0, ..."). Longest matching prefix wins.
+MODEL_LIMITS = {
+    "DMC18":  dict(lines=2000, line_length=79, labels=510,  variables=510,  arrays=30, array_elements=16000, threads=8),
+    "DMC21":  dict(lines=1000, line_length=79, labels=254,  variables=254,  arrays=30, array_elements=8000,  threads=8),
+    "DMC30":  dict(lines=2000, line_length=79, labels=510,  variables=510,  arrays=30, array_elements=16000, threads=6),
+    "DMC40":  dict(lines=2000, line_length=79, labels=510,  variables=510,  arrays=30, array_elements=24000, threads=8),
+    "DMC41":  dict(lines=2000, line_length=79, labels=510,  variables=510,  arrays=30, array_elements=24000, threads=8),
+    "DMC50":  dict(lines=4000, line_length=79, labels=1022, variables=1022, arrays=62, array_elements=40000, threads=8),
+    "RIO47":  dict(lines=400,  line_length=79, labels=62,   variables=126,  arrays=6,  array_elements=1000,  threads=4),
+}
+
+
+def split_lines(chunks):
+    """
+    Splits text given in arbitrary pieces (e.g., the output of a Jinja
+    template's C{generate()}) into lines, as C{"".join(chunks).split("\\n")}
+    would without building the whole text. Returns an iterator.
+    """
+    tail = []
+    for chunk in chunks:
+        if "\n" not in chunk:
+            tail.append(chunk)
+            continue
+        tail.append(chunk)
+        parts = "".join(tail).split("\n")
+        tail = [ parts.pop() ]
+        for line in parts:
+            yield line
+    yield "".join(tail)
+
+def strip_double_semis(lines):
+    """
+    Removes the first of two semicolons separated only by whitespace,
+    as C{double_semi.sub(r'\\1', content)} would on the joined lines
+    (semicolons may be separated by line breaks). Only a line ending in
+    a semicolon and the blank lines after it are held back. Returns an
+    iterator.
+    """
+    held = []
+    for line in lines:
+        line = double_semi.sub(r'\1', line)
+        if held:
+            if not line.strip():
+                held.append(line)
+                continue
+            if line.lstrip().startswith(";"):
+                held[0] = trailing_semi.sub(r'\1', held[0])
+            for h in held:
+                yield h
+            held = []
+        if trailing_semi.search(line):
+            held.append(line)
+        else:
+            yield line
+    for h in held:
+        yield h
+
+def trim_lines(lines):
+    """Strips whitespace and drops empty lines. Returns an iterator."""
+    for line in lines:
+        line = line.strip()
+        if len(line):
+            yield line
+
+def trim(content):
+    """
+    Performs whitespace trimming on a galil file.
+    """
+    return "\n".join(trim_lines(content.split("\n")))
+
+
+def compact_lines(lines):
+    """Strips comments and space around operators, drops empty lines"""
+    for line in lines:
+        line = comment.sub('', line)
+        line = operator_spaces.sub('\\1', line)
+        line = line.strip()
+        if len(line):
+            yield line
+
+def join_lines(lines, line_length):
+    """Merges joinable lines (see L{joinable_line}) into the line before"""
+    line = None
+    for nxt in lines:
+        if line is not None and joinable_line.match(nxt) and line_length > len(line + ";" + nxt):
+            line = line + ";" + nxt
+        else:
+            if line is not None:
+                yield line
+            line = nxt
+    if line is not None:
+        yield line
+
+def squash_labels(lines, line_length):
+    """Squashes label lines into the next line (and a following EN)"""
+    lines = iter(lines)
+    line = next(lines, None)
+    while line is not None:
+        nxt = next(lines, None)
+        if ( nxt is not None
+             and label_line.match(line)
+             and not label_start.match(nxt)
+             and line_length > len(line + ";" + nxt)
+           ):
+            line = line + ";" + nxt
+            nxt = next(lines, None)
+
+            if nxt == 'EN' and line_length > len(line + ";" + nxt):
+                line = line + ";" + nxt
+                nxt = next(lines, None)
+
+        # double semicolons confuse galil but are somewhat easy to
+        # introduce when templating and doing strange minification.
+        # Strip them out again just to be sure:
+        line = line_end_semi.sub('', double_semi.sub(r'\1', line))
+
+        if len(line):
+            if len(line) > line_length:
+                logger.error("Long line '%s' in minified galil output", line)
+            yield line
+        line = nxt
+
+def prune_lines(lines, keep=(), report=None):
+    """
+    Removes unreachable code from compacted lines (see
+    L{compact_lines}). The program is split into blocks at lines
+    starting with a label. Starting from the code before the first
+    label, the automatic subroutines (L{PRUNE_ROOTS}) and the labels in
+    C{keep}, a block is reachable if any reachable block references one
+    of its labels (C{JS}, C{JP}, C{XQ}, or any other "#label" use) or if
+    the previous block is reachable and does not end in C{EN}, C{RE},
+    C{RI} or an unconditional C{JP}.
+
+    Returns the list of kept lines. If C{report} (a dict) is given, it
+    receives the removed "labels" and the number of removed "lines" and
+    "bytes".
+    """
+    blocks = [ [] ]
+    for line in lines:
+        if label_start.match(line) and blocks[-1]:
+            blocks.append([])
+        blocks[-1].append(line)
+
+    owner = dict()                      # label -> block index
+    refs  = []                          # block index -> referenced labels
+    for i, block in enumerate(blocks):
+        defined = set()
+        for line in block:
+            defined.update(p_sub_def.findall(line))
+        for name in defined:
+            owner.setdefault(name, i)
+        refs.append(set( "#" + m for line in block for m in p_label_ref.findall(line) ) - defined)
+
+    def falls_through(i):
+        last = blocks[i][-1].split(";")[-1] if blocks[i] else ""
+        return not p_block_end.match(last)
+
+    roots = set(PRUNE_ROOTS) | set( k if k.startswith("#") else "#" + k for k in keep )
+    todo  = [ 0 ] + [ owner[name] for name in roots if name in owner ]
+    live  = set()
+    while todo:
+        i = todo.pop()
+        if i in live or i >= len(blocks):
+            continue
+        live.add(i)
+        todo.extend( owner[name] for name in refs[i] if name in owner )
+        if falls_through(i):
+            todo.append(i + 1)
+
+    kept, removed_labels, removed_lines, removed_bytes = [], [], 0, 0
+    for i, block in enumerate(blocks):
+        if i in live:
+            kept.extend(block)
+        else:
+            removed_labels.extend( name for name in p_sub_def.findall(block[0]) )
+            removed_lines += len(block)
+            removed_bytes += sum( len(line) + 1 for line in block )
+
+    if report is not None:
+        report.update(labels=removed_labels, lines=removed_lines, bytes=removed_bytes)
+    return kept
+
+def rename(line, variables=None, labels=None):
+    """
+    Renames variables and labels in a line of galil code. Text in
+    strings is not changed.
+
+    @param variables: dict of old: new variable names
+    @param labels: dict of old: new labels (including the "#")
+    """
+    parts = line.split('"')
+    for i in range(0, len(parts), 2):
+        if variables:
+            parts[i] = p_identifier.sub(lambda m: variables.get(m.group(1), m.group(1)), parts[i])
+        if labels:
+            parts[i] = p_label_ref.sub(lambda m: labels.get(m.group(0), m.group(0)), parts[i])
+    return '"'.join(parts)
+
+def short_names():
+    """Identifiers in order of length: a, b, ..., z, aa, a0, ..."""
+    first, rest = "abcdefghijklmnopqrstuvwxyz", "abcdefghijklmnopqrstuvwxyz0123456789"
+    for length in itertools.count(1):
+        for chars in itertools.product(first, *([rest] * (length - 1))):
+            yield "".join(chars)
+
+def shorten_lines(lines, keep=(), symbols=None):
+    """
+    Renames the variables assigned (or declared with C{DM}) and labels
+    defined in compacted lines (see L{compact_lines}) to the shortest
+    identifiers not otherwise used in the program, most used names
+    first. Names in L{KEEP_NAMES}, automatic subroutines (see
+    L{PRUNE_ROOTS}) and C{keep} (variable names or labels) are not
+    renamed.
+
+    Returns the list of renamed lines. If C{symbols} (a dict) is given,
+    it receives the "variables" and "labels" maps (old name: new name).
+    """
+    lines = list(lines)
+    keep  = set(keep) | KEEP_NAMES | PRUNE_ROOTS
+    keep |= set( "#" + k for k in keep if not k.startswith("#") )
+
+    used_names, used_labels = collections.Counter(), collections.Counter()
+    defined_vars, defined_labels = set(), set()
+    for line in lines:
+        for i, part in enumerate(line.split('"')):
+            if i % 2 == 0:
+                used_names.update(p_identifier.findall(part))
+                used_labels.update( "#" + m for m in p_label_ref.findall(part) )
+        defined_vars.update(p_var_assign.findall(line))
+        for decl in p_dm.findall(line):
+            defined_vars.update( item.strip().split("[")[0] for item in decl.split(",") )
+        defined_labels.update(p_sub_def.findall(line))
+
+    def assign(candidates, used, prefix):
+        mapping, names = dict(), short_names()
+        new = None
+        for old in sorted(candidates, key=lambda x: (-used[x], x)):
+            while new is None or new in used:
+                new = prefix + next(names)
+            if len(new) < len(old):
+                mapping[old] = new
+                new = None
+        return mapping
+
+    variables = assign([ v for v in defined_vars if v not in keep and p_identifier.match(v) ], used_names, "")
+    labels    = assign([ l for l in defined_labels if l not in keep ], used_labels, "#")
+
+    if symbols is not None:
+        symbols.update(variables=variables, labels=labels)
+    return [ rename(line, variables, labels) for line in lines ]
+
+def minify_lines(lines, line_length=79, prune=False, keep=(), report=None, shorten=False, symbols=None):
+    """
+    Minifies galil code given as an iterable of lines. Returns an
+    iterator over output lines (see L{minify}).
+
+    The optional passes read the whole program before producing output:
+    if C{prune} is true, unreachable code is removed (see
+    L{prune_lines}), if C{shorten} is true, variables and labels are
+    renamed (see L{shorten_lines}).
+    """
+    lines = compact_lines(lines)
+    if prune:
+        lines = prune_lines(lines, keep, report)
+    if shorten:
+        lines = shorten_lines(lines, keep, symbols)
+    return squash_labels(join_lines(lines, line_length), line_length)
+
+def minify(content, line_length=79, prune=False, keep=(), report=None, shorten=False, symbols=None):
+    """
+    Performs minification on a galil file. Actions performed:
+
+       - Strips all comments
+       - trims space after semicolon and before/after various ops (" = ", "IF (...)")
+       - Merges "simple" lines (up to line_length)
+       - Optionally removes unreachable subroutines (see L{prune_lines})
+       - Optionally shortens variable and label names (see L{shorten_lines})
+    """
+    return "\n".join(minify_lines(content.split("\n"), line_length, prune, keep, report, shorten, symbols))
+
+
+def lint_lines(lines, line_length=79, warnings=False):
+    """
+    Lint checks (see L{lint}) over an iterable of minified lines.
+    Returns a list of error strings.
+    """
+    errors = []
+    if_js = []
+    window = collections.deque(maxlen=3)    # p_if_js spans at most 3 lines
+    subs        = set()
+    sub_line    = {}
+    sub_arity   = {}
+    sub_neg1_dflt = set(("#ok", "#error"))
+    JSP_sub     = set()
+    JSP_line    = collections.defaultdict(list)
+
+    lineno = 0
+    for line in lines:
+        lineno += 1
+
+        if warnings:
+            # Only report matches ending on this line, earlier ones were
+            # seen in previous windows
+            window.append(line)
+            text = "\n".join(window)
+            for m in p_if_js.finditer(text):
+                if m.end() > len(text) - len(line):
+                    if_js.append( "IF(...);{} better written as {},(...)".format(m.group(1), m.group(1)) )
+
+        # presence of None
+        if "None" in line:
+            errors.append( "line {}, Contains 'None', check template vars: {}".format(lineno, line) )
+
+        # long lines
+        if len(line) > line_length:
+            errors.append( "line {}, Line too long: {}".format(lineno, line) )
+
+        # Bad operators
+        if p_bad_ops.search(line):
+            errors.append( "line {}, bad operator: {}".format(lineno, line) )
+
+        # for duplicate labels
+        for name in p_sub_def.findall(line):
+            if name in subs:
+                errors.append( "line {}, Duplicate label: {}".format(lineno, name) )
+            else:
+                subs.add(name)
+                sub_line[name] = lineno
+
+        # examine subroutine arguments (JS, JP)
+        # also for unused labels and jumps to non-existant labels
+        for name, arg in p_sub_arg.findall(line):
+            # Note: arg includes "()"
+            JSP_sub.add(name)
+            JSP_line[name].append(lineno)
+            args = [] if len(arg) < 3 else arg.split(',')
+
+            if name in sub_neg1_dflt and arg == "(-1)":
+                # Make exception for #ok and #error
+                pass
+            elif name in sub_arity:
+                if len(args) != sub_arity[name]:
+                    errors.append( "line {}, inconsistent sub arity for {}. Was {} now {}".format(lineno, name, sub_arity[name], len(args)) )
+            else:
+                sub_arity[name] = len(args)
+
+            if p_JS.search(arg):
+                errors.append( "line {}, _JS used in subroutine argument: {}".format(lineno, line) )
+            if p_danger_arg.search(arg):
+                errors.append( "line {}, Dangerous value (calculation) used in argument: {}".format(lineno, line) )
+
+        for cmd in line.split(";"):
+            # long strings
+            if not pc_MG.search(cmd):
+                strings = cmd.split('"')
+                for idx in (x for x in xrange(1, len(strings), 2) if len(strings[x]) > 5):
+                    errors.append( "line {}, Long string '{}' in command: {}".format(lineno, strings[idx], cmd) )
+
+    # jumps to non-existant labels
+    for sub in JSP_sub - subs:
+        errors.append( "line(s) {}, J[SP]{} found but label {} not defined".format(JSP_line[sub], sub, sub) )
+
+    if warnings:
+        # unused labels
+        for sub in subs - JSP_sub - AUTO_subs:
+            errors.append( "line {}, Label {} defined but never used".format(sub_line[sub], sub) )
+
+    return if_js + errors
+
+def lint(content, line_length=79, warnings=False):
+    """
+    Performs a lint check on (unminified or minified) galil code. See
+    L{GalilFile.lint}.
+    """
+    return lint_lines(minify_lines(content.split("\n"), line_length), line_length, warnings)
+
+
+def analyze_lines(lines):
+    """
+    Resource usage of a program (as it will be downloaded, usually
+    minified) given as an iterable of lines. Empty lines are ignored.
+    Returns a dictionary:
+
+        lines:           number of lines
+        line_length:     longest line length
+        labels:          number of labels
+        variables:       number of distinct variables assigned
+        arrays:          number of arrays declared (C{DM})
+        array_elements:  total declared array elements (known sizes only)
+        unsized_arrays:  names of arrays whose size is not a literal
+        threads:         number of threads used (highest C{XQ} thread + 1)
+    """
+    nr_lines = line_length = 0
+    labels, variables, arrays, unsized = set(), set(), dict(), set()
+    max_thread = 0
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if not line:
+            continue
+        nr_lines += 1
+        line_length = max(line_length, len(line))
+        labels.update(p_sub_def.findall(line))
+        variables.update(p_var_assign.findall(line))
+        for decl in p_dm.findall(line):
+            for item in decl.split(","):
+                m = p_dm_array.match(item.strip())
+                if m:
+                    arrays[m.group(1)] = int(m.group(2))
+                else:
+                    unsized.add(item.strip().split("[")[0])
+        for thread in p_xq.findall(line):
+            if thread:
+                max_thread = max(max_thread, int(thread))
+
+    variables -= set(arrays) | unsized
+    return dict(
+        lines=nr_lines, line_length=line_length, labels=len(labels), variables=len(variables),
+        arrays=len(arrays) + len(unsized - set(arrays)), array_elements=sum(arrays.values()),
+        unsized_arrays=sorted(unsized - set(arrays)), threads=max_thread + 1,
+    )
+
+def analyze(content):
+    """Analyzes galil code (see L{analyze_lines})"""
+    return analyze_lines(content.split("\n"))
+
+
+def model_limits(model):
+    """
+    Program limits (see L{MODEL_LIMITS}) for a model or controller
+    connection string. Returns None for unknown models.
+    """
+    model = re.sub(r'[^A-Z0-9]', '', (model or "").split(",")[0].upper())
+    best = None
+    for prefix in MODEL_LIMITS:
+        if model.startswith(prefix) and (best is None or len(prefix) > len(best)):
+            best = prefix
+    return MODEL_LIMITS[best] if best else None
+
+def check_limits(analysis, limits):
+    """
+    Compares an analysis (see L{analyze_lines}) against limits (a dict
+    or a model name, see L{model_limits}). Returns a list of error
+    strings, empty if the program fits.
+    """
+    if not isinstance(limits, dict):
+        limits = model_limits(limits)
+    errors = []
+    for key in ("lines", "line_length", "labels", "variables", "arrays", "array_elements", "threads"):
+        if limits and key in limits and analysis[key] > limits[key]:
+            errors.append( "Program {} {} exceeds limit {}".format(key.replace("_", " "), analysis[key], limits[key]) )
+    return errors
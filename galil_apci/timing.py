@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Build stage profiling
+
+A L{StageProfiler} times named stages (render, minify, lint, ...) of
+each file of a batch build and counts the lines each stage produced.
+While L{StageProfiler.count_regexes} is active, evaluations of the
+module level regular expressions (and C{re} module calls) of the given
+modules are counted too. L{StageProfiler.report} aggregates everything
+into a JSON-serializable dict.
+
+Used by C{dmctool --profile}.
+"""
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function
+__all__ = 'StageProfiler'.split()
+
+import collections
+import json
+import re
+import time
+
+from contextlib import contextmanager
+
+PATTERN_METHODS = 'match search sub subn split findall finditer fullmatch'.split()
+PATTERN_TYPE = type(re.compile(""))
+
+
+class CountingPattern(object):
+    """Compiled pattern stand-in which counts calls of its matching methods"""
+    def __init__(self, pattern, name, counter):
+        self._pattern = pattern
+        for method in PATTERN_METHODS:
+            if hasattr(pattern, method):
+                setattr(self, method, self._counted(getattr(pattern, method), name, counter))
+
+    @staticmethod
+    def _counted(fn, name, counter):
+        def counted(*args, **kwargs):
+            counter[name] += 1
+            return fn(*args, **kwargs)
+        return counted
+
+    def __getattr__(self, name):
+        return getattr(self._pattern, name)
+
+
+class CountingRe(object):
+    """C{re} module stand-in which counts calls by function and pattern"""
+    def __init__(self, module, counter):
+        self._module = module
+        for method in PATTERN_METHODS:
+            if hasattr(module, method):
+                setattr(self, method, self._counted(getattr(module, method), method, counter))
+
+    @staticmethod
+    def _counted(fn, method, counter):
+        def counted(pattern, *args, **kwargs):
+            counter["re.{}({})".format(method, getattr(pattern, 'pattern', pattern))] += 1
+            return fn(pattern, *args, **kwargs)
+        return counted
+
+    def __getattr__(self, name):
+        return getattr(self._module, name)
+
+
+class Stage(object):
+    __slots__ = 'time calls lines'.split()
+
+    def __init__(self):
+        self.time, self.calls, self.lines = 0.0, 0, 0
+
+    def as_dict(self):
+        return dict(time=self.time, calls=self.calls, lines=self.lines)
+
+
+class StageProfiler(object):
+    """
+    @param enabled: If false, all methods are (nearly free) no-ops so
+        that build code may be instrumented unconditionally.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.files   = collections.OrderedDict()
+        self.current = None
+        self.regex   = collections.Counter()
+
+    @contextmanager
+    def file(self, name):
+        """Stages timed within this context are attributed to file C{name}"""
+        if not self.enabled:
+            yield
+            return
+        self.current = self.files.setdefault(name, collections.OrderedDict())
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.current.setdefault("total", Stage())
+            self.current["total"].time += time.time() - t0
+            self.current["total"].calls += 1
+            self.current = None
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times a stage. The context value is a list; append the stage
+        output to it to count the lines produced.
+        """
+        out = []
+        if not self.enabled or self.current is None:
+            yield out
+            return
+        stage = self.current.setdefault(name, Stage())
+        t0 = time.time()
+        try:
+            yield out
+        finally:
+            stage.time  += time.time() - t0
+            stage.calls += 1
+            for res in out:
+                stage.lines += count_lines(res)
+
+    @contextmanager
+    def count_regexes(self, *modules):
+        """
+        Counts regular expression evaluations of the given modules:
+        module level compiled patterns are counted by name, calls of the
+        module's C{re} functions by pattern.
+        """
+        if not self.enabled:
+            yield
+            return
+        saved = []
+        for module in modules:
+            for name, value in list(vars(module).items()):
+                if isinstance(value, PATTERN_TYPE):
+                    saved.append((module, name, value))
+                    setattr(module, name, CountingPattern(value, "{}.{}".format(module.__name__, name), self.regex))
+                elif value is re:
+                    saved.append((module, name, value))
+                    setattr(module, name, CountingRe(re, self.regex))
+        try:
+            yield
+        finally:
+            for module, name, value in saved:
+                setattr(module, name, value)
+
+    def slowest(self):
+        """Name of the file with the largest total time (or None)"""
+        totals = [ (stages["total"].time, name) for name, stages in self.files.items() if "total" in stages ]
+        return max(totals)[1] if totals else None
+
+    def report(self):
+        stages = collections.OrderedDict()
+        for name, file_stages in self.files.items():
+            for stage, st in file_stages.items():
+                agg = stages.setdefault(stage, dict(time=0.0, calls=0, lines=0, max_time=0.0, max_file=None))
+                agg['time']  += st.time
+                agg['calls'] += st.calls
+                agg['lines'] += st.lines
+                if st.time > agg['max_time']:
+                    agg['max_time'], agg['max_file'] = st.time, name
+        return dict(
+            files=collections.OrderedDict(
+                (name, collections.OrderedDict( (stage, st.as_dict()) for stage, st in file_stages.items() ))
+                for name, file_stages in self.files.items()
+            ),
+            stages=stages,
+            regex=dict(self.regex),
+            regex_total=sum(self.regex.values()),
+            slowest=self.slowest(),
+        )
+
+    def write(self, path):
+        with open(path, 'w') as fh:
+            json.dump(self.report(), fh, indent=2)
+            fh.write("\n")
+
+
+def count_lines(content):
+    if content is None:
+        return 0
+    if isinstance(content, (list, tuple)):
+        return len(content)
+    if isinstance(content, bytes):
+        return content.count(b"\n") + 1 if content else 0
+    return content.count("\n") + 1 if content else 0
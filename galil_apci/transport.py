@@ -0,0 +1,528 @@
+# -*- coding: utf-8 -*-
+"""
+Controller transports
+
+A L{Galil} object sends its traffic through a transport object. Any
+object providing the methods of the vendor library C{Galil.Galil} which
+are used by this package may be a transport:
+
+    - C{command(cmd)} -> str, C{commandValue(cmd)} -> float
+    - C{programUpload()} -> str, C{programDownload(program)}
+    - C{connection()} -> str
+    - a read/write C{timeout_ms} attribute
+
+Other library methods (C{record}, C{sourceValue}, C{arrayUpload}, ...)
+are passed through by L{Galil} when the transport provides them.
+L{SocketTransport} provides C{record}, C{arrayUpload} and
+C{arrayDownload}, but not C{sourceValue}: decoding records needs the
+model specific record map of the vendor library (see
+L{galil_apci.datarecord.RecordDecoder} instead).
+
+Transports are registered by name (see L{register_transport}). The
+built-in transports are "swig" (the vendor C{libGalil} binding, when
+installed) and "socket" (L{SocketTransport}, pure Python). The default
+is the first available of the GALIL_APCI_TRANSPORT environment variable,
+"swig" and "socket".
+"""
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function
+__all__ = 'SocketTransport DownloadWriter open_transport register_transport transports'.split()
+
+import collections
+import os
+import re
+import socket
+import time
+
+from . import errors
+
+import logging
+logger = logging.getLogger('galil_apci')
+
+DEFAULT_PORT = 23
+
+ACK, NAK, LF = ord(":"), ord("?"), ord("\n")
+
+# Command acknowledgements (":") at the start of a response line
+p_ack = re.compile(r'^:+', re.M)
+p_quoted = re.compile(r'"[^"]*"')
+p_handle = re.compile(r'IH([A-H])')
+p_values = re.compile(r'[^\s,:]+')
+
+STRIP_MSB = bytes(bytearray( i & 0x7F for i in range(256) ))
+
+# name: factory(address) -> transport
+TRANSPORTS = collections.OrderedDict()
+
+
+def register_transport(name, factory):
+    """
+    Register a transport factory, a callable taking the controller
+    address and returning a connected transport. Factories should raise
+    ImportError if the transport is not available on this system.
+    """
+    TRANSPORTS[name] = factory
+
+def transports():
+    """Names of the registered transports"""
+    return list(TRANSPORTS)
+
+def open_transport(address, name=None):
+    """
+    Connects to a controller with the named transport (default: see
+    module documentation).
+    """
+    if name is not None:
+        if name not in TRANSPORTS:
+            raise Exception("Unknown Galil transport '{}'".format(name))
+        return TRANSPORTS[name](address)
+
+    names = list(TRANSPORTS)
+    env = os.environ.get('GALIL_APCI_TRANSPORT')
+    if env:
+        names.insert(0, env)
+    for name in names:
+        try:
+            return open_transport(address, name)
+        except ImportError as err:
+            logger.debug("Galil transport '%s' not available: %s", name, err)
+    raise Exception("No Galil transport available")
+
+
+def swig_transport(address):
+    import Galil as ExternalGalil
+    return ExternalGalil.Galil(str(address))
+
+register_transport("swig", swig_transport)
+
+
+def parse_address(address):
+    """
+    Host and port of a library style address ("10.0.0.2",
+    "10.0.0.2:23", "10.0.0.2 -d"). Library options are ignored.
+    """
+    host = str(address).split()[0] if str(address).strip() else ""
+    if not host:
+        raise Exception("The socket transport requires a controller address")
+    if ":" in host:
+        host, port = host.rsplit(":", 1)
+        return host, int(port)
+    return host, DEFAULT_PORT
+
+
+def count_commands(cmd):
+    """Number of (non-empty) commands in a command line"""
+    return sum( 1 for c in p_quoted.sub('""', cmd).split(";") if c.strip() ) or 1
+
+
+class ResponseBuffer(object):
+    """
+    Receive buffer of a stream handle. Data is received directly into a
+    preallocated buffer (through a C{memoryview}, no per-read
+    allocation) and scanned incrementally for the end of the response.
+    """
+    def __init__(self, size=4096):
+        self.buf  = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.len  = 0
+
+    def recv(self, sock):
+        if self.len == len(self.buf):
+            buf = bytearray(2 * len(self.buf))
+            buf[0:self.len] = self.view[0:self.len]
+            self.buf, self.view = buf, memoryview(buf)
+        n = sock.recv_into(self.view[self.len:])
+        self.len += n
+        return n
+
+    def find(self, sub, start=0):
+        return self.buf.find(sub, start, self.len)
+
+    def take(self, end):
+        """Removes and returns (bytes) the first C{end} bytes"""
+        res = self.view[0:end].tobytes()
+        rest = self.len - end
+        if rest:
+            self.buf[0:rest] = self.view[end:self.len].tobytes()
+        self.len = rest
+        return res
+
+    def clear(self):
+        self.len = 0
+
+
+class AckScanner(object):
+    """
+    Finds the end of the response to C{count} commands: each command is
+    answered by optional data lines followed by ":" (or "?" on error,
+    after which the controller ignores the rest of the line). Scanning
+    resumes where the previous call stopped.
+    """
+    def __init__(self, count):
+        self.count = count
+        self.seen  = 0
+        self.pos   = 0
+
+    def __call__(self, rbuf):
+        buf = rbuf.buf
+        while True:
+            a = rbuf.find(b":", self.pos)
+            q = rbuf.find(b"?", self.pos)
+            i = q if a < 0 or 0 <= q < a else a
+            if i < 0:
+                self.pos = rbuf.len
+                return 0
+            self.pos = i + 1
+            if i and buf[i-1] != LF and buf[i-1] != ACK:
+                continue                    # ":" or "?" within data
+            if buf[i] == NAK:
+                return i + 1
+            self.seen += 1
+            if self.seen == self.count:
+                return i + 1
+
+
+class SocketTransport(object):
+    """
+    Pure-Python transport speaking the DMC ASCII protocol over Ethernet.
+
+    Commands are sent on a TCP handle (with Nagle's algorithm disabled).
+    Unsolicited messages and data records use handles of their own,
+    opened on first use, so that they can never be mistaken for command
+    responses.
+
+    @param address: Controller address (see L{parse_address})
+
+    @param timeout_ms: Response timeout (milliseconds)
+
+    @param nodelay: Set TCP_NODELAY on the command handle
+
+    @param message_protocol: "tcp" or "udp" handle for unsolicited
+        messages (see L{message}).
+
+    @param bufsize: Initial receive buffer size (grown as needed)
+    """
+    def __init__(self, address, timeout_ms=500, nodelay=True, message_protocol="tcp", bufsize=4096):
+        self.address = address
+        self.host, self.port = parse_address(address)
+        self.timeout_ms = timeout_ms
+        self.nodelay = nodelay
+        self.message_protocol = message_protocol
+        self.sock = self.open_handle("tcp")
+        self.rbuf = ResponseBuffer(bufsize)
+        self.stale = False
+        self.msg_sock = None
+        self.dr_sock  = None
+        self.dr_buf   = None
+        self.dr_handle = None
+
+    def open_handle(self, protocol):
+        if protocol == "tcp":
+            sock = socket.create_connection((self.host, self.port), self.timeout_ms / 1000.0)
+            if self.nodelay:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        elif protocol == "udp":
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.settimeout(self.timeout_ms / 1000.0)
+            sock.connect((self.host, self.port))
+        else:
+            raise Exception("Unknown handle protocol '{}'".format(protocol))
+        return sock
+
+    def handle_name(self, sock):
+        """
+        Controller handle letter of a connection (WH answers e.g.
+        "IHB" for handle B).
+        """
+        sock.send(b"WH\r")
+        res = self.read_datagram(sock, "WH") if sock.type == socket.SOCK_DGRAM else self.read_stream(sock, "WH")
+        m = p_handle.search(res.decode('latin-1'))
+        if not m:
+            raise errors.CommandError("Unable to identify controller handle ({!r})".format(res))
+        return m.group(1)
+
+    def close(self):
+        for sock in (self.sock, self.msg_sock, self.dr_sock):
+            if sock is not None:
+                sock.close()
+        self.msg_sock = self.dr_sock = None
+
+    def timeout_error(self, cmd):
+        return errors.TimeoutError("1011 TIMEOUT ERROR.  Galil::command(\"{}\") took longer than {} ms to return".format(cmd, self.timeout_ms))
+
+    def read_response(self, cmd, done):
+        """
+        Reads from the command handle until C{done(rbuf)} returns the
+        length of a complete response. Returns the response (bytes).
+        """
+        rbuf, sock = self.rbuf, self.sock
+        deadline = time.time() + self.timeout_ms / 1000.0
+        while True:
+            end = done(rbuf)
+            if end:
+                return rbuf.take(end)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self.stale = True
+                raise self.timeout_error(cmd)
+            sock.settimeout(remaining)
+            try:
+                n = rbuf.recv(sock)
+            except socket.timeout:
+                continue
+            if not n:
+                self.stale = True
+                raise errors.TimeoutError("Connection to {} closed".format(self.address))
+
+    def read_stream(self, sock, cmd):
+        """Single response on an auxiliary TCP handle"""
+        rbuf, scan = ResponseBuffer(256), AckScanner(1)
+        sock.settimeout(self.timeout_ms / 1000.0)
+        while not scan(rbuf):
+            try:
+                if not rbuf.recv(sock):
+                    break
+            except socket.timeout:
+                raise self.timeout_error(cmd)
+        return rbuf.take(rbuf.len)
+
+    def read_datagram(self, sock, cmd):
+        sock.settimeout(self.timeout_ms / 1000.0)
+        try:
+            return sock.recv(2048)
+        except socket.timeout:
+            raise self.timeout_error(cmd)
+
+    def flush(self):
+        """Discards late responses to timed out commands"""
+        self.rbuf.clear()
+        self.sock.settimeout(0)
+        try:
+            while self.sock.recv(4096):
+                pass
+        except (socket.error, socket.timeout):
+            pass
+        self.stale = False
+
+    def send(self, cmd, data=None):
+        if self.stale:
+            self.flush()
+        self.sock.settimeout(self.timeout_ms / 1000.0)
+        try:
+            self.sock.sendall(data if data is not None else (cmd + "\r").encode('latin-1'))
+        except socket.timeout:
+            raise self.timeout_error(cmd)
+
+    def command(self, cmd):
+        """Send a command, return its response with whitespace and ":" removed"""
+        self.send(cmd)
+        res = self.read_response(cmd, AckScanner(count_commands(cmd)))
+        if res.endswith(b"?"):
+            raise errors.CommandError("{} returned ? {}".format(cmd, self.error_text()))
+        return p_ack.sub("", res.decode('latin-1')).strip()
+
+    def error_text(self):
+        try:
+            self.send("TC1")
+            return self.read_response("TC1", AckScanner(1)).decode('latin-1').rstrip(":").strip()
+        except errors.TimeoutError:
+            return ""
+
+    def commandValue(self, cmd):
+        return float(self.command(cmd))
+
+    def connection(self):
+        return "{}, {}".format(self.address, self.command("\x12\x16"))
+
+    @staticmethod
+    def upload_end(rbuf):
+        """Program text is terminated by ^Z, then acknowledged"""
+        eof = rbuf.find(b"\x1a")
+        if eof < 0:
+            return 0
+        ack = rbuf.find(b":", eof)
+        return ack + 1 if ack >= 0 else 0
+
+    def programUpload(self):
+        self.send("UL;")
+        res = self.read_response("UL", self.upload_end)
+        res = res[0:res.find(b"\x1a")].decode('latin-1')
+        return res.replace("\r\n", "\n").replace("\r", "\n").rstrip("\n")
+
+    def programDownload(self, program):
+        writer = self.programDownloadStart()
+        for line in program.replace("\r\n", "\n").replace("\r", "\n").rstrip("\n").split("\n"):
+            writer.write(line)
+        writer.close()
+
+    def arrayUpload(self, name):
+        """Values (floats) of an array (C{QU})"""
+        size = int(self.commandValue("MG{}[-1]".format(name)))
+        if size <= 0:
+            return []
+        res = self.command("QU{}[],0,{},1".format(name, size - 1))
+        return [ float(x) for x in p_values.findall(res) ]
+
+    def arrayDownload(self, values, name):
+        """Sets the first C{len(values)} elements of an array (C{QD})"""
+        values = list(values)
+        if not values:
+            return
+        data = ",".join( "{:.4f}".format(v) for v in values )
+        self.send("QD{}[],0,{}".format(name, len(values) - 1))
+        self.send("QD", (data + "\\").encode('latin-1'))
+        res = self.read_response("QD", AckScanner(1))
+        if res.endswith(b"?"):
+            raise errors.CommandError("QD{}[] returned ? {}".format(name, self.error_text()))
+
+    def programDownloadStart(self):
+        """
+        Starts a program download, returning a L{DownloadWriter} which
+        sends the program line by line.
+        """
+        self.send("DL")
+        return DownloadWriter(self)
+
+    def message(self, timeout_ms=500):
+        """
+        Unsolicited controller output (MG from a program, error
+        messages) received within C{timeout_ms} milliseconds. The first
+        call opens the message handle and directs messages to it (CF).
+        """
+        if self.msg_sock is None:
+            sock = self.open_handle(self.message_protocol)
+            self.command("CF" + self.handle_name(sock))
+            self.msg_sock = sock
+        chunks = []
+        deadline = time.time() + timeout_ms / 1000.0
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            self.msg_sock.settimeout(remaining)
+            try:
+                data = self.msg_sock.recv(2048)
+            except socket.timeout:
+                break
+            if not data:
+                break
+            chunks.append(data)
+            if data.endswith(b"\n"):
+                break
+        # unsolicited output may have the high bit set (CW1)
+        return b"".join(chunks).translate(STRIP_MSB).decode('latin-1')
+
+    def records_handle(self):
+        if self.dr_sock is None:
+            sock = self.open_handle("udp")
+            self.dr_handle = self.handle_name(sock)
+            self.dr_sock = sock
+            self.dr_buf = bytearray(2048)
+        return self.dr_sock
+
+    def recordsStart(self, period_ms=-1, samples=None):
+        """
+        Streams data records (DR) to the record handle every
+        C{period_ms} milliseconds (0 stops streaming), or every
+        C{samples} samples if given.
+        """
+        self.records_handle()
+        if samples is None and period_ms > 0:
+            samples = max(1, int(round(1000.0 * period_ms / abs(self.commandValue("MG_TM")))))
+        if not samples or samples < 0:
+            self.command("DR0")
+            return
+        self.command("DR{},{}".format(samples, "ABCDEFGH".index(self.dr_handle)))
+
+    def record(self, method="QR"):
+        """
+        Raw data record (bytes). "QR" queries a record on the command
+        handle, "DR" returns the next streamed record (see
+        L{recordsStart}). Decoding records (C{sourceValue}) requires the
+        model specific record map of the vendor library.
+        """
+        if method == "DR":
+            sock = self.records_handle()
+            sock.settimeout(self.timeout_ms / 1000.0)
+            try:
+                n = sock.recv_into(self.dr_buf)
+            except socket.timeout:
+                raise self.timeout_error("DR")
+            return bytes(self.dr_buf[0:n])
+        self.send("QR")
+        res = self.read_response("QR", record_end)
+        if res.endswith(b"?"):
+            raise errors.CommandError("QR returned ? {}".format(self.error_text()))
+        return res[0:-1]
+
+
+class DownloadWriter(object):
+    """
+    Sends program lines of a download (see
+    L{SocketTransport.programDownloadStart}) in blocks of about
+    C{blocksize} bytes, finishing the download on L{close}.
+    """
+    def __init__(self, transport, blocksize=1024):
+        self.transport = transport
+        self.blocksize = blocksize
+        self.buf = bytearray()
+        self.sent = 0
+
+    def write(self, line):
+        self.buf += line.encode('latin-1') + b"\r"
+        if len(self.buf) >= self.blocksize:
+            self.transport.send("DL", bytes(self.buf))
+            self.sent += len(self.buf)
+            del self.buf[:]
+
+    def close(self):
+        t = self.transport
+        t.send("DL", bytes(self.buf) + b"\\")
+        del self.buf[:]
+        res = t.read_response("DL", AckScanner(1))
+        if res.endswith(b"?"):
+            raise errors.CommandError("DL returned ? {}".format(t.error_text()))
+
+    def abort(self):
+        """
+        Ends the download without sending the buffered lines. If lines
+        were already sent, an empty program is downloaded in place of
+        the incomplete one. Responses are ignored.
+        """
+        t = self.transport
+        del self.buf[:]
+        logger.warning("Program download to %s aborted, the controller program is erased", t.address)
+        try:
+            t.send("DL", b"\\")
+            t.read_response("DL", AckScanner(1))
+            if self.sent:
+                t.send("DL", b"DL\r\\")
+                t.read_response("DL", AckScanner(1))
+        except (errors.CommandError, errors.TimeoutError, socket.error) as err:
+            logger.warning("Unable to end aborted download: %s", err)
+
+
+def record_end(rbuf):
+    """QR response: a binary record (length in header bytes 2-3) and ":" """
+    if rbuf.len and rbuf.buf[0] == NAK:
+        return 1
+    if rbuf.len < 4:
+        return 0
+    size = rbuf.buf[2] | (rbuf.buf[3] << 8)
+    return size + 1 if rbuf.len > size else 0
+
+
+register_transport("socket", SocketTransport)
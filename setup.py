@@ -40,7 +40,7 @@ setup(
     packages     = [ 'galil_apci' ],
     py_modules   = [ 'Galil' ],
     ext_modules  = [ galil_module ],
-    scripts      = [ 'bin/dmctool' ],
+    scripts      = [ 'bin/dmctool', 'bin/galilbackup', 'bin/galilproxy' ],
     provides     = "galil_apci",
     requires     = [ "jinja2_apci", ],
 )
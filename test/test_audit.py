@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function
+import unittest2
+
+import sys
+from os.path import dirname, abspath, join
+sys.path.insert(1, dirname(dirname(abspath(__file__))))
+
+import csv
+import json
+import shutil
+import tempfile
+import threading
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from galil_apci.audit import audit_fleet, write_report
+from galil_apci.errors import CommandError
+
+
+class FakeGalil(object):
+    """Answers packed "KPA=?;..." queries from a dict of values"""
+    max_line_length = 80
+
+    def __init__(self, values):
+        self.values = values
+        self.closed = False
+
+    def command(self, cmd):
+        if self.values is None:
+            raise CommandError("1 Unrecognized command")
+        return " ".join( self.values[q[:-2]] for q in cmd.split(";") )
+
+    def close(self):
+        self.closed = True
+
+
+class Audit(unittest2.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.template = join(self.root, "axis.cfg")
+        open(self.template, "w").write("KPA=6.5\nKDA=10\n")
+
+        self.controllers = {
+            "10.0.0.1": dict(KPA="6.5", KDA="10.0000"),
+            "10.0.0.2": dict(KPA="7.0", KDA="10"),
+            "10.0.0.3": None,
+        }
+        self.opened = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def connect(self, address):
+        if address == "10.0.0.4":
+            raise Exception("No route to host")
+        galil = FakeGalil(self.controllers[address])
+        with self.lock:
+            self.opened.append(galil)
+        return galil
+
+    def test_fleet(self):
+        inventory = [ dict(address=a, template=self.template) for a in sorted(self.controllers) + ["10.0.0.4"] ]
+        seen = []
+        results = audit_fleet(inventory, workers=4, connect=self.connect, callback=seen.append)
+
+        self.assertEqual([ r['address'] for r in results ], [ e['address'] for e in inventory ])
+        self.assertEqual(len(seen), 4)
+        self.assertEqual([ r['status'] for r in results ], ["ok", "drift", "error", "error"])
+        self.assertEqual(results[1]['changes'], [dict(cmd="KPA", filename=self.template, lineno=1, expected="6.5", actual="7.0")])
+        self.assertEqual(results[3]['error'], "connect: No route to host")
+        self.assertEqual(len(self.opened), 3)
+        self.assertTrue(all( g.closed for g in self.opened ))
+
+        fh = StringIO()
+        write_report(results, fh)
+        report = json.loads(fh.getvalue())
+        self.assertEqual([ c['status'] for c in report['controllers'] ], ["ok", "drift", "error", "error"])
+
+        fh = StringIO()
+        write_report(results, fh, format='csv')
+        rows = list(csv.reader(StringIO(fh.getvalue())))
+        self.assertEqual(rows[0][0:3], ["address", "template", "status"])
+        self.assertEqual([ (r[0], r[2], r[4]) for r in rows[1:] ],
+                         [ ("10.0.0.1", "ok", ""), ("10.0.0.2", "drift", "KPA"),
+                           ("10.0.0.3", "error", ""), ("10.0.0.4", "error", "") ])
+
+
+if __name__ == '__main__':
+    unittest2.main()
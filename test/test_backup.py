@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function
+import unittest2
+
+import sys
+from os.path import dirname, abspath
+sys.path.insert(1, dirname(dirname(abspath(__file__))))
+
+import shutil
+import tempfile
+import time
+
+import galil_apci.backup
+from galil_apci.backup import BackupStore, backup_controller, normalize
+
+
+class FrozenTime(object):
+    """time module stand-in with a fixed clock"""
+    gmtime   = staticmethod(time.gmtime)
+    strftime = staticmethod(time.strftime)
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class FakeGalil(object):
+    address = "10.0.0.5"
+
+    def __init__(self, program, board_hash=None, program_ok=1):
+        self.program = program
+        self.board_hash = board_hash
+        self.program_ok = program_ok
+        self.uploads = 0
+
+    def get(self, key, dflt=None):
+        return self.program_ok if key == "xPrgOK" else dflt
+
+    def getBoardProgramHash(self):
+        return self.board_hash
+
+    def programUpload(self):
+        self.uploads += 1
+        return self.program
+
+    def arrayUpload(self, name):
+        return [ 1.0, 2.5, 3.0 ]
+
+
+class Backup(unittest2.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = BackupStore(self.root, compression='gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_normalize(self):
+        self.assertEqual(normalize("#AUTO \r\nEN\t\r\n\r\n"), b"#AUTO\nEN\n")
+        self.assertEqual(normalize(""), b"")
+
+    def test_dedup(self):
+        galil = FakeGalil("#AUTO\r\nEN\r\n")
+        path1, stats = backup_controller(galil, self.store, arrays=["data"])
+        self.assertEqual((stats['items'], stats['changed']), (2, 2))
+        self.assertGreater(stats['written'], 0)
+
+        path2, stats = backup_controller(galil, self.store, arrays=["data"])
+        self.assertEqual((stats['items'], stats['changed'], stats['written']), (2, 0, 0))
+        self.assertEqual(self.store.manifest(path1)['items'], self.store.manifest(path2)['items'])
+        self.assertEqual(self.store.get(self.store.latest(galil.address)['items']['array/data']), b"1\n2.5\n3\n")
+
+        galil.program = "#AUTO\nMG 1\nEN\n"
+        backup_controller(galil, self.store)
+        diff = "".join(self.store.diff(-2, -1, galil.address))
+        self.assertIn("+MG 1\n", diff)
+        self.assertIn("--- a/array/data", diff)
+
+    def test_skip_upload(self):
+        galil = FakeGalil("#AUTO\nEN\n", board_hash="$12345678.0000")
+        backup_controller(galil, self.store)
+        # opt-in only: another tool may have downloaded a program
+        path, stats = backup_controller(galil, self.store)
+        self.assertFalse(stats['upload_skipped'])
+        self.assertEqual(galil.uploads, 2)
+
+        path, stats = backup_controller(galil, self.store, skip_unchanged=True)
+        self.assertTrue(stats['upload_skipped'])
+        self.assertEqual(galil.uploads, 2)
+
+        galil.program_ok = 0
+        path, stats = backup_controller(galil, self.store, skip_unchanged=True)
+        self.assertFalse(stats['upload_skipped'])
+        self.assertEqual(galil.uploads, 3)
+
+    def test_manifest_names(self):
+        saved = galil_apci.backup.time
+        try:
+            galil_apci.backup.time = FrozenTime(1476000000.9996)
+            paths = [ self.store.commit("10.0.0.5", dict(n=str(i))) for i in range(3) ]
+        finally:
+            galil_apci.backup.time = saved
+        self.assertEqual(self.store.snapshots("10.0.0.5"), paths)
+        self.assertTrue(paths[0].endswith("T080000.999.json"))
+        self.assertEqual(self.store.latest("10.0.0.5")['items'], dict(n="2"))
+
+
+if __name__ == '__main__':
+    unittest2.main()
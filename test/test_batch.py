@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function
+import unittest2
+
+import sys
+from os.path import dirname, abspath
+sys.path.insert(1, dirname(dirname(abspath(__file__))))
+
+from galil_apci.galil import Galil
+
+
+class FakeTransport(object):
+    timeout_ms = 500
+
+    def __init__(self):
+        self.commands = []
+
+    def command(self, cmd):
+        self.commands.append(cmd)
+        return ""
+
+
+class Batch(unittest2.TestCase):
+    def setUp(self):
+        self.transport = FakeTransport()
+        self.galil = Galil("fake", transport=self.transport)
+
+    def test_collapse(self):
+        with self.galil.batch() as b:
+            self.galil.SB(1, 2)
+            self.galil.CB(2)
+            self.galil.TB(3, 0)
+            self.galil.set(xMode=1)
+            self.galil["xMode"] = 2
+            self.galil.set(xName="abc")
+            self.assertEqual(self.transport.commands, [])
+        self.assertEqual(self.transport.commands, ['SB1;CB2;CB3;xMode=2;xName="abc"'])
+        self.assertEqual(b.sent, self.transport.commands)
+        self.assertEqual(b.stats['collapsed'], 2)
+
+    def test_last_write_wins(self):
+        with self.galil.batch() as b:
+            self.galil.set(xMode=1)
+            self.galil.SB(2)
+            self.galil.CB(2)
+            self.galil.CB(4)
+            self.galil.SB(4)
+        # bits first, in order of first write, with their final values
+        self.assertEqual(self.transport.commands, ["CB2;SB4;xMode=1"])
+        self.assertEqual(b.stats['collapsed'], 2)
+
+    def test_explicit(self):
+        with self.galil.batch(autoflush=False) as b:
+            self.galil.SB(1)
+            self.assertEqual(b.flush(), ["SB1"])
+            self.galil.SB(2)
+        self.assertEqual(self.transport.commands, ["SB1"])
+        self.galil.SB(3)
+        self.assertEqual(self.transport.commands, ["SB1", "SB3"])
+
+    def test_error(self):
+        with self.assertRaises(ValueError):
+            with self.galil.batch():
+                self.galil.SB(1)
+                raise ValueError("oops")
+        self.assertEqual(self.transport.commands, [])
+        self.assertIsNone(self.galil.write_batch)
+
+
+if __name__ == '__main__':
+    unittest2.main()
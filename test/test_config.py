@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function, unicode_literals
+import unittest2
+
+import sys
+from os.path import dirname, abspath
+sys.path.insert(1, dirname(dirname(abspath(__file__))))
+
+from galil_apci.config import CONFIG_PARSERS, GalilConfig, parse_lines
+from galil_apci.galil import Galil
+from galil_apci.parameters import Parameter
+
+SAMPLE = """#config
+REM comment
+SIA=1,2,3,4<5>6
+KPA=6.5
+TL=9.998,9.998
+BA AB
+SB 3
+CB4
+AQ 1,2
+CN 1,-1,-1,0,1
+LZ 0
+SM 255,255,255,0
+MW 1
+SHA
+MO
+
+EN
+"""
+
+class ConfigLoad(unittest2.TestCase):
+    def test_single_match(self):
+        # Single-regex dispatch must agree with trying each parser in turn
+        for lineno, line, idx, kwargs in parse_lines(SAMPLE.splitlines()):
+            for i, (pat, cls) in enumerate(CONFIG_PARSERS):
+                m = pat.match(line)
+                if m:
+                    self.assertEqual((i, m.groupdict()), (idx, kwargs), line)
+                    break
+
+    def test_loads(self):
+        conf = GalilConfig(None, axes="AB").loads(SAMPLE, "sample.cfg")
+        self.assertEqual([ str(x) for x in conf.lines ][2:6], ["SIA=1,2,3,4<5>6", "KPA=6.5", "TL=9.998,9.998", "BA AB"])
+        self.assertEqual(conf.lines[3].lineno, 4)
+        self.assertEqual(conf.lines[3].filename, "sample.cfg")
+
+        with self.assertRaisesRegexp(Exception, "Unparsable setting in bad.cfg line 2: 'XX YY'"):
+            GalilConfig(None).loads("MO\nXX YY\n", "bad.cfg")
+
+    def test_columnar(self):
+        rows = GalilConfig(None, axes="AB").loads(SAMPLE, "sample.cfg").lines
+        cols = GalilConfig(None, axes="AB", columnar=True).loads(SAMPLE, "sample.cfg").lines
+        self.assertEqual(len(rows), len(cols))
+        for row, col in zip(rows, cols):
+            self.assertEqual(type(row), type(col))
+            self.assertEqual(str(row), str(col))
+            if isinstance(row, Parameter):
+                self.assertEqual((row.filename, row.lineno), (col.filename, col.lineno))
+
+        item = cols[3]
+        item.value = "7"
+        cols[3] = item
+        self.assertEqual(str(cols[3]), "KPA=7")
+
+
+class FakeTransport(object):
+    """Controller state for packed queries, MG reads and sets; KD writes are ignored"""
+    timeout_ms = 500
+
+    def __init__(self):
+        self.state = { "KPA": "6", "KDA": "9", "_LZ": "0", "@OUT[3]": "0" }
+        self.sent  = []
+
+    def command(self, line):
+        self.sent.append(line)
+        out = []
+        for cmd in line.split(";"):
+            if cmd.endswith("=?"):
+                out.append(self.state[cmd[:-2]])
+            elif cmd.startswith("MG"):
+                out.extend( self.state[e] for e in cmd[2:].split(",") )
+            elif cmd.startswith("KP"):
+                self.state[cmd[0:3]] = cmd[4:]
+            elif cmd.startswith("SB"):
+                self.state["@OUT[{}]".format(cmd[2:])] = "1"
+        return " ".join(out)
+
+
+class ConfigApply(unittest2.TestCase):
+    CONFIG = "MO\nKPA=6.5\nKDA=10\nLZ 0\nSB 3\nSHA\n"
+
+    def setUp(self):
+        self.transport = FakeTransport()
+        self.galil = Galil("fake", transport=self.transport)
+        self.conf = GalilConfig(self.galil, axes="A").loads(self.CONFIG, "apply.cfg")
+
+    def test_dry_run(self):
+        plan = self.conf.apply(dry_run=True)
+        self.assertEqual(plan['commands'], ["KPA=6.5", "KDA=10", "SB3"])
+        self.assertEqual(plan['lines'], ["KPA=6.5;KDA=10;SB3"])
+        self.assertEqual([ curr for item, curr in plan['changes'] ], ["6", "9", 0])
+        self.assertEqual([ item.cmd for item in plan['skipped'] ], ["MO", "SHA"])
+        self.assertNotIn("failed", plan)
+        self.assertFalse(any( "=" in line and "?" not in line for line in self.transport.sent ))
+
+    def test_apply(self):
+        plan = self.conf.apply()
+        self.assertIn("KPA=6.5;KDA=10;SB3", self.transport.sent)
+        self.assertEqual([ (item.cmd, curr) for item, curr in plan['failed'] ], [("KDA", "9")])
+        self.assertEqual((self.transport.state["KPA"], self.transport.state["@OUT[3]"]), ("6.5", "1"))
+        self.assertFalse([ line for line in self.transport.sent if "MO" in line or "SH" in line ])
+
+        plan = self.conf.apply(verify=False)
+        self.assertEqual(plan['lines'], ["KDA=10"])
+        self.assertNotIn("failed", plan)
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function
+import unittest2
+
+import sys
+from os.path import dirname, abspath, join, basename
+sys.path.insert(1, dirname(dirname(abspath(__file__))))
+
+import shutil
+import tempfile
+
+try:
+    import numpy
+    from galil_apci.datalog import DataLogger, read_log, rotated_path
+except ImportError:
+    numpy = None
+
+
+class FakeGalil(object):
+    """Synthetic samples (_TPA = sample number); every 10th read fails"""
+    def __init__(self, count):
+        self.count  = count
+        self.calls  = 0
+        self.logger = None
+
+    def get_list(self, exprs):
+        self.calls += 1
+        if self.calls == self.count:
+            self.logger.stop_event.set()
+        if self.calls % 10 == 0:
+            return None
+        return [ float(self.calls), -float(self.calls) ]
+
+
+@unittest2.skipIf(numpy is None, "requires numpy")
+class DataLog(unittest2.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_rotated_path(self):
+        self.assertEqual(rotated_path("/x/log.npz", 3), "/x/log.0003.npz")
+        self.assertEqual(rotated_path("/x/log-{n:02d}.npz", 3), "/x/log-03.npz")
+
+    def test_sources(self):
+        # e.g., the socket transport: no record decoding
+        with self.assertRaisesRegexp(Exception, "sourceValue"):
+            DataLogger(FakeGalil(1), join(self.root, "log.npz"), sources=["_TPA"])
+
+    def test_chunks(self):
+        galil = FakeGalil(55)
+        dl = DataLogger(galil, join(self.root, "log.npz"), exprs=["_TPA", "_TPB"], rate=1e6,
+                        chunk_rows=16, max_bytes=1)
+        galil.logger = dl
+        dl.run()
+
+        stats = dl.stats()
+        self.assertEqual((stats['samples'], stats['errors']), (50, 5))
+        # 16 + 16 + 16 + 2 rows, every chunk exceeds max_bytes and rotates
+        self.assertEqual([ basename(f) for f in stats['files'] ],
+                         [ "log.0000.npz", "log.0001.npz", "log.0002.npz", "log.0003.npz" ])
+
+        columns, data = read_log(stats['files'])
+        self.assertEqual(columns, ["time", "_TPA", "_TPB"])
+        self.assertEqual(data.shape, (50, 3))
+        wanted = [ float(i) for i in range(1, 56) if i % 10 ]
+        self.assertEqual(list(data[:, 1]), wanted)
+        self.assertEqual(list(data[:, 2]), [ -x for x in wanted ])
+        self.assertTrue((numpy.diff(data[:, 0]) >= 0).all())
+
+        with numpy.load(stats['files'][0]) as npz:
+            self.assertEqual(sorted(npz.files), ["chunk000000", "columns"])
+
+        # without rotation, all chunks land in one archive
+        galil = FakeGalil(20)
+        dl = DataLogger(galil, join(self.root, "one.npz"), exprs=["_TPA", "_TPB"], rate=1e6, chunk_rows=8)
+        galil.logger = dl
+        dl.run()
+        self.assertEqual(len(dl.files), 1)
+        self.assertEqual(read_log(dl.files[0])[1].shape, (18, 3))
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function
+import unittest2
+
+import sys
+from os.path import dirname, abspath
+sys.path.insert(1, dirname(dirname(abspath(__file__))))
+
+import errno
+import socket
+import struct
+
+from galil_apci.datarecord import DataRecordReceiver
+from galil_apci.errors import CommandError
+
+
+class RefusedSocket(object):
+    """Connected UDP socket after an ICMP port unreachable"""
+    def __init__(self):
+        self.calls = 0
+
+    def settimeout(self, timeout):
+        pass
+
+    def recv_into(self, buf):
+        self.calls += 1
+        raise socket.error(errno.ECONNREFUSED, "Connection refused")
+
+    def close(self):
+        pass
+
+
+class FakeGalil(object):
+    address = "127.0.0.1"
+    dr_handle = "C"
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.started = []
+
+    def records_handle(self):
+        return self.sock
+
+    def recordsStart(self, period_ms=-1, samples=None):
+        self.started.append(samples if samples is not None else period_ms)
+
+
+class SwigGalil(object):
+    address = "127.0.0.1"
+
+
+def record(sample, position):
+    # header, sample number, one 32 bit field
+    return struct.pack('<BBHHl', 0x80, 0, 10, sample, position)
+
+
+class Receiver(unittest2.TestCase):
+    def test_accounting(self):
+        rx = DataRecordReceiver(bind=("127.0.0.1", 0), fields=dict(_TPA=(6, 'l')), timeout_ms=50)
+        rx.start(period=2)
+        tx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            # 65534 -> 0 wraps, 6 is lost, 4 arrives late, 2 is repeated
+            # (and 0 again, late)
+            for sample in (65532, 65534, 0, 2, 2, 8, 4, 0, 10):
+                tx.sendto(record(sample, 10 * sample), rx.address)
+            got = []
+            for s in rx.samples(timeout=1.0):
+                got.append(s)
+                if s.sample == 10:
+                    break
+        finally:
+            tx.close()
+            rx.close()
+
+        self.assertEqual([ s.sample for s in got ], [65532, 65534, 0, 2, 8, 10])
+        self.assertEqual(got[-1].values, dict(_TPA=100))
+        stats = rx.stats()
+        self.assertEqual(stats['packets'], 9)
+        self.assertEqual(stats['lost'], 1)
+        self.assertEqual(stats['duplicates'], 2)
+        self.assertEqual(stats['reordered'], 1)
+
+    def test_window(self):
+        rx = DataRecordReceiver(bind=("127.0.0.1", 0))
+        try:
+            rx.step = 1
+            for sample in (65530, 5):                   # 10 lost across the wrap
+                rx.accept(sample, window=4)
+            self.assertEqual(rx.stats()['lost'], 10)
+            self.assertEqual(sorted(rx.missing), [1, 2, 3, 4])
+            for sample in (4, 65533):                   # in and beyond the window
+                self.assertFalse(rx.accept(sample, window=4))
+            self.assertEqual((rx.counters['lost'], rx.counters['reordered'], rx.counters['duplicates']), (9, 1, 1))
+        finally:
+            rx.close()
+
+    def test_errors(self):
+        rx = DataRecordReceiver(bind=("127.0.0.1", 0), timeout_ms=50, max_errors=3, backoff=0.001)
+        rx.sock.close()
+        rx.sock = RefusedSocket()
+        rx.run()                            # returns rather than spinning
+        self.assertEqual(rx.sock.calls, 3)
+        self.assertEqual(rx.stats()['errors'], 3)
+
+    def test_galil(self):
+        galil = FakeGalil()
+        rx = DataRecordReceiver(bind=("127.0.0.1", 0), timeout_ms=50)
+        try:
+            self.assertEqual(rx.connect(galil), "C")
+            self.assertIs(rx.sock, galil.sock)
+            rx.start(galil, period=4)
+            self.assertEqual(galil.started, [4])
+        finally:
+            rx.close()
+        self.assertEqual(galil.started, [4, 0])
+        # the transport keeps its handle
+        self.assertNotEqual(galil.sock.fileno(), -1)
+        galil.sock.close()
+
+        # no record handle (e.g., vendor library transport)
+        rx = DataRecordReceiver(bind=("127.0.0.1", 0))
+        try:
+            with self.assertRaises(CommandError):
+                rx.connect(SwigGalil())
+        finally:
+            rx.close()
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -18,13 +18,28 @@ from __future__ import division, absolute_import, print_function, unicode_litera
 import unittest2
 
 import json
+import os
+import shutil
 import sys
+import tempfile
 from os.path import dirname, abspath
 sys.path.insert(1, dirname(dirname(abspath(__file__))))
 
 from galil_apci.file import GalilFile
+from galil_apci.galil import ProgramBuffer
 from jinja2 import UndefinedError
 
+class FakeGalil(object):
+    """Buffered program downloads (no streaming transport)"""
+    def __init__(self):
+        self.programs = []
+
+    def programDownloadWriter(self):
+        return ProgramBuffer(self)
+
+    def programDownload(self, program):
+        self.programs.append(program)
+
 class BasicAccess(unittest2.TestCase):
     def setUp(self):
         self.gf = GalilFile(path="test/gal")
@@ -38,6 +53,57 @@ class BasicAccess(unittest2.TestCase):
         with self.assertRaises(UndefinedError):
             self.gf.load("galtest.gal", dict())
 
+    def test_variants(self):
+        key = sorted(self.machine)[0]
+        variants, programs = self.gf.build_variants("galtest.gal", self.machine, dict(a={}, b={ key: "XYZ" }, c={}), processes=2)
+        self.assertEqual(list(variants), ["a", "b", "c"])
+        self.assertEqual(len(programs), 2)
+        self.assertEqual(variants["a"]["digest"], variants["c"]["digest"])
+        self.assertEqual(programs[variants["a"]["digest"]], self.gf.load("galtest.gal", self.machine))
+
+        # workers rebuild the environment, they need not be forked
+        import multiprocessing
+        if hasattr(multiprocessing, "get_context"):
+            import galil_apci.file
+            saved = galil_apci.file.Pool
+            try:
+                galil_apci.file.Pool = multiprocessing.get_context("spawn").Pool
+                spawned, _ = self.gf.build_variants("galtest.gal", self.machine, dict(a={}, b={ key: "XYZ" }), processes=2)
+            finally:
+                galil_apci.file.Pool = saved
+            self.assertEqual(spawned["a"]["digest"], variants["a"]["digest"])
+
+    def test_shared(self):
+        other = GalilFile(path="test/gal")
+        other.env.globals["only_here"] = 1
+        self.assertNotIn("only_here", self.gf.env.globals)
+        self.assertIs(GalilFile(path="test/gal", shared=True).env, GalilFile(path="test/gal", shared=True).env)
+
+    def test_stream(self):
+        galil = FakeGalil()
+        stats = self.gf.stream_to("galtest.gal", self.machine, galil)
+        wanted = open('test/gal/galtest.out').read().strip()
+        self.assertEqual(galil.programs, [ wanted ])
+        self.assertEqual(stats['lines'], wanted.count("\n") + 1)
+
+        with self.assertRaises(UndefinedError):
+            self.gf.stream_to("galtest.gal", dict(), galil)
+        self.assertEqual(len(galil.programs), 1)          # nothing partial downloaded
+
+        root = tempfile.mkdtemp()
+        try:
+            path = os.path.join(root, "galtest.dmc")
+            with open(path, "w") as fh:
+                fh.write("old\n")
+            with self.assertRaises(UndefinedError):
+                self.gf.stream_to("galtest.gal", dict(), path)
+            self.assertEqual(open(path).read(), "old\n")     # not truncated
+            self.assertEqual(os.listdir(root), ["galtest.dmc"])
+            self.gf.stream_to("galtest.gal", self.machine, path)
+            self.assertEqual(open(path).read().strip(), wanted)
+        finally:
+            shutil.rmtree(root)
+
 
 if __name__ == '__main__':
     unittest2.main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function
+import unittest2
+
+import sys
+from os.path import dirname, abspath, join
+sys.path.insert(1, dirname(dirname(abspath(__file__))))
+
+import shutil
+import tempfile
+
+from galil_apci.galil import Galil
+from galil_apci.index import ProgramIndex
+
+
+class Index(unittest2.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.db = join(self.root, "index.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_program_hash(self):
+        a, b = b"#A\nEN", b"#B\nEN"
+        src = join(self.root, "x.gal")
+        open(src, "w").write("#{{ label }}\nEN\n")
+        index = ProgramIndex(self.db)
+        self.assertEqual(index.program_hash(a, src), Galil.computeProgramHash(a))
+        index.close()
+
+        # new process, same source file rendered with a different context
+        index = ProgramIndex(self.db)
+        self.assertEqual(index.program_hash(b, src), Galil.computeProgramHash(b))
+        self.assertEqual(index.program_hash(a, src), Galil.computeProgramHash(a))
+
+        index.record("10.0.0.5", "prog", index.program_hash(a), src, downloaded=True)
+        self.assertEqual(index.lookup("10.0.0.5")['hash'], Galil.computeProgramHash(a))
+        index.close()
+
+
+if __name__ == '__main__':
+    unittest2.main()
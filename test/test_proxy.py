@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function
+import unittest2
+
+import sys
+from os.path import dirname, abspath
+sys.path.insert(1, dirname(dirname(abspath(__file__))))
+
+import json
+import threading
+import time
+
+from galil_apci.errors import CommandError
+from galil_apci.proxy import ClientMetrics, GalilProxy, is_read, split_commands
+from galil_apci.transport import SocketTransport
+
+
+class FakeGalil(object):
+    """Upstream answering "MGn" with n; optionally blocks until released"""
+    def __init__(self):
+        self.calls = []
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def command(self, cmd):
+        self.calls.append(cmd)
+        self.entered.set()
+        self.release.wait()
+        if cmd == "XQ#bad":
+            raise CommandError("XQ#bad returned ? 1 Unrecognized command")
+        if cmd == "TC1":
+            return "0"
+        return "{:.4f}".format(float(cmd[2:])) if cmd.startswith("MG") else ""
+
+
+class Proxy(unittest2.TestCase):
+    def setUp(self):
+        self.galil = FakeGalil()
+        self.proxy = GalilProxy(self.galil, listen=("127.0.0.1", 0), cache_ttl=10)
+
+    def tearDown(self):
+        self.proxy.server_close()
+
+    def client(self, port):
+        return ClientMetrics(("127.0.0.1", port))
+
+    def test_is_read(self):
+        for cmd in ("MG1", "TPA", "MG_TPA;TE", "KPA=?", "MW ?", "TP;MG@IN[1]"):
+            self.assertTrue(is_read(cmd), cmd)
+        for cmd in ("SB1", "XQ#AUTO", "MG1;SB2", 'MG "hi"', "KPA=6", "MG1;"):
+            self.assertFalse(is_read(cmd), cmd)
+
+    def test_cache(self):
+        c = self.client(1)
+        self.assertEqual(self.proxy.respond("MG1", c), "1.0000\r\n:")
+        self.assertEqual(self.proxy.respond("MG1", c), "1.0000\r\n:")
+        self.assertEqual((len(self.galil.calls), c.cache_hits), (1, 1))
+
+        # expired
+        t, res = self.proxy.cache["MG1"]
+        self.proxy.cache["MG1"] = (t - 11, res)
+        self.proxy.respond("MG1", c)
+        self.assertEqual(len(self.galil.calls), 2)
+
+        # writes clear the cache
+        self.assertEqual(self.proxy.respond("SB1", c), ":")
+        self.assertEqual(self.proxy.cache, dict())
+        self.proxy.respond("MG1", c)
+        self.assertEqual(self.galil.calls, ["MG1", "MG1", "SB1", "MG1"])
+
+        self.assertEqual(self.proxy.respond("XQ#bad", c), "?")
+        self.assertEqual((c.commands, c.reads, c.writes, c.errors), (6, 4, 2, 1))
+
+    def test_split(self):
+        self.assertEqual(split_commands('SB1;SB2'), ["SB1", "SB2"])
+        self.assertEqual(split_commands(' MG "a;b";MG1 ; '), ['MG "a;b"', "MG1"])
+
+    def test_packed(self):
+        c = self.client(1)
+        self.assertEqual(self.proxy.respond("SB1;MG2;MG1", c), ":2.0000\r\n:1.0000\r\n:")
+        self.assertEqual(self.galil.calls, ["SB1", "MG2", "MG1"])
+        # the controller ignores the rest of the line after an error
+        self.assertEqual(self.proxy.respond("MG1;XQ#bad;SB2", c), "1.0000\r\n:?")
+        self.assertEqual(self.galil.calls[-1], "XQ#bad")
+
+    def test_errors(self):
+        a, b = self.client(1), self.client(2)
+        self.assertEqual(self.proxy.respond("TC1", a), "0\r\n:")
+        self.assertEqual(self.proxy.respond("XQ#bad", a), "?")
+        self.assertEqual(self.proxy.respond("SB1", b), ":")
+        # each client sees its own last error, TC1 is not sent upstream
+        self.assertEqual(self.proxy.respond("TC1", a), "1 Unrecognized command\r\n:")
+        self.assertEqual(self.proxy.respond("TC", a), "1\r\n:")
+        self.assertEqual(self.proxy.respond("TC1", b), "0\r\n:")
+        self.assertNotIn("TC1", self.galil.calls)
+
+    def test_transport(self):
+        thread = threading.Thread(target=self.proxy.serve_forever)
+        thread.daemon = True
+        thread.start()
+        transport = SocketTransport("127.0.0.1:{}".format(self.proxy.server_address[1]))
+        try:
+            self.assertEqual(transport.command("SB1;SB2"), "")
+            self.assertEqual(transport.command("MG1;MG2").split(), ["1.0000", "2.0000"])
+            with self.assertRaises(CommandError) as ctx:
+                transport.command("XQ#bad")
+            self.assertIn("1 Unrecognized command", str(ctx.exception))
+        finally:
+            transport.close()
+            self.proxy.shutdown()
+            thread.join()
+
+    def test_merge(self):
+        a, b = self.client(1), self.client(2)
+        replies = dict()
+        self.galil.release.clear()
+        first = threading.Thread(target=lambda: replies.update(a=self.proxy.respond("MG2", a)))
+        first.start()
+        self.assertTrue(self.galil.entered.wait(5))
+        second = threading.Thread(target=lambda: replies.update(b=self.proxy.respond("MG2", b)))
+        second.start()
+        deadline = time.time() + 5
+        while not b.merged and time.time() < deadline:
+            time.sleep(0.001)
+        self.galil.release.set()
+        first.join()
+        second.join()
+
+        self.assertEqual(replies, dict(a="2.0000\r\n:", b="2.0000\r\n:"))
+        self.assertEqual(self.galil.calls, ["MG2"])
+        self.assertEqual((a.upstream, b.upstream, b.merged), (1, 0, 1))
+
+    def test_stats(self):
+        self.proxy.add_client(("127.0.0.1", 3))
+        c = self.proxy.clients[("127.0.0.1", 3)]
+        self.proxy.respond("MG3", c)
+        reply = self.proxy.respond("#STATS", c)
+        self.assertTrue(reply.endswith("\r\n:"))
+        stats = json.loads(reply[:-3])
+        self.assertEqual([ s['address'] for s in stats['clients'] ], ["127.0.0.1:3"])
+        self.assertEqual((stats['clients'][0]['reads'], stats['cached']), (1, 1))
+        self.proxy.remove_client(("127.0.0.1", 3))
+        self.assertEqual(len(self.proxy.metrics()['closed']), 1)
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function
+import unittest2
+
+import sys
+from os.path import dirname, abspath
+sys.path.insert(1, dirname(dirname(abspath(__file__))))
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from galil_apci.errors import CommandError
+from galil_apci.record import SessionRecorder, ReplayGalil, ReplayError
+
+
+class Replay(unittest2.TestCase):
+    def setUp(self):
+        self.fh = StringIO()
+        rec = SessionRecorder(self.fh)
+        rec.record("command", "MG_TPA", " 10.0000", rec.start, 0.001)
+        rec.record("command", "MG_TPA", " 20.0000", rec.start + 0.01, 0.001)
+        rec.record("commandValue", "MGxOk", 1.0, rec.start + 0.02, 0.001)
+        rec.record("command", "XQ#foo", None, rec.start + 0.03, 0.5, CommandError("2 bad"))
+        rec.close()
+
+    def replay(self, **kwargs):
+        return ReplayGalil(StringIO(self.fh.getvalue()), **kwargs)
+
+    def test_keyed(self):
+        galil = self.replay()
+        self.assertEqual(galil.commandValue("MGxOk"), 1.0)
+        self.assertEqual(galil.get_list(["_TPA"]), [10.0])
+        self.assertEqual(galil.get_list(["_TPA"]), [20.0])
+        self.assertEqual(galil.get_list(["_TPA"]), [20.0])
+        with self.assertRaises(CommandError):
+            galil.command("XQ#foo")
+        with self.assertRaises(ReplayError):
+            galil.command("MG_TPB")
+        self.assertEqual((galil.max_line_length, galil.timeout_ms, galil.program_index), (80, 500, None))
+
+    def test_strict(self):
+        galil = self.replay(strict=True)
+        self.assertEqual(galil.command("MG_TPA"), " 10.0000")
+        with self.assertRaises(ReplayError):
+            galil.commandValue("MGxOk")
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function
+import unittest2
+
+import sys
+from os.path import dirname, abspath
+sys.path.insert(1, dirname(dirname(abspath(__file__))))
+
+from galil_apci.errors import TimeoutError
+from galil_apci.galil import Galil
+from galil_apci.retry import RetryPolicy
+
+
+class FakeTransport(object):
+    """Times out the first C{failures} commands, recording the timeout of each attempt"""
+    def __init__(self, failures=0):
+        self.timeout_ms = 500
+        self.failures = failures
+        self.calls = []
+
+    def command(self, cmd):
+        self.calls.append((cmd, self.timeout_ms))
+        if self.failures:
+            self.failures -= 1
+            raise TimeoutError("1010 TIMEOUT ERROR")
+        return "1.0000"
+
+
+def galil(failures=0, **kwargs):
+    g = Galil("fake", transport=FakeTransport(failures))
+    g.retry_policy = RetryPolicy(backoff=0, **kwargs)
+    return g
+
+
+class Retry(unittest2.TestCase):
+    def test_backoff(self):
+        policy = RetryPolicy(backoff=0.010, backoff_max=0.030, jitter=0)
+        self.assertEqual([ policy.delay(n) for n in (1, 2, 3, 4) ], [ 0.010, 0.020, 0.030, 0.030 ])
+        policy.jitter = 0.5
+        for _ in range(20):
+            self.assertTrue(0.010 <= policy.delay(2) <= 0.020)
+
+    def test_retries(self):
+        g = galil(failures=2, retries=2)
+        self.assertEqual(g.command("MG1"), "1.0000")
+        self.assertEqual(len(g.transport.calls), 3)
+        self.assertEqual(g.retry_policy.counters, dict(calls=1, timeouts=2, retries=2))
+
+        g = galil(failures=3, retries=2)
+        self.assertIsNone(g.command("MG1"))
+        self.assertEqual(len(g.transport.calls), 3)
+        self.assertEqual(g.retry_policy.counters['failures'], 1)
+
+        g = galil(failures=1, retries=2, raise_errors=True)
+        with self.assertRaises(TimeoutError):
+            g.command("MG1", retry=0)
+        self.assertEqual(g.command("MG1"), "1.0000")
+
+    def test_non_idempotent(self):
+        for cmd in ("XQ#AUTO", "SB2", "CB2", "RS", "MG1;SB3"):
+            g = galil(failures=1, retries=2)
+            self.assertIsNone(g.command(cmd))
+            self.assertEqual(len(g.transport.calls), 1, cmd)
+            self.assertEqual(g.retry_policy.counters['suppressed'], 1)
+            self.assertEqual(g.retry_policy.counters['retries'], 0)
+
+    def test_adaptive(self):
+        g = galil(failures=1, retries=1, min_samples=20)
+        policy = g.retry_policy
+        self.assertEqual(policy.timeout_for(["MG"]), None)
+        for _ in range(20):
+            policy.observe(["MG"], 100.0)
+        self.assertEqual(policy.timeout_for(["MG"]), 400)
+        self.assertEqual(policy.timeout_for(["MG", "QU"]), 400)        # QU: no samples, no default yet
+
+        # a timeout doubles the timeout of the next attempt
+        self.assertEqual(g.command("MG1"), "1.0000")
+        self.assertEqual([ t for _, t in g.transport.calls ], [400, 800])
+        self.assertEqual(policy.default_timeout_ms, 500)
+
+        for _ in range(200):
+            policy.observe(["MG"], 1.0)
+        self.assertEqual(policy.timeout_for(["MG"]), 50)                # clamped to timeout_min_ms
+        self.assertEqual(policy.stats()['timeouts']['MG'], 50)
+
+        policy.reset_timeout(g)
+        self.assertEqual(g.timeout_ms, 500)
+
+
+if __name__ == '__main__':
+    unittest2.main()
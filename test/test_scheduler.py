@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function
+import unittest2
+
+import sys
+from os.path import dirname, abspath
+sys.path.insert(1, dirname(dirname(abspath(__file__))))
+
+from galil_apci.errors import CommandError
+from galil_apci.scheduler import ReadScheduler
+
+
+class FakeGalil(object):
+    max_line_length = 80
+
+    def __init__(self):
+        self.calls = []
+
+    def translate(self, expr):
+        return expr
+
+    def get_list(self, exprs):
+        self.calls.append(list(exprs))
+        if "bad" in exprs:
+            raise CommandError("bad")
+        return [ float(len(e)) for e in exprs ]
+
+
+class Scheduler(unittest2.TestCase):
+    def test_coalesce(self):
+        galil = FakeGalil()
+        sched = ReadScheduler(galil)
+        got = dict(a=[], b=[])
+        a = sched.subscribe(["_TPA", "_TPB"], 10, lambda v, t: got['a'].append(v))
+        b = sched.subscribe(["_TPB", "@IN[1]"], 5, lambda v, t: got['b'].append(v))
+        b.next_due = a.next_due
+
+        self.assertEqual(sched.tick(), 2)
+        self.assertEqual(galil.calls, [["_TPA", "_TPB", "@IN[1]"]])
+        self.assertEqual(got['a'], [dict(_TPA=4.0, _TPB=4.0)])
+        self.assertEqual(got['b'], [{"_TPB": 4.0, "@IN[1]": 6.0}])
+        self.assertAlmostEqual(b.next_due - a.next_due, 0.1, places=5)
+        self.assertEqual(sched.tick(now=a.next_due - 1), 0)
+        self.assertEqual(sched.stats()['requested'], 4)
+        self.assertEqual(sched.stats()['exprs'], 3)
+
+    def test_bad_expression(self):
+        galil = FakeGalil()
+        sched = ReadScheduler(galil)
+        got = []
+        sched.subscribe(["_TPA"], 10, lambda v, t: got.append(v))
+        bad = sched.subscribe(["bad"], 10, lambda v, t: got.append(v))
+        self.assertEqual(sched.tick(), 1)
+        self.assertEqual(got, [dict(_TPA=4.0)])
+        self.assertEqual(bad.errors, 1)
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function
+import unittest2
+
+import sys
+from os.path import dirname, abspath
+sys.path.insert(1, dirname(dirname(abspath(__file__))))
+
+from galil_apci.schema import VariableSchema
+
+
+class FakeGalil(object):
+    max_line_length = 40
+
+    def __init__(self, responses=()):
+        self.responses = list(responses)
+        self.commands = []
+
+    def command(self, cmd):
+        self.commands.append(cmd)
+        return self.responses.pop(0) if self.responses else ":"
+
+    def translate(self, expr):
+        return expr
+
+
+class SchemaAccess(unittest2.TestCase):
+    def setUp(self):
+        self.schema = VariableSchema([
+            ("xSpeed", float), ("xCount", int), ("xName", str),
+            ("xOn", bool), ("xTbl", 'int', 3),
+        ])
+
+    def test_read(self):
+        compiled = self.schema.compile(38)
+        for cmd, slots in compiled.read_cmds:
+            self.assertLessEqual(len(cmd), 38)
+        self.assertEqual(sum(len(s) for c, s in compiled.read_cmds), 7)
+
+        coded = [ "$0000000C.8000", "$FFFFFFFE.0000", "$41424300.0000",
+                  "$00000001.0000", "$00000001.0000", "$00000002.0000", "$00000003.0000" ]
+        responses = []
+        for cmd, slots in compiled.read_cmds:
+            responses.append(" ".join(coded[0:len(slots)]))
+            coded = coded[len(slots):]
+
+        galil = FakeGalil(responses)
+        got = self.schema.read(galil)
+        self.assertEqual(len(galil.commands), len(compiled.read_cmds))
+        self.assertEqual(got, dict(xSpeed=12.5, xCount=-2, xName="ABC", xOn=True, xTbl=[1, 2, 3]))
+
+    def test_write(self):
+        galil = FakeGalil()
+        lines = self.schema.write(galil, xSpeed=1.25, xCount=7, xName="ab", xOn=False, xTbl=[4, 5, 6])
+        self.assertEqual(lines, galil.commands)
+        for line in lines:
+            self.assertLessEqual(len(line), 38)
+        self.assertEqual(";".join(lines).split(";"), [
+            'xSpeed=1.25', 'xCount=7', 'xName="ab"', 'xOn=0', 'xTbl[0]=4', 'xTbl[1]=5', 'xTbl[2]=6'
+        ])
+
+        galil = FakeGalil()
+        self.schema.write(galil, dict(xCount=3), xOn=True)
+        self.assertEqual(galil.commands, ["xCount=3;xOn=1"])
+
+        with self.assertRaises(ValueError):
+            self.schema.write(galil, xName="toolong")
+        with self.assertRaises(KeyError):
+            self.schema.write(galil, xBogus=1)
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function
+import unittest2
+
+import sys
+from os.path import dirname, abspath, join
+sys.path.insert(1, dirname(dirname(abspath(__file__))))
+
+import shutil
+import tempfile
+
+from galil_apci.status import StatusPublisher, StatusReader
+
+
+class FakeGalil(object):
+    nr_digital_inputs  = 4
+    nr_digital_outputs = 4
+    nr_analog_inputs   = 2
+    nr_threads         = 4
+
+    def get_list(self, exprs):
+        values = dict(( "@IN[{}]".format(i), 1.0 if i in (1, 3) else 0.0 ) for i in range(1, 5))
+        values.update(( "@OUT[{}]".format(i), 1.0 if i == 2 else 0.0 ) for i in range(1, 5))
+        values.update({ "@AN[1]": 1.5, "@AN[2]": -2.5, "_TPA": 100.0, "_TPB": -7.0,
+                        "_XQ0": 5.0, "_XQ1": -1.0, "_XQ2": 12.0, "_XQ3": -1.0 })
+        return [ values[e] for e in exprs ]
+
+    def command(self, cmd):
+        # "PROG", hash
+        return "$50524F47.0000 $00123456.7800"
+
+
+class TornReader(StatusReader):
+    """Sees a writer update in progress, then one completing mid-copy"""
+    def __init__(self, path, sequence):
+        super(TornReader,self).__init__(path)
+        self.script = list(sequence)
+
+    def sequence(self):
+        return self.script.pop(0) if self.script else super(TornReader,self).sequence()
+
+
+class Status(unittest2.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = join(self.root, "status")
+        self.publisher = StatusPublisher(FakeGalil(), self.path, axes="AB")
+
+    def tearDown(self):
+        self.publisher.close()
+        shutil.rmtree(self.root)
+
+    def test_round_trip(self):
+        reader = StatusReader(self.path)
+        self.assertIsNone(reader.read())
+        self.assertTrue(self.publisher.publish())
+
+        snap = reader.read()
+        self.assertEqual(snap.seq, 2)
+        self.assertTrue(snap.ok)
+        self.assertEqual(snap.inputs, [1, 0, 1, 0])
+        self.assertEqual(snap.outputs, [0, 1, 0, 0])
+        self.assertEqual(snap.analog, [1.5, -2.5])
+        self.assertEqual(snap.positions, dict(A=100.0, B=-7.0))
+        self.assertEqual(snap.threads, set([0, 2]))
+        self.assertEqual((snap.program_name, snap.program_hash), ("PROG", "$00123456.7800"))
+
+        # 32 bit sequence wrap skips 0 ("nothing published")
+        self.publisher.seq = 0xFFFFFFFE
+        self.publisher.publish()
+        self.assertEqual(reader.read().seq, 2)
+        reader.close()
+
+    def test_torn_read(self):
+        self.publisher.publish()
+        reader = TornReader(self.path, [3, 4, 6, 6, 6])
+        self.assertEqual(reader.read().seq, 6)
+        self.assertEqual(reader.script, [])
+        reader.close()
+
+        with self.assertRaises(RuntimeError):
+            TornReader(self.path, [5] * 3).read(retries=3)
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function, unicode_literals
+import unittest2
+
+import re
+import sys
+from os.path import dirname, abspath
+sys.path.insert(1, dirname(dirname(abspath(__file__))))
+
+from galil_apci import text
+from galil_apci.errors import ProgramLimitError
+from galil_apci.galil import Galil
+from galil_apci.timing import StageProfiler
+
+
+class FakeTransport(object):
+    timeout_ms = 500
+
+    def connection(self):
+        return "RIO47100 Rev 1.0, 123, 10.0.0.70, IHA"
+
+
+SAMPLE = """
+REM A test
+#AUTO
+    ' set up
+    a = 1
+    b = 2
+    JS#foo
+    EN
+
+#foo
+    IF (a = 1)
+        JS#bar
+    ENDIF
+    EN
+"""
+
+class TextPasses(unittest2.TestCase):
+    def test_minify(self):
+        self.assertEqual(text.minify(SAMPLE), "#AUTO;a=1;b=2\nJS#foo\nEN\n#foo;IF(a=1)\nJS#bar;ENDIF\nEN")
+        self.assertEqual(text.minify(SAMPLE, 10).split("\n")[0:2], ["#AUTO;a=1", "b=2"])
+        self.assertEqual(list(text.minify_lines(SAMPLE.splitlines(True))), text.minify(SAMPLE).split("\n"))
+
+    def test_trim(self):
+        self.assertEqual(text.trim("  a=1  \n\n\tEN\n"), "a=1\nEN")
+
+    def test_lint(self):
+        errors = text.lint(SAMPLE, warnings=True)
+        self.assertEqual(errors[0], "IF(...);JS#bar better written as JS#bar,(...)")
+        self.assertIn("line(s) [5], J[SP]#bar found but label #bar not defined", errors)
+
+    def test_prune(self):
+        src = SAMPLE + "#bar\nJP#baz\n#baz\nc=1\n#qux\nd=1\nEN\n#dead\nJS#qux\nEN\n"
+        report = dict()
+        self.assertEqual(text.minify(src, prune=True, report=report),
+                         "#AUTO;a=1;b=2\nJS#foo\nEN\n#foo;IF(a=1)\nJS#bar;ENDIF\nEN\n#bar;JP#baz\n#baz;c=1\n#qux;d=1\nEN")
+        self.assertEqual(report, dict(labels=["#dead"], lines=3, bytes=16))
+        self.assertIn("#dead", text.minify(src, prune=True, keep=["dead"]))
+
+    def test_shorten(self):
+        src = '#AUTO\nlongname=1;xRun="longname"\n#worker\nlongname=longname+other;JS#worker\nEN\n'
+        symbols = dict()
+        self.assertEqual(text.minify(src, shorten=True, symbols=symbols),
+                         '#AUTO;a=1;xRun="longname"\n#a;a=a+other;JS#a;EN')
+        self.assertEqual(symbols, dict(variables=dict(longname="a"), labels={"#worker": "#a"}))
+        self.assertEqual(text.rename('MG longname,"longname",_TPA,#worker', symbols['variables'], symbols['labels']),
+                         'MG a,"longname",_TPA,#a')
+
+    def test_analyze(self):
+        stats = text.analyze(text.minify(SAMPLE) + "\nDM buf[100],log[n];XQ#foo,3\nbuf[0]=a\n")
+        self.assertEqual((stats['lines'], stats['labels'], stats['variables']), (8, 2, 2))
+        self.assertEqual((stats['arrays'], stats['array_elements'], stats['unsized_arrays']), (2, 100, ["log"]))
+        self.assertEqual(stats['threads'], 4)
+        self.assertEqual(text.check_limits(stats, "DMC4080 Rev 1.0, 123, 10.0.0.70, IHA"), [])
+        self.assertEqual(text.check_limits(stats, dict(lines=5, threads=4)), ["Program lines 8 exceeds limit 5"])
+        self.assertIsNone(text.model_limits("XYZ"))
+
+    def test_stream_lines(self):
+        chunks = ["#A;", "MG 1;\n", "  ;\n\n", ";MG 2", "\nEN"]
+        content = "".join(chunks)
+        self.assertEqual(list(text.split_lines(chunks)), content.split("\n"))
+        self.assertEqual(list(text.strip_double_semis(text.split_lines(chunks))),
+                         text.double_semi.sub(r'\1', content).split("\n"))
+
+    def test_program_limits(self):
+        galil = Galil("fake", transport=FakeTransport())
+        # indented, unminified assignments are counted (RIO47: 126 variables)
+        program = "#AUTO\n" + "".join( "    v{} = 1\n".format(i) for i in range(127) ) + "    EN\n"
+        with self.assertRaises(ProgramLimitError) as ctx:
+            galil.checkProgramLimits(program)
+        self.assertIsInstance(ctx.exception, ValueError)
+        self.assertIn("Program variables 127 exceeds limit 126", str(ctx.exception))
+        galil.checkProgramLimits(program.replace("v126", "v0"))
+
+
+class Profile(unittest2.TestCase):
+    def test_stages(self):
+        prof = StageProfiler()
+        with prof.count_regexes(text):
+            with prof.file("sample.gal"):
+                with prof.stage("minify") as out:
+                    out.append(text.minify(SAMPLE, 79))
+        self.assertIsInstance(text.comment, type(re.compile("")))     # restored
+
+        report = prof.report()
+        self.assertEqual(report['slowest'], "sample.gal")
+        self.assertEqual(report['stages']['minify']['calls'], 1)
+        self.assertEqual(report['files']['sample.gal']['minify']['lines'], text.minify(SAMPLE, 79).count("\n") + 1)
+        self.assertGreater(report['regex']['galil_apci.text.comment'], 0)
+        self.assertEqual(report['regex_total'], sum(report['regex'].values()))
+
+
+if __name__ == '__main__':
+    unittest2.main()
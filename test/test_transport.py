@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Dean Serenevy  <deans@apcisystems.com>
+# This software is Copyright (c) 2013 APCI, LLC.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, absolute_import, print_function
+import unittest2
+
+import sys
+from os.path import dirname, abspath
+sys.path.insert(1, dirname(dirname(abspath(__file__))))
+
+import socket
+import threading
+
+from galil_apci.errors import CommandError, TimeoutError
+from galil_apci.galil import Galil
+from galil_apci.transport import SocketTransport, count_commands
+
+
+class FakeController(threading.Thread):
+    """Answers a few DMC commands on a single TCP connection"""
+    def __init__(self):
+        super(FakeController,self).__init__()
+        self.daemon = True
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(1)
+        self.address = "127.0.0.1:{}".format(self.server.getsockname()[1])
+        self.program = None
+        self.arrays = dict(data=[1.0, 2.5, -3.0])
+
+    def answer(self, cmd):
+        if cmd.startswith("MG") and cmd.endswith("[-1]"):
+            return " {:.4f}\r\n:".format(len(self.arrays[cmd[2:-4]]))
+        if cmd.startswith("QU"):
+            name, first, last, delim = cmd[2:].replace("[]", "").split(",")
+            return "\r".join( "{:.4f}".format(v) for v in self.arrays[name][int(first):int(last)+1] ) + "\r\n:"
+        if cmd.startswith("MG"):
+            return "".join( " {:.4f}\r\n".format(float(x)) for x in cmd[2:].split(",") ) + ":"
+        if cmd == "TC1":
+            return "  1 Unrecognized command\r\n:"
+        if cmd == "UL":
+            return "#A\r\nEN\r\n\x1a:"
+        if cmd == "SLOW":
+            return ""
+        if cmd.startswith("XQ"):
+            return "?"
+        return ":"
+
+    def run(self):
+        conn, _ = self.server.accept()
+        buf = b""
+        while True:
+            data = conn.recv(4096)
+            if not data:
+                break
+            buf += data
+            while b"\r" in buf:
+                if buf.startswith(b"DL\r"):
+                    if b"\\" not in buf:
+                        break
+                    end = buf.index(b"\\")
+                    self.program = buf[3:end].decode('latin-1')
+                    buf = buf[end+1:]
+                    conn.sendall(b":")
+                    continue
+                if buf.startswith(b"QD"):
+                    if b"\\" not in buf:
+                        break
+                    head, rest = buf.split(b"\r", 1)
+                    end = rest.index(b"\\")
+                    name, first, last = head[2:].decode('latin-1').replace("[]", "").split(",")
+                    values = [ float(x) for x in rest[:end].decode('latin-1').split(",") ]
+                    self.arrays[name][int(first):int(last)+1] = values
+                    buf = rest[end+1:]
+                    conn.sendall(b":")
+                    continue
+                line, buf = buf.split(b"\r", 1)
+                res = ""
+                for cmd in line.decode('latin-1').split(";"):
+                    if cmd:
+                        res += self.answer(cmd)
+                        if res.endswith("?"):
+                            break
+                # dribble the response to exercise buffering
+                for i in range(len(res)):
+                    conn.sendall(res[i:i+1].encode('latin-1'))
+        conn.close()
+
+
+class Transport(unittest2.TestCase):
+    def setUp(self):
+        self.controller = FakeController()
+        self.controller.start()
+        self.transport = SocketTransport(self.controller.address, timeout_ms=200)
+
+    def tearDown(self):
+        self.transport.close()
+
+    def test_command(self):
+        t = self.transport
+        self.assertEqual(t.command("MG1"), "1.0000")
+        self.assertEqual(t.commandValue("MG2.5"), 2.5)
+        self.assertEqual(t.command("MG1,2"), "1.0000\r\n 2.0000")
+        self.assertEqual(t.command("SH;MG3;"), "3.0000")
+        with self.assertRaisesRegexp(CommandError, "Unrecognized"):
+            t.command("XQ#foo")
+        with self.assertRaises(TimeoutError):
+            t.command("SLOW")
+        self.assertEqual(t.command("MG4"), "4.0000")
+
+    def test_program(self):
+        t = self.transport
+        self.assertEqual(t.programUpload(), "#A\nEN")
+        t.programDownload("#B\nEN\n")
+        self.assertEqual(self.controller.program, "#B\rEN\r")
+
+    def test_array(self):
+        t = self.transport
+        self.assertEqual(t.arrayUpload("data"), [1.0, 2.5, -3.0])
+        t.arrayDownload([4, 5.25], "data")
+        self.assertEqual(self.controller.arrays["data"], [4.0, 5.25, -3.0])
+        self.assertEqual(t.command("MG1"), "1.0000")
+        self.assertFalse(hasattr(t, "sourceValue"))
+
+    def test_galil(self):
+        galil = Galil(self.controller.address, transport=self.transport)
+        self.assertEqual(galil.command("MG7"), "7.0000")
+        self.assertEqual(galil.commandValue("MG8"), 8.0)
+        self.assertEqual(galil.timeout_ms, 200)
+
+        writer = galil.programDownloadWriter()
+        for line in ("#C", "MG 1", "EN"):
+            writer.write(line)
+        writer.close()
+        self.assertEqual(self.controller.program, "#C\rMG 1\rEN\r")
+
+        writer = galil.programDownloadWriter()
+        writer.write("#D")
+        writer.abort()
+        self.assertEqual(self.controller.program, "")
+
+        # lines already sent are replaced by an empty program
+        writer = galil.programDownloadWriter()
+        for i in range(300):
+            writer.write("MG {}".format(i))
+        self.assertGreater(writer.sent, 0)
+        writer.abort()
+        self.assertEqual(self.controller.program, "")
+        self.assertEqual(galil.command("MG9"), "9.0000")
+
+    def test_count(self):
+        self.assertEqual(count_commands("MG1"), 1)
+        self.assertEqual(count_commands("SH;MG1;"), 2)
+        self.assertEqual(count_commands('MG "a;b";TP'), 2)
+
+
+if __name__ == '__main__':
+    unittest2.main()